@@ -14,6 +14,10 @@ import traceback
 import datetime as dt
 import json
 
+from drivers import DRIVERS, Launcher
+from readiness import wait_for
+from tabs import TabbedBrowser
+
 
 class App(object):
     """
@@ -30,6 +34,10 @@ Attritbutes:
     qa_specialis-   name of the current qa specialist
     data        -   dict of loaded json data
     USRS        -   list of test agents
+    concurrency -   the most browsers started at once
+    launcher    -   the Launcher of the last browsers started
+    tabbed      -   open new apps as tabs of one browser per browser type
+    browsers    -   the TabbedBrowsers opened in tabbed mode
     """
 
 
@@ -40,6 +48,10 @@ Attritbutes:
         self.sfile = './data.json'
         self.data = {}
         self.qa_specialist = 'Greg'
+        self.concurrency = 3
+        self.launcher = None
+        self.tabbed = False
+        self.browsers = []
         
         # load saved data
         self.load_sfile()
@@ -124,41 +136,46 @@ Attritbutes:
         browsers = raw_input("Enter the browsers you want to test. (ff) (ch):  ")
         states = raw_input("Enter the states you want to test. (o) - oklahoma, (m) - missouri, (a) - arkansas : ")
 
-        options = Options()
-        options.add_argument("--devtools")
-        driver = webdriver.Firefox(firefox_options=options)
-        driver.get(u)
-        driver.find_element(By.XPATH, '//a[text()="Quote a rewrite with change"]').click()
-        
-        for u in urls:
-            options = webdriver.ChromeOptions()
-            options.add_experimental_option("detach", True)
-            driver = webdriver.Chrome(chrome_options=options)
-            driver.get(u)
-            driver.find_element(By.XPATH, '//a[text()="Quote a rewrite with change"]').click()
+        browsers = [b for b in browsers.split() if b in DRIVERS] or ['ff', 'ch']
+
+        def quote_rewrite(driver):
+            wait_for(driver, (By.XPATH, '//a[text()="Quote a rewrite with change"]')).click()
+
+        return self.launch(browsers, urls, quote_rewrite)
 
     def new_apps(self, urls):
-        for u in urls:
-            options = Options()
-            options.add_argument("--devtools")
-            driver = webdriver.Firefox(firefox_options=options)
-            driver.get(u)
-            
-        
-        # Open Chrome browsers in all 3 states and go to 
+        # Open Firefox and Chrome browsers in all 3 states and go to
         # Quick Quote Rewrite Auto Rater
-        for u in urls:
-            options = webdriver.ChromeOptions()
-            options.add_experimental_option("detach", True)
-            driver = webdriver.Chrome(chrome_options=options)
-            driver.get(u)
-            
+        if self.tabbed:
+            return self.launch(['ff', 'ch'], urls[:1],
+                               lambda driver: self.open_tabs(driver, urls))
+        return self.launch(['ff', 'ch'], urls)
+
+    def open_tabs(self, driver, urls):
+        """Turn a browser on urls[0] into a tab per url, see tabs.py"""
+        browser = TabbedBrowser(driver)
+        # Reopen the first url in its tab so it gets the tab's credentials
+        for url in urls:
+            browser.open(url)
+        self.browsers.append(browser)
+        return browser
+
+    def launch(self, browsers, urls, after=None):
+        """Start the browsers in the background, see drivers.Launcher"""
+        self.launcher = Launcher(self.concurrency)
+        self.launcher.launch(browsers, urls, after)
+        return self.launcher
+
     def main_loop(self):
         """Manages the UI."""
         while True:
             self.clear_screen()
             self.print_screen()
             print('Current vdev: {}'.format(self.data["vdev"]))
+            if self.launcher:
+                print(self.launcher.progress())
+            print('New apps open in: {}'.format(
+                'tabs' if self.tabbed else 'windows'))
             self.print_main_menu()
 
             cmd = raw_input("\nEnter a command: ").strip().lower()
@@ -172,8 +189,10 @@ Attritbutes:
                 self.set_vdev()
 
             elif cmd == 'r':
+                # Only the questions run here, the browsers start on the
+                # launcher's threads and 'l' shows their progress
                 try:
-                    thread.start_new_thread(self.rewrites, (self.get_rewrite_urls(),))
+                    self.run_setup(self.get_rewrite_urls())
                 except Exception as e:
                     self.clear_screen()
                     traceback.print_exc()
@@ -184,6 +203,16 @@ Attritbutes:
             elif cmd == 'n':
                     self.new_apps(self.get_na_urls())
 
+            elif cmd == 't':
+                self.tabbed = not self.tabbed
+
+            elif cmd == 'l':
+                self.clear_screen()
+                if self.launcher:
+                    print(self.launcher.progress())
+                    print(self.launcher.report())
+                raw_input("\nHit enter to cont...")
+
             elif cmd == 'q':
                # self.clear_screen()
                 print("Thanks for playing!")
@@ -222,6 +251,8 @@ Attritbutes:
                 "           MENU                    \n\n"
                 ": r     -  Rewrites               :\n"
                 ": n     -  New App                :\n"
+                ": l     -  Browser Launch Times   :\n"
+                ": t     -  Toggle Tabbed New Apps :\n"
                 ": p     -  Enter New Policies     :\n"  
                 ": v     -  Enter New Envirnoment  :\n"
                 ": s     -  Save                   :\n"
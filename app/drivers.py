@@ -0,0 +1,194 @@
+"""
+Browser drivers for the QA Helper, and a launcher that starts them in parallel
+
+Starting a browser takes seconds, most of it waiting on the browser and its
+driver process, so the Launcher starts several sessions at once: one thread
+per session, with a semaphore limiting how many start at the same time.
+Each Session records how long its browser took to start and its page took
+to load, and the Launcher reports progress while they run.
+
+Typical use:
+    launcher = Launcher(concurrency=3)
+    launcher.launch(['ff', 'ch'], urls)
+    print(launcher.progress())
+    launcher.wait()
+    print(launcher.report())
+"""
+
+from selenium import webdriver
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+from selenium.webdriver.firefox.options import Options
+
+import threading
+import time
+
+
+def firefox():
+    """Start Firefox with the developer tools open"""
+    options = Options()
+    options.add_argument("--devtools")
+    return webdriver.Firefox(firefox_options=options)
+
+
+def chrome():
+    """Start Chrome, left open when the script exits"""
+    options = webdriver.ChromeOptions()
+    options.add_experimental_option("detach", True)
+    return webdriver.Chrome(chrome_options=options)
+
+
+def headless_firefox():
+    """Start Firefox without a window"""
+    options = Options()
+    options.add_argument("--headless")
+    return webdriver.Firefox(firefox_options=options)
+
+
+def remote_chrome(command_executor='http://127.0.0.1:4444/wd/hub'):
+    """Start Chrome through a Selenium server"""
+    return webdriver.Remote(
+        command_executor=command_executor,
+        desired_capabilities=DesiredCapabilities.CHROME)
+
+
+# Browser codes used in the menus and session pool, and the factory for each
+DRIVERS = {
+    'ff': firefox,
+    'ch': chrome,
+    'ffh': headless_firefox,
+    'rch': remote_chrome,
+}
+
+
+class Session(object):
+    """
+One browser being started and pointed at a url
+
+Attributes:
+    browser     -   the browser code, a key of DRIVERS
+    url         -   the page to open
+    driver      -   the WebDriver, once started
+    state       -   waiting, starting, loading, ready or failed
+    error       -   the exception if it failed
+    startup     -   seconds the browser took to start
+    navigation  -   seconds the page took to load, including after()
+    """
+
+    def __init__(self, browser, url):
+        self.browser = browser
+        self.url = url
+        self.driver = None
+        self.state = 'waiting'
+        self.error = None
+        self.startup = None
+        self.navigation = None
+
+    def run(self, factory, after=None):
+        """Start the browser, open the url and run after(driver)"""
+        try:
+            self.state = 'starting'
+            started = time.time()
+            self.driver = factory()
+            self.startup = time.time() - started
+
+            self.state = 'loading'
+            started = time.time()
+            self.driver.get(self.url)
+            if after is not None:
+                after(self.driver)
+            self.navigation = time.time() - started
+            self.state = 'ready'
+        except Exception as e:
+            self.error = e
+            self.state = 'failed'
+
+
+class Launcher(object):
+    """Starts browser sessions in parallel"""
+
+    def __init__(self, concurrency=3, drivers=DRIVERS):
+        """
+        Args:
+            concurrency (int): The most browsers starting at once
+            drivers (dict): Browser factories by browser code
+        """
+        self.concurrency = concurrency
+        self.drivers = drivers
+        self.sessions = []
+        self.started = None
+        self._threads = []
+        self._slots = threading.Semaphore(concurrency)
+
+    def launch(self, browsers, urls, after=None):
+        """Start a session for each browser and url, without waiting
+
+        Args:
+            browsers (list): Browser codes, such as ['ff', 'ch']
+            urls (list): The pages to open in each browser
+            after: Called with each driver once its page has loaded
+
+        Returns:
+            The new sessions
+        """
+        self.started = time.time()
+        sessions = [Session(browser, url)
+                    for browser in browsers for url in urls]
+        for session in sessions:
+            thread = threading.Thread(
+                target=self._run, args=(session, after))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self.sessions.extend(sessions)
+        return sessions
+
+    def _run(self, session, after):
+        with self._slots:
+            session.run(self.drivers[session.browser], after)
+
+    def wait(self, timeout=None):
+        """Wait for every session to be ready or fail
+
+        Returns:
+            True if they all finished in time
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None
+                        else max(0, deadline - time.time()))
+        return self.done
+
+    @property
+    def done(self):
+        return all(session.state in ('ready', 'failed')
+                   for session in self.sessions)
+
+    def progress(self):
+        """A one line summary of the sessions' states"""
+        if not self.sessions:
+            return "No browsers launched."
+        counts = {}
+        for session in self.sessions:
+            counts[session.state] = counts.get(session.state, 0) + 1
+        states = ', '.join('{} {}'.format(counts[state], state)
+                           for state in ('ready', 'failed', 'loading',
+                                         'starting', 'waiting')
+                           if state in counts)
+        return "Browsers: {}/{} ready ({}) {:.1f}s".format(
+            counts.get('ready', 0), len(self.sessions), states,
+            time.time() - self.started)
+
+    def report(self):
+        """A table of each session's timings"""
+        lines = ["{:<4} {:<8} {:>8} {:>8}  {}".format(
+            'brwr', 'state', 'start s', 'load s', 'url')]
+        for session in self.sessions:
+            lines.append("{:<4} {:<8} {:>8} {:>8}  {}".format(
+                session.browser, session.state,
+                _seconds(session.startup), _seconds(session.navigation),
+                session.error or session.url))
+        return '\n'.join(lines)
+
+
+def _seconds(value):
+    return '-' if value is None else '{:.2f}'.format(value)
@@ -1,22 +1,53 @@
-from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import StaleElementReferenceException
+
+from readiness import wait_for
+from tabs import TabDriver
 
 
 class BasePageElement(object):
-    """Base page class that is initialized on every page object class."""
-    
+    """Base page class that is initialized on every page object class.
+
+    The element found for a page is kept in the page's elements, by
+    locator, and used again until the page replaces it.  Each lookup is
+    counted in the page's lookups.  A cached element is used without going
+    through the driver, so a page in a tab of a TabbedBrowser switches to
+    its tab first.
+
+    A lookup waits for the page to be ready and the element to be there
+    with one script call, see readiness.py.
+    """
+
+    # Seconds to wait for the element
+    timeout = 100
+
+    def _find(self, obj, refresh=False):
+        """Return the element, looking it up if it isn't cached"""
+        elements = obj.__dict__.setdefault('elements', {})
+        element = None if refresh else elements.get(self.locator)
+        if element is None:
+            element = wait_for(obj.driver, self.locator, self.timeout)
+            elements[self.locator] = element
+            obj.lookups = getattr(obj, 'lookups', 0) + 1
+        return element
+
+    def _use(self, obj, action):
+        """Run action on the element, finding it again if it went stale"""
+        if isinstance(obj.driver, TabDriver):
+            obj.driver.activate()
+        try:
+            return action(self._find(obj))
+        except StaleElementReferenceException:
+            return action(self._find(obj, refresh=True))
 
     def __set__(self, obj, value):
         """Sets the text to the value supplied"""
-        driver = obj.driver
-        WebDriverWait(driver, 100).until(
-            lambda driver: driver.find_element_by_name(self.locator))
-        driver.find_element_by_name(self.locator).clear()
-        driver.find_element_by_name(self.locator).send_keys(value)
+        def fill(element):
+            element.clear()
+            element.send_keys(value)
+        self._use(obj, fill)
 
     def __get__(self, obj, owner):
         """Gets the text of the specified object"""
-        driver = obj.driver
-        WebDriverWait(driver, 100).until(
-            lambda driver: driver.find_element_by_name(self.locator))
-        element = driver.find_element_by_name(self.locator)
-        return element.get_attribute("value")
\ No newline at end of file
+        if obj is None:
+            return self
+        return self._use(obj, lambda element: element.get_attribute("value"))
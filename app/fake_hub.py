@@ -0,0 +1,223 @@
+"""
+Stand-in for a Selenium 3 hub, for trying grid.py without Docker
+
+It answers the parts of the hub API the GridScheduler reads (the console
+page, /grid/api/hub and /grid/api/proxy) and creates and deletes sessions
+on /wd/hub/session without starting any browser.  Each node takes a fixed
+number of sessions of one browser.  A session requested when no node has
+room fails, instead of being queued like on a real hub, and is counted in
+rejected so a test can tell the scheduler overloaded the grid.
+
+Usage: python fake_hub.py [--port PORT] [--node BROWSER:SESSIONS ...]
+
+With no --node, it has a firefox and a chrome node taking one session each,
+like docker-compose.yml.
+"""
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+import itertools
+import json
+import sys
+import threading
+
+DEFAULT_NODES = [('firefox', 1), ('chrome', 1)]
+
+
+class FakeNode(object):
+    """A node taking sessions of one browser"""
+
+    def __init__(self, node_id, browser, max_sessions):
+        self.id = node_id
+        self.browser = browser
+        self.max_sessions = max_sessions
+        self.sessions = set()
+
+    def status(self):
+        capabilities = [{'browserName': self.browser,
+                         'maxInstances': self.max_sessions}]
+        return {
+            'success': True,
+            'msg': 'proxy found !',
+            'id': self.id,
+            'request': {
+                'configuration': {
+                    'maxSession': self.max_sessions,
+                    'capabilities': capabilities,
+                },
+            },
+        }
+
+
+class FakeHubHandler(BaseHTTPRequestHandler):
+    """Answers one hub request"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        hub = self.server
+        if url.path == '/grid/console':
+            body = ''.join(
+                '<p title="id : {}, OS : LINUX">{}</p>'.format(
+                    node.id, node.browser) for node in hub.nodes)
+            self.reply(200, body, 'text/html')
+        elif url.path == '/grid/api/hub':
+            self.reply(200, hub.status())
+        elif url.path == '/grid/api/proxy':
+            node = hub.node(params.get('id', [''])[0])
+            if node is None:
+                self.reply(200, {'success': False, 'msg': 'Cannot find proxy'})
+            else:
+                self.reply(200, node.status())
+        elif url.path in ('/wd/hub/status', '/status'):
+            self.reply(200, {'status': 0, 'value': {'ready': True}})
+        else:
+            self.reply(404, {'status': 9, 'value': {'message': url.path}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+        if urlparse(self.path).path.rstrip('/') != '/wd/hub/session':
+            self.reply(404, {'status': 9, 'value': {'message': self.path}})
+            return
+        capabilities = body.get('desiredCapabilities', {})
+        browser = capabilities.get('browserName')
+        session_id = self.server.start(browser)
+        if session_id is None:
+            self.reply(500, {'status': 33, 'value': {
+                'message': 'No free {} slot'.format(browser)}})
+            return
+        self.reply(200, {'status': 0, 'sessionId': session_id,
+                         'value': {'browserName': browser}})
+
+    def do_DELETE(self):
+        parts = urlparse(self.path).path.strip('/').split('/')
+        if parts[:3] == ['wd', 'hub', 'session'] and len(parts) == 4:
+            self.server.stop(parts[3])
+            self.reply(200, {'status': 0, 'value': None})
+        else:
+            self.reply(404, {'status': 9, 'value': {'message': self.path}})
+
+    def reply(self, status, body, content_type='application/json'):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class FakeHub(ThreadingMixIn, HTTPServer):
+    """A hub with fake nodes, answering on localhost
+
+    Attributes:
+        nodes       -   the FakeNodes
+        started     -   sessions created so far
+        rejected    -   session requests no node had room for
+        peak        -   the most sessions open at once, per browser
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, nodes=DEFAULT_NODES):
+        """
+        Args:
+            port (int): The port, 0 picks a free one
+            nodes (list): (browser, max sessions) for each node
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeHubHandler)
+        self.nodes = [
+            FakeNode('http://10.0.0.{}:5555'.format(i), browser, sessions)
+            for i, (browser, sessions) in enumerate(nodes, 2)]
+        self.started = 0
+        self.rejected = 0
+        self.peak = {}
+        self._ids = itertools.count(1)
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def node(self, node_id):
+        for node in self.nodes:
+            if node.id == node_id:
+                return node
+        return None
+
+    def status(self):
+        with self._lock:
+            total = sum(node.max_sessions for node in self.nodes)
+            used = sum(len(node.sessions) for node in self.nodes)
+        return {'success': True, 'newSessionRequestCount': 0,
+                'slotCounts': {'free': total - used, 'total': total}}
+
+    def start(self, browser):
+        """Open a session on a node with room, and return its id"""
+        with self._lock:
+            for node in self.nodes:
+                if (node.browser == browser and
+                        len(node.sessions) < node.max_sessions):
+                    session_id = 'fake-{}'.format(next(self._ids))
+                    node.sessions.add(session_id)
+                    self._sessions[session_id] = node
+                    self.started += 1
+                    open_now = sum(len(n.sessions) for n in self.nodes
+                                   if n.browser == browser)
+                    self.peak[browser] = max(
+                        self.peak.get(browser, 0), open_now)
+                    return session_id
+            self.rejected += 1
+            return None
+
+    def stop(self, session_id):
+        with self._lock:
+            node = self._sessions.pop(session_id, None)
+            if node is not None:
+                node.sessions.discard(session_id)
+
+    def serve_in_background(self):
+        """Serve from a daemon thread, and return the thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def main(argv):
+    port = 4444
+    nodes = []
+    args = iter(argv)
+    for arg in args:
+        if arg == '--port':
+            port = int(next(args))
+        elif arg == '--node':
+            browser, sessions = next(args).split(':')
+            nodes.append((browser, int(sessions)))
+    hub = FakeHub(port, nodes or DEFAULT_NODES)
+    sys.stderr.write('Fake hub on {}\n'.format(hub.url))
+    try:
+        hub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        hub.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
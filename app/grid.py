@@ -0,0 +1,352 @@
+"""
+Runs test jobs on the Selenium Grid without overloading its nodes
+
+docker-compose.yml starts a hub with a Firefox and a Chrome node.  A
+GridScheduler asks the hub how many sessions each node takes, keeps a queue
+of jobs per browser and starts a job only when a node for its browser has a
+free slot, so every node is kept at its max sessions and no request sits in
+the hub's own queue.  It reports how long jobs waited and how busy each
+browser's slots were.
+
+The hub chooses the node for each session, so capacity is counted per
+browser: the sum over the nodes of the sessions each node takes of that
+browser, and in all at most the sum of the nodes' max sessions.  Other
+clients may be using the grid too, so before starting jobs the scheduler
+asks the hub how many slots are free, and leaves the ones other clients
+hold alone.  The hub only counts slots for the whole grid, so whose browser
+they are taken from isn't known, and they are counted against every
+browser's slots.
+
+Selenium 3 has no API listing the nodes, so their ids are read from the
+hub's console page unless they are given.  fake_hub.py serves the same API
+for trying the scheduler without Docker.
+
+Typical use:
+    scheduler = GridScheduler('http://127.0.0.1:4444')
+    for test in tests:
+        scheduler.submit('chrome', test)
+    scheduler.wait()
+    print(scheduler.report())
+"""
+
+from collections import deque
+
+import json
+import re
+import threading
+import time
+
+try:
+    from urllib import urlencode
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+
+HUB = 'http://127.0.0.1:4444'
+NODE_ID = re.compile(r'id\s*:\s*(https?://[^,\s<"]+)')
+
+
+class GridError(Exception):
+    """Raised when the hub can't be queried or has no node for a browser"""
+
+
+class GridClient(object):
+    """Reads the hub and node status from a Selenium 3 hub"""
+
+    def __init__(self, hub_url=HUB, timeout=10):
+        self.hub_url = hub_url.rstrip('/')
+        self.timeout = timeout
+
+    def _get(self, path, **params):
+        url = self.hub_url + path
+        if params:
+            url += '?' + urlencode(params)
+        try:
+            response = urlopen(url, timeout=self.timeout)
+            try:
+                return response.read().decode('utf-8')
+            finally:
+                response.close()
+        except (IOError, OSError) as e:
+            raise GridError('Could not reach the hub at {}: {}'.format(
+                self.hub_url, e))
+
+    def hub(self):
+        """Return the hub's status, with its free and total slot counts"""
+        return json.loads(self._get('/grid/api/hub'))
+
+    def node_ids(self):
+        """Return the ids of the registered nodes, from the console page"""
+        ids = []
+        for node_id in NODE_ID.findall(self._get('/grid/console')):
+            if node_id not in ids:
+                ids.append(node_id)
+        return ids
+
+    def node(self, node_id):
+        """Return a node's configuration
+
+        Returns:
+            (max sessions, {browser name: max instances})
+        """
+        status = json.loads(self._get('/grid/api/proxy', id=node_id))
+        if not status.get('success'):
+            raise GridError('Unknown node {}'.format(node_id))
+        config = status['request']['configuration']
+        browsers = {}
+        for capability in config.get(
+                'capabilities', status['request'].get('capabilities', [])):
+            name = capability['browserName']
+            browsers[name] = browsers.get(name, 0) + int(
+                capability.get('maxInstances', 1))
+        return int(config.get('maxSession', 1)), browsers
+
+
+def remote_driver(hub_url, browser):
+    """Start a session on the grid"""
+    from selenium import webdriver
+    return webdriver.Remote(
+        command_executor=hub_url + '/wd/hub',
+        desired_capabilities={'browserName': browser})
+
+
+class Job(object):
+    """
+A test to run with a driver
+
+Attributes:
+    browser     -   the browser name it needs
+    func        -   called with the driver
+    result      -   what func returned
+    error       -   the exception if it failed
+    queued      -   when it was submitted
+    started     -   when its session was requested
+    finished    -   when its session was closed
+    """
+
+    def __init__(self, browser, func):
+        self.browser = browser
+        self.func = func
+        self.result = None
+        self.error = None
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+        self._done = threading.Event()
+
+    @property
+    def waited(self):
+        """Seconds spent queued"""
+        return (self.started or time.time()) - self.queued
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish, and return its result"""
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class GridScheduler(object):
+    """Queues jobs per browser and runs them as the grid has room"""
+
+    def __init__(self, hub_url=HUB, node_ids=None, factory=remote_driver,
+                 refresh_interval=30.0, poll_interval=1.0):
+        """
+        Args:
+            hub_url (str): The hub, without /wd/hub
+            node_ids (list): The node ids, read from the hub if not given
+            factory: Called with the hub url and a browser name to start a
+                session on the grid
+            refresh_interval (float): Seconds between reading the node
+                configuration again
+            poll_interval (float): Seconds between asking the hub for free
+                slots while jobs wait
+        """
+        self.client = GridClient(hub_url)
+        self.node_ids = node_ids
+        self.factory = factory
+        self.refresh_interval = refresh_interval
+        self.poll_interval = poll_interval
+        self.capacity = {}
+        self.max_sessions = 0
+        self.others = 0
+        self.jobs = []
+        self._queue = deque()
+        self._running = {}
+        self._open = 0
+        self._open_changes = 0
+        self._busy = {}
+        self._cond = threading.Condition()
+        self._refreshed = 0
+        self._dispatcher = None
+        self._started = None
+
+    def refresh(self):
+        """Read each node's capacity from the hub"""
+        capacity = {}
+        max_sessions = 0
+        for node_id in self.node_ids or self.client.node_ids():
+            sessions, browsers = self.client.node(node_id)
+            max_sessions += sessions
+            for name, instances in browsers.items():
+                capacity[name] = capacity.get(name, 0) + min(
+                    instances, sessions)
+        with self._cond:
+            self.capacity = capacity
+            self.max_sessions = max_sessions
+            self._refreshed = time.time()
+            self._cond.notify_all()
+
+    def poll(self, tries=3):
+        """Read from the hub how many slots other clients are using
+
+        Args:
+            tries (int): Times to read the hub while our own sessions keep
+                opening or closing; others is left as it was if they never
+                stay put for a whole read
+        """
+        for _ in range(tries):
+            with self._cond:
+                changes = self._open_changes
+            counts = self.client.hub().get('slotCounts', {})
+            with self._cond:
+                # Only trust the read if none of our sessions opened or
+                # closed during it, or one could be missed or taken off twice
+                if self._open_changes == changes:
+                    self.others = max(0, counts.get('total', 0) -
+                                      counts.get('free', 0) - self._open)
+                    return
+
+    def submit(self, browser, func):
+        """Queue a job
+
+        Args:
+            browser (str): The browser name, such as 'firefox' or 'chrome'
+            func: Called with a driver for the browser; the session is
+                closed when it returns
+
+        Returns:
+            The Job
+        """
+        if not self._refreshed:
+            self.refresh()
+        if browser not in self.capacity:
+            raise GridError('No node on the grid runs {}'.format(browser))
+        job = Job(browser, func)
+        with self._cond:
+            if self._started is None:
+                self._started = job.queued
+            self.jobs.append(job)
+            self._queue.append(job)
+            self._cond.notify_all()
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(
+                    target=self._dispatch, name='Grid scheduler')
+                self._dispatcher.daemon = True
+                self._dispatcher.start()
+        return job
+
+    def _next(self):
+        """Return the first queued job with a free slot, or None.
+
+        Called with the lock held.
+        """
+        if sum(self._running.values()) + self.others >= self.max_sessions:
+            return None
+        for job in self._queue:
+            if (self._running.get(job.browser, 0) + self.others <
+                    self.capacity.get(job.browser, 0)):
+                self._queue.remove(job)
+                return job
+        return None
+
+    def _dispatch(self):
+        while True:
+            try:
+                if time.time() - self._refreshed > self.refresh_interval:
+                    self.refresh()
+                self.poll()
+            except GridError:
+                pass
+            with self._cond:
+                job = self._next()
+                if job is None:
+                    if not self._queue:
+                        self._dispatcher = None
+                        return
+                    # Other clients free slots without telling us
+                    self._cond.wait(self.poll_interval)
+                    continue
+                self._running[job.browser] = (
+                    self._running.get(job.browser, 0) + 1)
+            job.started = time.time()
+            thread = threading.Thread(target=self._run, args=(job,))
+            thread.daemon = True
+            thread.start()
+
+    def _run(self, job):
+        try:
+            driver = self.factory(self.client.hub_url, job.browser)
+            # Counted as ours only while the hub surely has it open, so
+            # poll() never takes our sessions for free slots
+            self._opened(1)
+            try:
+                job.result = job.func(driver)
+            finally:
+                self._opened(-1)
+                driver.quit()
+        except Exception as e:
+            job.error = e
+        job.finished = time.time()
+        with self._cond:
+            self._running[job.browser] -= 1
+            self._busy[job.browser] = (self._busy.get(job.browser, 0) +
+                                       job.finished - job.started)
+            self._cond.notify_all()
+        job._done.set()
+
+    def _opened(self, count):
+        with self._cond:
+            self._open += count
+            self._open_changes += 1
+
+    def wait(self, timeout=None):
+        """Wait for every submitted job to finish
+
+        Returns:
+            True if they all finished in time
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for job in list(self.jobs):
+            job._done.wait(None if deadline is None
+                           else max(0, deadline - time.time()))
+        return all(job.finished is not None for job in self.jobs)
+
+    def report(self):
+        """A table of queue waits and slot utilization per browser"""
+        with self._cond:
+            jobs = list(self.jobs)
+            busy = dict(self._busy)
+            capacity = dict(self.capacity)
+        if not jobs:
+            return "No jobs run."
+        elapsed = max(job.finished or time.time() for job in jobs) - \
+            self._started
+        lines = ["{:<10} {:>5} {:>5} {:>6} {:>10} {:>10} {:>6}".format(
+            'browser', 'slots', 'jobs', 'failed', 'mean wait', 'max wait',
+            'util')]
+        for browser in sorted(set(job.browser for job in jobs)):
+            mine = [job for job in jobs if job.browser == browser]
+            waits = [job.waited for job in mine]
+            slots = capacity.get(browser, 0)
+            utilization = busy.get(browser, 0) / (slots * elapsed) \
+                if slots and elapsed else 0
+            lines.append(
+                "{:<10} {:>5} {:>5} {:>6} {:>9.2f}s {:>9.2f}s {:>5.0f}%".format(
+                    browser, slots, len(mine),
+                    sum(1 for job in mine if job.error is not None),
+                    sum(waits) / len(waits), max(waits), 100 * utilization))
+        lines.append("{} jobs in {:.2f}s".format(len(jobs), elapsed))
+        return '\n'.join(lines)
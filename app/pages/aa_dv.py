@@ -1,6 +1,7 @@
 """Auto Application - Drivers & Vehicles"""
 
 from base import BasePage
+from readiness import wait_for
 from locators.qq_prempay_locs import QQPremPayLocators as qqp
 from selenium import webdriver
 from selenium.webdriver.support import ui
@@ -10,7 +11,5 @@ from selenium.webdriver.common.keys import Keys
 class AADriversVehiclesPage(BasePage):
 
     def click_application_button(self):
-        element = self.driver.find_element(
-            *qqp.APPLICATION_BUTTON
-        )
+        element = wait_for(self.driver, qqp.APPLICATION_BUTTON)
         element.click()
@@ -1,4 +1,5 @@
 from base import BasePage
+from readiness import wait_for
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import ui
@@ -13,24 +14,19 @@ class AddressModal(BasePage):
 
     #BUTTON CLICKS
     def click_different_street_address_option_yes(self):        
-        element = self.driver.find_element(
-            *aml.DIFF_ADDRESS_RADIO_YES)
+        element = wait_for(self.driver, aml.DIFF_ADDRESS_RADIO_YES)
         element.click()
 
     def click_different_street_address_option_no(self):
-        element = self.driver.find_element(
-            *aml.DIFF_ADDRESS_RADIO_NO
-        )
+        element = wait_for(self.driver, aml.DIFF_ADDRESS_RADIO_NO)
         element.click()
 
     def click_address_save_button(self):        
-        element = self.driver.find_element(
-            *aml.SAVE_BUTTON)
+        element = wait_for(self.driver, aml.SAVE_BUTTON)
         element.click()
 
     def click_address_cancel_button(self):        
-        element = self.driver.find_element(
-            *aml.CANCEL_BUTTON)
+        element = wait_for(self.driver, aml.CANCEL_BUTTON)
         element.click()
 
 
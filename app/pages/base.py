@@ -9,5 +9,9 @@ class BasePage(object):
     def __init__(self, driver, url):
         self.driver = driver
         self.url = url
+        # Elements found by BasePageElement, by locator, and how many
+        # lookups that took
+        self.elements = {}
+        self.lookups = 0
 
     
\ No newline at end of file
@@ -1,4 +1,5 @@
 from base import BasePage
+from readiness import wait_for
 from locators.qq_entry_locs import QQEntryLocators as qqe
 from selenium import webdriver
 from selenium.webdriver.support import ui
@@ -19,15 +20,15 @@ class QQEntryPage(BasePage):
     def enter_address(self):
 
     def click_rate_button(self):        
-        element = self.driver.find_element(*qqe.RATE_BUTTON)
+        element = wait_for(self.driver, qqe.RATE_BUTTON)
         element.click()
     
     def click_save_button(self):
-        element = self.driver.find_element(*qqe.SAVE_BUTTON)
+        element = wait_for(self.driver, qqe.SAVE_BUTTON)
         element.click()
 
     def click_address_cancel_button(self):        
-        element = self.driver.find_element(*qqe.CANCEL_BUTTON)
+        element = wait_for(self.driver, qqe.CANCEL_BUTTON)
         element.click()
 
     def enter_year
\ No newline at end of file
@@ -1,4 +1,5 @@
 from base import BasePage
+from readiness import wait_for
 from locators.qrw_autorater_locs import QRWAutoRaterLocators as qrw
 from selenium import webdriver
 from selenium.webdriver.support import ui
@@ -11,13 +12,13 @@ class QRWAutoRaterPage(BasePage):
     """
 
     def click_rate_button(self):        
-        element = self.driver.find_element(*qrw.RATE_BUTTON)
+        element = wait_for(self.driver, qrw.RATE_BUTTON)
         element.click()
     
     def click_exit_button(self):
-        element = self.driver.find_element( *qrw.EXIT_BUTTON)
+        element = wait_for(self.driver, qrw.EXIT_BUTTON)
         element.click()
 
     def click_address_button(self):        
-        element = self.driver.find_element(*qrw.ADDRESS_BUTTON)
+        element = wait_for(self.driver, qrw.ADDRESS_BUTTON)
         element.click()
\ No newline at end of file
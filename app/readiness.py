@@ -0,0 +1,187 @@
+"""
+Waits for a page to be ready, without polling
+
+Polling find_element costs a WebDriver round trip per try, and an implicit
+wait makes every lookup of a missing element take the full timeout.  The
+wait here is one execute_async_script call: a small script is added to the
+page once, tracking XHR and fetch requests in flight and the last change to
+the DOM, and the call returns as soon as:
+
+- the document has loaded,
+- no request is in flight,
+- the DOM hasn't changed for `quiet` seconds, so YUI panels such as the
+  rewrite rating panel have finished drawing, or `max_quiet` seconds have
+  passed, so a page that never stops changing still gets used,
+- and, if a locator is given, the element it finds exists.
+
+The page is checked again whenever a request ends or the DOM changes, not
+on a fixed interval.  Requests started before the first wait on a page
+aren't seen, but the DOM changes they cause are.  If the page navigates
+during the wait, the script is unloaded with it and the wait starts over on
+the new page.
+
+A locator is a (By, value) tuple, as page locators are, or an element
+name.  Pages find their elements through here rather than find_element, so
+drivers need no implicit wait, which would make every lookup of a missing
+element take the full timeout.
+
+Typical use:
+    element = wait_for(driver, 'vin')
+    element = wait_for(driver, (By.ID, 'rate'))
+    wait_for(driver)
+"""
+
+from selenium.common.exceptions import JavascriptException, TimeoutException
+from selenium.webdriver.common.by import By
+
+import time
+import weakref
+
+TRACKER = """
+(function (w) {
+    if (w.__pmReadiness) { return; }
+    var r = w.__pmReadiness = {pending: 0, changed: Date.now(), waiters: []};
+    r.touch = function () {
+        r.changed = Date.now();
+        var waiters = r.waiters.slice();
+        for (var i = 0; i < waiters.length; i++) { waiters[i](); }
+    };
+    var send = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function () {
+        var finished = false;
+        var end = function () {
+            if (!finished) { finished = true; r.pending--; r.touch(); }
+        };
+        r.pending++;
+        this.addEventListener('loadend', end);
+        try { return send.apply(this, arguments); }
+        catch (e) { end(); throw e; }
+    };
+    if (w.fetch) {
+        var fetch = w.fetch;
+        w.fetch = function () {
+            var end = function () { r.pending--; r.touch(); };
+            r.pending++;
+            return fetch.apply(this, arguments).then(
+                function (response) { end(); return response; },
+                function (error) { end(); throw error; });
+        };
+    }
+    new MutationObserver(r.touch).observe(w.document.documentElement, {
+        childList: true, subtree: true, attributes: true, characterData: true
+    });
+    w.addEventListener('load', r.touch);
+})(window);
+"""
+
+WAIT_FOR_READY = TRACKER + """
+var by = arguments[0], value = arguments[1], quiet = arguments[2],
+    timeout = arguments[3], maxQuiet = arguments[4],
+    done = arguments[arguments.length - 1];
+var r = window.__pmReadiness, started = Date.now();
+var deadline = started + timeout;
+var timer = null, finished = false;
+function finish(result) {
+    if (finished) { return; }
+    finished = true;
+    clearTimeout(timer);
+    var i = r.waiters.indexOf(check);
+    if (i >= 0) { r.waiters.splice(i, 1); }
+    done(result);
+}
+function find() {
+    switch (by) {
+    case 'id': return document.getElementById(value);
+    case 'name': return document.getElementsByName(value)[0];
+    case 'css selector': return document.querySelector(value);
+    case 'class name': return document.getElementsByClassName(value)[0];
+    case 'tag name': return document.getElementsByTagName(value)[0];
+    case 'xpath':
+        return document.evaluate(value, document, null,
+            XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    }
+    var links = document.getElementsByTagName('a');
+    for (var i = 0; i < links.length; i++) {
+        var text = links[i].textContent.trim();
+        if (by === 'link text' ? text === value : text.indexOf(value) >= 0) {
+            return links[i];
+        }
+    }
+    return null;
+}
+function check() {
+    var now = Date.now();
+    var element = by ? find() : null;
+    var idle = r.pending === 0 && document.readyState === 'complete';
+    var settled = now - r.changed >= quiet || now - started >= maxQuiet;
+    if ((element || !by) && idle && settled) {
+        finish(by ? element : true);
+        return;
+    }
+    if (now >= deadline) {
+        finish(null);
+        return;
+    }
+    // Wake up when the quiet period would be over, or at the deadline
+    var wait = deadline - now;
+    if (idle && !settled) {
+        wait = Math.min(wait, quiet - (now - r.changed) + 1,
+                        maxQuiet - (now - started) + 1);
+    }
+    clearTimeout(timer);
+    timer = setTimeout(check, Math.max(wait, 1));
+}
+r.waiters.push(check);
+check();
+"""
+
+# Page loads a wait follows before giving up
+NAVIGATIONS = 5
+
+# Script timeouts set so far, by driver; a driver's goes away with it
+_script_timeouts = weakref.WeakKeyDictionary()
+
+
+def wait_for(driver, locator=None, timeout=30, quiet=0.1, max_quiet=2):
+    """Wait for the page to be idle, and for an element if one is given
+
+    Args:
+        driver: The WebDriver
+        locator: The (By, value) of the element to wait for, or its name
+        timeout (float): Seconds to wait
+        quiet (float): Seconds without DOM changes for the page to be idle,
+            None or 0 not to wait for the DOM
+        max_quiet (float): Seconds after which the page is idle even if
+            its DOM keeps changing
+
+    Returns:
+        The element, or True if no locator was given
+    """
+    if locator is None:
+        by, value = None, None
+    elif isinstance(locator, basestring):
+        by, value = By.NAME, locator
+    else:
+        by, value = locator
+    # The script has its own deadline, so only give the driver a longer
+    # one when it could cut the wait short
+    script_timeout = timeout + 5
+    if _script_timeouts.get(driver, 0) < script_timeout:
+        driver.set_script_timeout(script_timeout)
+        _script_timeouts[driver] = script_timeout
+    deadline = time.time() + timeout
+    for navigations in range(NAVIGATIONS + 1):
+        try:
+            result = driver.execute_async_script(
+                WAIT_FOR_READY, by, value, int((quiet or 0) * 1000),
+                int(max(0, deadline - time.time()) * 1000),
+                int(max_quiet * 1000))
+            break
+        except JavascriptException:
+            # Leaving the page unloads the script, so wait on the next one
+            if navigations == NAVIGATIONS or time.time() >= deadline:
+                raise
+    if result is None:
+        raise TimeoutException('Page not ready{} after {}s'.format(
+            ' with element {}'.format(value) if by else '', timeout))
+    return result
@@ -0,0 +1,274 @@
+"""
+A pool of warm WebDriver sessions shared by tests
+
+Starting a browser is most of the time a short test takes, so tests check a
+driver out of the pool instead of starting their own, and check it back in
+when they are done.  On checkout a reused driver is reset: extra windows are
+closed, every site's cookies and the page's web storage are cleared and it
+is left on a blank page.  On check in the driver is health checked, and
+drivers that fail it, that were checked in as failed or that have been used
+max_uses times are quit and replaced by a fresh one on a later checkout.
+
+WebDriver can only delete the current site's cookies, so the others are
+cleared through the DevTools protocol in Chrome and from the browser's
+chrome context in Firefox.  Drivers that can do neither are quit instead of
+being handed out again.
+
+Browsers keep HTTP basic auth credentials for the life of the session and
+clearing cookies doesn't forget them, so drivers are pooled per browser and
+credentials: a driver is only handed out again for the same auth.
+
+Typical use:
+    with pool.session('rch', auth=('5121', 'test')) as driver:
+        driver.get(url)
+
+or, in tests:
+    class TestQuote(PooledTestCase):
+        browser = 'rch'
+"""
+
+from contextlib import contextmanager
+
+import atexit
+import threading
+import unittest
+
+from drivers import DRIVERS
+from tabs import execute_cdp
+
+CLEAR_STORAGE = """
+try { window.localStorage.clear(); } catch (e) {}
+try { window.sessionStorage.clear(); } catch (e) {}
+"""
+
+# Run in Firefox's chrome context, where the cookies of every site are
+# reachable
+CLEAR_FIREFOX_COOKIES = """
+var services = typeof Services !== 'undefined' ? Services :
+    ChromeUtils.import('resource://gre/modules/Services.jsm').Services;
+services.cookies.removeAll();
+"""
+
+
+class SessionResetError(Exception):
+    """Raised when a used driver can't be put back to a clean state"""
+
+
+class PooledDriver(object):
+    """
+A driver in the pool
+
+Attributes:
+    driver      -   the WebDriver
+    key         -   (browser code, auth) it is pooled under
+    uses        -   the times it has been checked out
+    """
+
+    def __init__(self, driver, key):
+        self.driver = driver
+        self.key = key
+        self.uses = 0
+
+
+class SessionPool(object):
+    """Keeps started drivers per browser and auth, to hand out again"""
+
+    def __init__(self, drivers=DRIVERS, max_uses=25, max_idle=2):
+        """
+        Args:
+            drivers (dict): Browser factories by browser code
+            max_uses (int): Checkouts before a driver is quit and replaced
+            max_idle (int): The most idle drivers kept per browser and auth
+        """
+        self.drivers = drivers
+        self.max_uses = max_uses
+        self.max_idle = max_idle
+        self.started = 0
+        self.reused = 0
+        self.recycled = 0
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._out = {}
+
+    def acquire(self, browser, auth=None):
+        """Check out a driver, starting one if none is idle
+
+        Args:
+            browser (str): A browser code, a key of drivers
+            auth (tuple): The (user, password) the test will log in with
+
+        Returns:
+            A WebDriver on a blank page
+        """
+        key = (browser, auth)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                pooled = idle.pop() if idle else None
+            if pooled is None:
+                pooled = PooledDriver(self.drivers[browser](), key)
+                with self._lock:
+                    self.started += 1
+                break
+            try:
+                self.reset(pooled.driver)
+            except Exception:
+                self._quit(pooled)
+                continue
+            with self._lock:
+                self.reused += 1
+            break
+
+        pooled.uses += 1
+        with self._lock:
+            self._out[id(pooled.driver)] = pooled
+        return pooled.driver
+
+    def release(self, driver, failed=False):
+        """Check a driver back in
+
+        Args:
+            driver: A driver from acquire()
+            failed (bool): Quit the driver instead of keeping it
+        """
+        with self._lock:
+            pooled = self._out.pop(id(driver))
+        if (failed or pooled.uses >= self.max_uses or
+                not self.healthy(driver)):
+            self._quit(pooled)
+            return
+        with self._lock:
+            idle = self._idle.setdefault(pooled.key, [])
+            if len(idle) < self.max_idle:
+                idle.append(pooled)
+                return
+        self._quit(pooled)
+
+    @contextmanager
+    def session(self, browser, auth=None):
+        """Check out a driver for the length of a with block
+
+        The driver is quit instead of kept if the block raises an error
+        other than a test failure.
+        """
+        driver = self.acquire(browser, auth)
+        failed = False
+        try:
+            yield driver
+        except AssertionError:
+            raise
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.release(driver, failed)
+
+    @staticmethod
+    def reset(driver):
+        """Put a used driver back to a clean state"""
+        handles = driver.window_handles
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+        # Storage belongs to the page's site, so clear it before leaving
+        driver.execute_script(CLEAR_STORAGE)
+        driver.delete_all_cookies()
+        if not SessionPool.clear_cookies(driver):
+            raise SessionResetError(
+                "Can't clear every site's cookies in {}".format(
+                    driver.capabilities.get('browserName')))
+        driver.get('about:blank')
+
+    @staticmethod
+    def clear_cookies(driver):
+        """Delete the cookies of every site, not only the current page's
+
+        Returns:
+            True if the browser could do it
+        """
+        browser = driver.capabilities.get('browserName')
+        try:
+            if browser == 'chrome':
+                execute_cdp(driver, 'Network.clearBrowserCookies', {})
+                return True
+            if browser == 'firefox' and hasattr(driver, 'context'):
+                with driver.context(driver.CONTEXT_CHROME):
+                    driver.execute_script(CLEAR_FIREFOX_COOKIES)
+                return True
+        except Exception:
+            pass
+        return False
+
+    @staticmethod
+    def healthy(driver):
+        """Return True if the driver still answers commands"""
+        try:
+            return driver.execute_script('return 1;') == 1
+        except Exception:
+            return False
+
+    def _quit(self, pooled):
+        with self._lock:
+            self.recycled += 1
+        try:
+            pooled.driver.quit()
+        except Exception:
+            pass
+
+    def close(self):
+        """Quit every idle driver"""
+        with self._lock:
+            idle = [pooled for drivers in self._idle.values()
+                    for pooled in drivers]
+            self._idle.clear()
+        for pooled in idle:
+            try:
+                pooled.driver.quit()
+            except Exception:
+                pass
+
+
+# The pool shared by every test in the process
+pool = SessionPool()
+atexit.register(pool.close)
+
+
+class PooledTestCase(unittest.TestCase):
+    """
+A test case with a driver from the pool in self.driver
+
+The driver is checked out before setUp() and checked back in after
+tearDown(), as failed if the test failed or raised an error, so a driver a
+test may have left in a bad state is quit rather than handed out again.
+Pages wait for their elements with readiness.wait_for, so the driver has no
+implicit wait unless implicit_wait is set; one would make every lookup of a
+missing element take the full wait.
+
+Attributes:
+    browser         -   the browser code to check out
+    auth            -   the (user, password) the test logs in with
+    implicit_wait   -   seconds find_element waits for an element
+    driver          -   the WebDriver, while a test runs
+    """
+
+    browser = 'rch'
+    auth = None
+    implicit_wait = 0
+    driver = None
+
+    def run(self, result=None):
+        if result is None:
+            result = self.defaultTestResult()
+        problems = len(result.failures) + len(result.errors)
+        self.driver = pool.acquire(self.browser, self.auth)
+        # Also quit if the test run itself didn't finish
+        failed = True
+        try:
+            self.driver.implicitly_wait(self.implicit_wait)
+            outcome = unittest.TestCase.run(self, result)
+            failed = len(result.failures) + len(result.errors) > problems
+            return outcome
+        finally:
+            pool.release(self.driver, failed)
+            self.driver = None
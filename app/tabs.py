@@ -0,0 +1,204 @@
+"""
+Several agents' pages as tabs of one browser
+
+Instead of a browser per agent url, a TabbedBrowser opens each url in its
+own tab of one browser.  Each Tab hands out a driver that switches to the
+tab before every command, so page objects built on it can be used side by
+side without switching tabs by hand.
+
+Browsers keep one set of basic auth credentials per site, so agents in
+different tabs would end up sharing the last one used.  To keep them apart:
+
+- Chrome sends each tab's own Authorization header, set through the
+  DevTools protocol on that tab, and its urls are loaded without the
+  credentials in them.
+- Other browsers log in again as the tab's agent, with a background request
+  carrying its credentials, every time a different tab is switched to.
+
+Typical use:
+    browser = TabbedBrowser(driver)
+    for url in urls:
+        browser.open(url)
+    page = browser['5121'].page(QQEntryPage)
+"""
+
+from collections import OrderedDict
+
+import base64
+
+try:
+    from urlparse import urlsplit, urlunsplit
+except ImportError:
+    from urllib.parse import urlsplit, urlunsplit
+
+# Makes the browser remember arguments[1] and [2] as the credentials for
+# the site of arguments[0]
+REAUTHENTICATE = """
+try {
+    var xhr = new XMLHttpRequest();
+    xhr.open('HEAD', arguments[0], false, arguments[1], arguments[2]);
+    xhr.send();
+    return xhr.status;
+} catch (e) {
+    return 0;
+}
+"""
+
+
+def split_auth(url):
+    """Take the credentials out of a url
+
+    Returns:
+        (url without them, (user, password) or None)
+    """
+    parts = urlsplit(url)
+    if parts.username is None:
+        return url, None
+    host = parts.hostname
+    if parts.port:
+        host = '{}:{}'.format(host, parts.port)
+    bare = urlunsplit((parts.scheme, host, parts.path, parts.query,
+                       parts.fragment))
+    return bare, (parts.username, parts.password or '')
+
+
+def basic_auth(auth):
+    """Return the Authorization header value for (user, password)"""
+    token = base64.b64encode('{}:{}'.format(*auth).encode('utf-8'))
+    return 'Basic ' + token.decode('ascii')
+
+
+def execute_cdp(driver, cmd, params):
+    """Run a DevTools protocol command on the current tab of a Chrome driver"""
+    if hasattr(driver, 'execute_cdp_cmd'):
+        return driver.execute_cdp_cmd(cmd, params)
+    # Selenium 3 doesn't know ChromeDriver's endpoint for it
+    driver.command_executor._commands['executeCdpCommand'] = (
+        'POST', '/session/$sessionId/goog/cdp/execute')
+    return driver.execute(
+        'executeCdpCommand', {'cmd': cmd, 'params': params})['value']
+
+
+class TabDriver(object):
+    """A driver that switches to its tab before every command"""
+
+    def __init__(self, tab):
+        self._tab = tab
+
+    def activate(self):
+        """Switch the browser to the tab"""
+        self._tab.activate()
+
+    def __getattr__(self, name):
+        self._tab.activate()
+        return getattr(self._tab.browser.driver, name)
+
+
+class Tab(object):
+    """
+One tab of a TabbedBrowser
+
+Attributes:
+    browser     -   the TabbedBrowser
+    name        -   what the tab is looked up by, the agent by default
+    handle      -   the window handle
+    url         -   the url first opened, without credentials
+    auth        -   (user, password) for the tab, or None
+    driver      -   a TabDriver for the tab
+    """
+
+    def __init__(self, browser, name, handle, url, auth):
+        self.browser = browser
+        self.name = name
+        self.handle = handle
+        self.url = url
+        self.auth = auth
+        self.driver = TabDriver(self)
+
+    def activate(self):
+        """Switch the browser to this tab"""
+        self.browser.activate(self)
+
+    def page(self, page_class, url=None):
+        """Return a page object working in this tab"""
+        return page_class(self.driver, url or self.url)
+
+
+class TabbedBrowser(object):
+    """One browser with a tab per agent"""
+
+    def __init__(self, driver):
+        """
+        Args:
+            driver: The browser's WebDriver; its current window becomes the
+                first tab
+        """
+        self.driver = driver
+        self.tabs = OrderedDict()
+        self.current = None
+        self.header_auth = (
+            driver.capabilities.get('browserName') == 'chrome')
+
+    def __getitem__(self, name):
+        return self.tabs[name]
+
+    def __iter__(self):
+        return iter(self.tabs.values())
+
+    def __len__(self):
+        return len(self.tabs)
+
+    def open(self, url, name=None):
+        """Open a url in a new tab
+
+        Args:
+            url (str): The page, with the agent's credentials in it if it
+                needs them
+            name (str): The tab's name, the agent by default
+
+        Returns:
+            The Tab
+        """
+        driver = self.driver
+        bare, auth = split_auth(url)
+        if name is None:
+            name = auth[0] if auth else str(len(self.tabs) + 1)
+        if self.tabs:
+            before = set(driver.window_handles)
+            driver.execute_script("window.open('about:blank');")
+            handle = (set(driver.window_handles) - before).pop()
+        else:
+            handle = driver.current_window_handle
+        driver.switch_to.window(handle)
+        tab = Tab(self, name, handle, bare, auth)
+        self.tabs[name] = tab
+        self.current = tab
+
+        if auth and self.header_auth:
+            try:
+                execute_cdp(driver, 'Network.enable', {})
+                execute_cdp(driver, 'Network.setExtraHTTPHeaders',
+                            {'headers': {'Authorization': basic_auth(auth)}})
+            except Exception:
+                # ChromeDriver too old for the DevTools endpoint
+                self.header_auth = False
+            else:
+                driver.get(bare)
+                return tab
+        driver.get(url)
+        return tab
+
+    def activate(self, tab):
+        """Switch to a tab, logging in as its agent if need be"""
+        if self.current is tab:
+            return
+        self.driver.switch_to.window(tab.handle)
+        self.current = tab
+        if tab.auth and not self.header_auth:
+            self.driver.execute_script(REAUTHENTICATE, tab.url, *tab.auth)
+
+    def quit(self):
+        """Close the browser and every tab"""
+        self.tabs.clear()
+        self.current = None
+        self.driver.quit()
@@ -0,0 +1,114 @@
+"""Tests for starting browser sessions in parallel, with fake browsers"""
+import os
+import sys
+import threading
+import time
+import unittest
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP)
+
+from drivers import Launcher
+
+
+class FakeBrowser(object):
+    """A driver whose page loads take a while"""
+
+    def __init__(self, load_time):
+        self.load_time = load_time
+        self.url = None
+
+    def get(self, url):
+        time.sleep(self.load_time)
+        self.url = url
+
+
+class FakeDrivers(object):
+    """Browser factories that count how many browsers start at once"""
+
+    def __init__(self, start_time=0.05, load_time=0.02):
+        self.start_time = start_time
+        self.load_time = load_time
+        self.lock = threading.Lock()
+        self.starting = 0
+        self.peak = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def start(self):
+        with self.lock:
+            self.starting += 1
+            self.peak = max(self.peak, self.starting)
+        try:
+            self.release.wait(10)
+            time.sleep(self.start_time)
+        finally:
+            with self.lock:
+                self.starting -= 1
+        return FakeBrowser(self.load_time)
+
+    def broken(self):
+        raise RuntimeError('geckodriver not found')
+
+    def drivers(self):
+        return {'ff': self.start, 'ch': self.start, 'xx': self.broken}
+
+
+class TestLauncher(unittest.TestCase):
+    """Starting sessions with a limit on browsers starting at once"""
+
+    def setUp(self):
+        self.fake = FakeDrivers()
+        self.launcher = Launcher(concurrency=2, drivers=self.fake.drivers())
+
+    def test_concurrency(self):
+        """No more than concurrency browsers should start at once"""
+        sessions = self.launcher.launch(['ff', 'ch'], ['u1', 'u2', 'u3'])
+        self.assertEqual(len(sessions), 6)
+        self.assertTrue(self.launcher.wait(10))
+        self.assertEqual(self.fake.peak, 2)
+        self.assertEqual([session.driver.url for session in sessions],
+                         ['u1', 'u2', 'u3'] * 2)
+
+    def test_timings(self):
+        """Each session should record its startup and page load times"""
+        calls = []
+        session, = self.launcher.launch(['ff'], ['u1'], calls.append)
+        self.assertTrue(self.launcher.wait(10))
+        self.assertEqual(session.state, 'ready')
+        self.assertEqual(calls, [session.driver])
+        self.assertGreaterEqual(session.startup, 0.05)
+        self.assertGreaterEqual(session.navigation, 0.02)
+        self.assertIn('0.0', self.launcher.report().splitlines()[1])
+
+    def test_failure(self):
+        """A browser that fails to start shouldn't stop the others"""
+        self.launcher.launch(['xx', 'ff'], ['u1'])
+        self.assertTrue(self.launcher.wait(10))
+        broken, working = self.launcher.sessions
+        self.assertEqual((broken.state, working.state), ('failed', 'ready'))
+        self.assertIsInstance(broken.error, RuntimeError)
+        lines = self.launcher.report().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn('geckodriver not found', lines[1])
+        self.assertIn('u1', lines[2])
+
+    def test_progress(self):
+        """Progress should count sessions by state while they start"""
+        self.assertEqual(self.launcher.progress(), "No browsers launched.")
+        self.fake.release.clear()
+        self.launcher.launch(['ff', 'ch'], ['u1', 'u2'])
+        # launch() returns before any browser has started
+        self.assertFalse(self.launcher.done)
+        deadline = time.time() + 10
+        while self.fake.starting < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIn('0/4 ready (2 starting, 2 waiting)',
+                      self.launcher.progress())
+        self.fake.release.set()
+        self.assertTrue(self.launcher.wait(10))
+        self.assertIn('4/4 ready (4 ready)', self.launcher.progress())
+
+
+if __name__ == '__main__':
+    unittest.main()
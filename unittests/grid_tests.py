@@ -0,0 +1,138 @@
+"""Tests for the Selenium Grid scheduler, against the fake hub"""
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+
+try:
+    from urllib2 import Request, urlopen
+except ImportError:
+    from urllib.request import Request, urlopen
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP)
+
+from fake_hub import FakeHub
+from grid import GridError, GridScheduler
+
+
+class HubSession(object):
+    """A session opened on the hub without a browser, like a WebDriver"""
+
+    def __init__(self, hub_url, browser):
+        body = json.dumps({'desiredCapabilities': {'browserName': browser}})
+        request = Request(hub_url + '/wd/hub/session', body.encode('utf-8'),
+                          {'Content-Type': 'application/json'})
+        response = urlopen(request, timeout=10)
+        try:
+            self.session_id = json.loads(
+                response.read().decode('utf-8'))['sessionId']
+        finally:
+            response.close()
+        self.hub_url = hub_url
+
+    def quit(self):
+        request = Request(
+            self.hub_url + '/wd/hub/session/' + self.session_id)
+        request.get_method = lambda: 'DELETE'
+        urlopen(request, timeout=10).close()
+
+
+class GridTestCase(unittest.TestCase):
+    """Runs a fake hub for each test"""
+
+    nodes = [('chrome', 2), ('firefox', 1)]
+
+    def setUp(self):
+        self.hub = FakeHub(0, self.nodes)
+        self.thread = self.hub.serve_in_background()
+        self.scheduler = GridScheduler(
+            self.hub.url, factory=HubSession, poll_interval=0.02)
+
+    def tearDown(self):
+        self.hub.shutdown()
+        self.hub.server_close()
+        self.thread.join()
+
+
+class TestScheduler(GridTestCase):
+    """Running jobs on the grid without overloading it"""
+
+    def test_capacity(self):
+        """Jobs should fill every slot without a session being refused"""
+        jobs = [self.scheduler.submit(
+            browser, lambda driver: time.sleep(0.05) or driver.session_id)
+            for browser in ['chrome'] * 6 + ['firefox'] * 3]
+        self.assertEqual(self.scheduler.capacity,
+                         {'chrome': 2, 'firefox': 1})
+        self.assertTrue(self.scheduler.wait(10))
+        self.assertEqual([job.error for job in jobs], [None] * 9)
+        self.assertEqual(len(set(job.result for job in jobs)), 9)
+        self.assertEqual(self.hub.rejected, 0)
+        self.assertEqual(self.hub.peak, {'chrome': 2, 'firefox': 1})
+        report = self.scheduler.report()
+        self.assertIn('9 jobs', report)
+        self.assertEqual(len(report.splitlines()), 4)
+
+    def test_other_clients(self):
+        """Slots other clients hold should be left to them"""
+        other = HubSession(self.hub.url, 'chrome')
+        self.scheduler.refresh()
+        release = threading.Timer(0.3, other.quit)
+        release.start()
+        started = time.time()
+        jobs = [self.scheduler.submit(
+            'chrome', lambda driver: time.sleep(0.1)) for _ in range(2)]
+        self.assertTrue(self.scheduler.wait(10))
+        release.join()
+        self.assertEqual(self.hub.rejected, 0)
+        # Only one slot was free until the other client let go of its own
+        self.assertGreaterEqual(max(job.started for job in jobs) - started,
+                                0.1)
+        self.assertEqual([job.error for job in jobs], [None, None])
+
+    def test_errors(self):
+        """Jobs for a browser no node runs, or that fail, should be reported
+        """
+        self.assertRaises(GridError, self.scheduler.submit, 'safari',
+                          lambda driver: None)
+        job = self.scheduler.submit('firefox', lambda driver: 1 / 0)
+        self.assertRaises(ZeroDivisionError, job.wait, 10)
+        self.assertEqual(self.hub.started, 1)
+        self.assertEqual(self.hub.status()['slotCounts']['free'], 3)
+
+    def test_poll_race(self):
+        """Sessions opening during a hub read shouldn't wait for it, and
+        the read should be retried"""
+        reads = []
+
+        def hub():
+            if not reads:
+                # One of our sessions opens while the hub is being read
+                opener = threading.Thread(target=self.scheduler._opened,
+                                          args=(1,))
+                opener.start()
+                opener.join(1)
+                self.assertFalse(opener.is_alive())
+            reads.append(self.scheduler._open)
+            return {'slotCounts': {'total': 3, 'free': 1}}
+
+        self.scheduler.client.hub = hub
+        self.scheduler.poll()
+        self.assertEqual(reads, [1, 1])
+        self.assertEqual(self.scheduler.others, 1)
+
+        # Left as it was when our sessions never stay put
+        def busy_hub():
+            self.scheduler._opened(1)
+            return {'slotCounts': {'total': 3, 'free': 0}}
+
+        self.scheduler.client.hub = busy_hub
+        self.scheduler.poll()
+        self.assertEqual(self.scheduler.others, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
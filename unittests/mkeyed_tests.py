@@ -0,0 +1,604 @@
+"""Tests for the MKEYED reader and its helpers, on synthetic data files"""
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import unittest
+
+UTILS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils')
+sys.path.insert(0, UTILS)
+
+from mkeyed import (
+    MKEYEDReader, BBPyKeyNotFoundError, BBPyPartialKeyFoundException,
+    BBPyBloomFilterError, BBPyScanTokenError, BBPyWriterIOError,
+    BBPyWriterRecordError, BBPyWriterTypeError, MKEYEDWriter,
+    decodeWriteRequest, encodeWriteRequest)
+from mkeyed_analyze import analyze
+from mkeyed_export import export, is_current
+from mkeyed_gen import MKEYEDGenerator, default_key
+from mkeyed_incremental import IncrementalScan
+from mkeyed_join import KeyedStream, RecordStream, join
+from mkeyed_mirror import MKEYEDMirror
+from mkeyed_registry import ReaderRegistry
+from mkeyed_shm import SharedIndex
+
+
+class MKEYEDTestCase(unittest.TestCase):
+    """Writes synthetic data files into a scratch directory"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='mkeyed-tests-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def generate(self, name, records, **kwargs):
+        path = os.path.join(self.tmpdir, name)
+        generator = MKEYEDGenerator(records, **kwargs)
+        generator.write(path)
+        return path, generator
+
+
+class TestReader(MKEYEDTestCase):
+    """Reading generated files in both layouts"""
+
+    def test_layouts(self):
+        """Every key and record should read back in both layouts"""
+        for layout in ('2GB', '4GB'):
+            path, gen = self.generate(layout, 500, fanout=6, layout=layout)
+            reader = MKEYEDReader(path)
+            self.assertEqual(len(reader), 500)
+            keys = [key for key, _ in reader.getIndex().cursor()]
+            self.assertEqual(keys, [gen.key(i) for i in range(500)])
+            self.assertEqual(reader.read(gen.key(250)), gen.key(250))
+            self.assertEqual(reader.readRecord(gen.key(499))[1], 499.0)
+
+    def test_partial_key(self):
+        """A partial key should raise with the first matching key"""
+        path, gen = self.generate('PARTIAL', 100, fanout=4)
+        reader = MKEYEDReader(path)
+        with self.assertRaises(BBPyPartialKeyFoundException) as e:
+            reader.read(gen.key(42)[:14])
+        self.assertEqual(e.exception.recordkey, gen.key(40))
+        self.assertEqual(len(reader.readAll(gen.key(42)[:14])), 10)
+
+    def test_read_batches(self):
+        """Batches should hold every matching record in key order"""
+        path, gen = self.generate('BATCHES', 250, fanout=5)
+        reader = MKEYEDReader(path)
+        batches = list(reader.readBatches(batch_size=100, keysonly=True))
+        self.assertEqual([len(batch) for batch in batches], [100, 100, 50])
+        self.assertEqual(sum(batches, []), [gen.key(i) for i in range(250)])
+
+        prefix = gen.key(123)[:13]
+        records = [record for batch in reader.readBatches(
+            prefix, batch_size=3, numerics=True, reuse=True)
+            for record in batch]
+        self.assertEqual(records, reader.readAll(prefix, numerics=True))
+
+    def test_resume(self):
+        """Scans should continue from a token, even after the file changed"""
+        path, gen = self.generate('RESUME', 300, fanout=4)
+        reader = MKEYEDReader(path)
+        records = reader.readGenerator(numerics=True)
+        first = [next(records)[0] for _ in range(130)]
+        token = reader.scanToken()
+        rest = [record[0] for record in
+                MKEYEDReader(path).readGenerator(numerics=True, token=token)]
+        self.assertEqual(first + rest, [gen.key(i) for i in range(300)])
+
+        keys, token = [], None
+        while True:
+            chunk, token = reader.readChunk(
+                gen.key(0)[:13], size=7, token=token, keysonly=True)
+            keys.extend(chunk)
+            if token is None:
+                break
+        self.assertEqual(keys, [gen.key(i) for i in range(100)])
+
+        # A different tree invalidates the path, the last key still works
+        _, token = reader.readChunk(size=150)
+        self.generate('RESUME', 400, fanout=3)
+        reader = MKEYEDReader(path)
+        reader.resume(token)
+        self.assertEqual(reader.read(), gen.key(150))
+        self.assertRaises(BBPyScanTokenError, reader.resume, 'not a token')
+
+    def test_bloom_filter(self):
+        """Missing keys should be answered by the Bloom filter"""
+        path, gen = self.generate('BLOOM', 200, fanout=4, step=2)
+        reader = MKEYEDReader(path)
+        sidecar = path + '.bloom'
+        reader.buildBloomFilter(0.01, path=sidecar)
+        missing = [default_key(i * 2 + 1, 23) for i in range(100)]
+        for key in missing:
+            self.assertRaises(BBPyKeyNotFoundError, reader.read, key)
+        stats = reader.getStats(extended=True)
+        self.assertEqual(stats['bloom_checks'], 100)
+        self.assertGreater(stats['bloom_saved'], 90)
+        self.assertEqual(reader.read(gen.key(10)), gen.key(10))
+
+        self.generate('BLOOM', 201, fanout=4, step=2)
+        self.assertRaises(
+            BBPyBloomFilterError, MKEYEDReader(path).loadBloomFilter, sidecar)
+
+    def test_record_cache(self):
+        """Cached records should be dropped when the file changes"""
+        path, gen = self.generate('CACHE', 50, fanout=4)
+        reader = MKEYEDReader(path)
+        reader.enableRecordCache(10, validate_interval=0)
+        for _ in range(3):
+            reader.read(gen.key(1))
+            reader.read(gen.key(2))
+        stats = reader.getStats(extended=True)
+        self.assertEqual((stats['cache_hits'], stats['cache_misses']), (4, 2))
+
+        self.generate('CACHE', 60, fanout=4)
+        reader.read(gen.key(1))
+        self.assertEqual(len(reader), 60)
+        self.assertEqual(reader.getStats(extended=True)['cache_size'], 1)
+
+    def test_analyze(self):
+        """Generated indexes should be healthy"""
+        path, gen = self.generate('ANALYZE', 1000, fanout=8)
+        report = analyze(MKEYEDReader(path))
+        self.assertEqual(report.problems(), [])
+        self.assertEqual(report.keys, 1000)
+        self.assertEqual(report.min_leaf_depth, report.max_leaf_depth)
+
+    def test_export(self):
+        """Exported columns should hold every field, typed"""
+        path, gen = self.generate('EXPORT', 120, fanout=5, fields=3)
+        outdir = os.path.join(self.tmpdir, 'columns')
+        reader = MKEYEDReader(path)
+        manifest = export(reader, outdir, chunk_size=50, names=['record'])
+        self.assertEqual(manifest['rows'], 120)
+        self.assertEqual(
+            [(column['name'], column['type'])
+             for column in manifest['columns']],
+            [('record', 'text'), ('field_1', 'float64'),
+             ('field_2', 'float64'), ('field_3', 'float64')])
+        self.assertTrue(is_current(outdir, reader))
+
+        def load(name, code):
+            with open(os.path.join(outdir, name), 'rb') as f:
+                data = f.read()
+            header_end = 10 + struct.unpack('<H', data[8:10])[0]
+            self.assertIn("'shape': (%d,)" % (
+                (len(data) - header_end) // struct.calcsize(code)),
+                data[10:header_end])
+            return struct.unpack('<%d%s' % (
+                (len(data) - header_end) // struct.calcsize(code), code),
+                data[header_end:])
+
+        self.assertEqual(list(load('field_2.npy', 'd')),
+                         [float(i * 2) for i in range(120)])
+        offsets = load('record.offsets.npy', 'q')
+        with open(os.path.join(outdir, 'record.data.npy'), 'rb') as f:
+            data = f.read()[-offsets[-1]:]
+        self.assertEqual(data[offsets[7]:offsets[8]], gen.key(7))
+
+    def test_registry(self):
+        """Readers should be reused until their file changes or idles"""
+        path, gen = self.generate('REGISTRY', 100, fanout=4)
+        registry = ReaderRegistry(idle_timeout=0.05)
+        with registry.reader(path) as reader:
+            reader.read(gen.key(10))
+            warm = len(reader.getIndex().blocks)
+        with registry.reader(path) as again:
+            self.assertIs(again, reader)
+            self.assertEqual(len(again.getIndex().blocks), warm)
+            self.assertEqual(again.read(), gen.key(0))
+            self.assertIsNot(registry.acquire(path), again)
+
+        os.utime(path, (0, 0))
+        with registry.reader(path) as reopened:
+            self.assertIsNot(reopened, reader)
+        self.assertEqual((registry.opened, registry.reused), (3, 1))
+        for _ in range(100):
+            if not len(registry):
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(registry), 0)
+
+    def test_incremental_scan(self):
+        """Only records added since the last scan should be read"""
+        def key(i):
+            return '%020d%s%05d%09d' % (i, 'NT'[i % 3 == 0], 0, i)
+
+        def triggered(fields):
+            if fields[0][20:21] == 'T':
+                return fields[0][26:35]
+
+        def expected(records):
+            return ['%09d' % i for i in range(0, records, 3)]
+
+        path, _ = self.generate('DBFW21', 90, keylength=35, keyfunc=key)
+        scan = IncrementalScan(os.path.join(self.tmpdir, 'scan.json'),
+                               triggered)
+        self.assertEqual(scan.scan(MKEYEDReader(path)), expected(90))
+        self.assertEqual(scan.records_read, 90)
+        values = scan.scan(MKEYEDReader(path))
+        self.assertEqual(values, expected(90))
+        self.assertEqual((scan.index_walked, scan.records_read), (False, 0))
+        # Saved values should have the type a scan reads them as
+        self.assertEqual(set(type(value) for value in values), set([str]))
+
+        self.generate('DBFW21', 100, keylength=35, keyfunc=key)
+        self.assertEqual(scan.scan(MKEYEDReader(path)), expected(100))
+        self.assertEqual((scan.full_scan, scan.index_walked,
+                          scan.records_read), (False, True, 10))
+
+        # A trigger deleted and its slot reused for another record
+        def reused(i):
+            if i == 30:
+                return '%020dT%05d%09d' % (i, 1, 999)
+            return key(i)
+
+        self.generate('DBFW21', 100, keylength=35, keyfunc=reused)
+        values = expected(100)
+        values[10] = '%09d' % 999
+        self.assertEqual(scan.scan(MKEYEDReader(path)), values)
+        self.assertEqual((scan.full_scan, scan.records_read), (False, 1))
+
+        # A record that matched nothing deleted and its slot reused for a
+        # trigger, so the record count doesn't change
+        def replaced(i):
+            if i == 31:
+                return '%020dT%05d%09d' % (i, 1, 998)
+            return reused(i)
+
+        self.generate('DBFW21', 100, keylength=35, keyfunc=replaced)
+        values.insert(11, '%09d' % 998)
+        self.assertEqual(scan.scan(MKEYEDReader(path)), values)
+        self.assertEqual((scan.full_scan, scan.records_read), (False, 1))
+
+        # A trigger deleted, its slot left out of the index, and a record
+        # that matches nothing added
+        self.generate('DBFW21', 101, keylength=35, keyfunc=replaced,
+                      deleted=[33])
+        values.remove('%09d' % 33)
+        self.assertEqual(scan.scan(MKEYEDReader(path)), values)
+        self.assertEqual((scan.full_scan, scan.records_read), (False, 1))
+
+        self.generate('DBFW21', 50, keylength=35, keyfunc=key)
+        self.assertEqual(scan.scan(MKEYEDReader(path)), expected(50))
+        self.assertEqual((scan.full_scan, scan.records_read), (True, 50))
+
+
+class TestInstrumentation(MKEYEDTestCase):
+    """Counting the work a reader does"""
+
+    def setUp(self):
+        MKEYEDTestCase.setUp(self)
+        self.path, self.gen = self.generate('COUNTED', 300, fanout=4)
+        self.reader = MKEYEDReader(self.path)
+
+    def test_counters(self):
+        """Lookups should be counted until instrumentation is turned off"""
+        stats = self.reader.enableInstrumentation()
+        self.assertIs(self.reader.enableInstrumentation(), stats)
+        self.assertEqual(self.reader.read(self.gen.key(10)), self.gen.key(10))
+        conversions = stats.numeric_conversions
+        fields = self.reader.readRecord(self.gen.key(200))
+        counters = self.reader.getStats(extended=True)
+        self.assertEqual(counters['lookups'], 2)
+        self.assertGreater(counters['max_depth'], 1)
+        self.assertGreaterEqual(
+            counters['lookup_depth'], counters['max_depth'])
+        self.assertGreater(counters['bytes_read'], 0)
+        self.assertGreater(counters['records_split'], 0)
+        self.assertEqual(counters['numeric_conversions'] - conversions,
+                         sum(1 for field in fields if type(field) is float))
+
+        self.reader.disableInstrumentation()
+        self.assertNotIn('lookups', self.reader.getStats(extended=True))
+        self.assertEqual(self.reader.read(self.gen.key(20)), self.gen.key(20))
+
+    def test_profile(self):
+        """A profile should report the work done inside it"""
+        with self.reader.profile() as profile:
+            self.reader.read(self.gen.key(30))
+        self.assertEqual(profile.counters['lookups'], 1)
+        self.assertGreater(profile.counters['max_depth'], 1)
+        self.assertIsNone(self.reader._stats)
+        self.assertIn('lookups', str(profile))
+
+        stats = self.reader.enableInstrumentation()
+        self.reader.read(self.gen.key(40))
+        depth = stats.max_depth
+        with self.reader.profile() as profile:
+            self.reader.getIndex()
+        self.assertEqual(profile.counters['lookups'], 0)
+        self.assertEqual(profile.counters['max_depth'], 0)
+        self.assertIs(self.reader._stats, stats)
+        self.assertEqual(stats.max_depth, depth)
+
+        with self.reader.profile(enabled=False) as profile:
+            self.reader.read(self.gen.key(50))
+        self.assertEqual(profile.counters, {})
+
+
+class TestJoin(MKEYEDTestCase):
+    """Joining two generated files"""
+
+    def setUp(self):
+        MKEYEDTestCase.setUp(self)
+        self.left, _ = self.generate('LEFT', 300, fanout=5, step=2)
+        self.right, _ = self.generate('RIGHT', 200, fanout=4, step=3)
+        self.expected = len(set(range(0, 600, 2)) & set(range(0, 600, 3)))
+
+    def test_merge_join(self):
+        """Both sides ordered on a key prefix"""
+        pairs = list(join(KeyedStream(MKEYEDReader(self.left), joinkey=15),
+                          KeyedStream(MKEYEDReader(self.right), joinkey=15)))
+        self.assertEqual(len(pairs), self.expected)
+        for left, right in pairs:
+            self.assertEqual(left[0][:15], right[0][:15])
+
+    def test_lookup_join(self):
+        """One side joined on a record value"""
+        probe = RecordStream(
+            MKEYEDReader(self.right), joinkey=lambda record: record[0][:15])
+        pairs = list(join(
+            probe, KeyedStream(MKEYEDReader(self.left), joinkey=15)))
+        self.assertEqual(len(pairs), self.expected)
+
+
+class TestMirror(MKEYEDTestCase):
+    """Local copies of a generated file"""
+
+    def setUp(self):
+        MKEYEDTestCase.setUp(self)
+        self.source, self.gen = self.generate('SOURCE', 200, fanout=4)
+        self.mirror_dir = os.path.join(self.tmpdir, 'mirror')
+        self.mirror = MKEYEDMirror(
+            self.source, self.mirror_dir, chunk_size=4096)
+
+    def test_refresh(self):
+        """Open readers should keep a complete copy through a refresh"""
+        chunks = (os.path.getsize(self.source) + 4095) // 4096
+        self.assertEqual(self.mirror.refresh(), chunks)
+        inode = os.stat(self.mirror.path).st_ino
+        self.assertEqual(self.mirror.refresh(force=True), 0)
+        self.assertEqual(os.stat(self.mirror.path).st_ino, inode)
+
+        old = self.mirror.open(refresh=False)
+        self.generate('SOURCE', 300, fanout=4)
+        self.assertGreater(self.mirror.refresh(), 0)
+        self.assertNotEqual(os.stat(self.mirror.path).st_ino, inode)
+        self.assertEqual(len(old), 200)
+        self.assertEqual(old.read(self.gen.key(150)), self.gen.key(150))
+        self.assertEqual(len(self.mirror.open(refresh=False)), 300)
+        self.assertEqual([name for name in os.listdir(self.mirror_dir)
+                          if name.endswith('.tmp')], [])
+
+    def test_changed_chunks(self):
+        """A refresh should patch only the changed chunks into the copy"""
+        self.mirror.refresh()
+        with open(self.source, 'r+b') as f:
+            f.seek(5000)
+            f.write('X')
+        self.assertEqual(self.mirror.refresh(force=True), 1)
+        with open(self.source, 'rb') as f:
+            source = f.read()
+        with open(self.mirror.path, 'rb') as f:
+            self.assertEqual(f.read(), source)
+
+        # Shorter at a chunk boundary, with every chunk left unchanged
+        with open(self.source, 'r+b') as f:
+            f.truncate(8192)
+        self.assertEqual(self.mirror.refresh(force=True), 0)
+        self.assertEqual(os.path.getsize(self.mirror.path), 8192)
+
+    def test_stale(self):
+        """A changed source should make the copy stale until refreshed"""
+        self.assertFalse(self.mirror.isCurrent())
+        self.mirror.refresh()
+        self.assertTrue(self.mirror.isCurrent())
+        self.generate('SOURCE', 201, fanout=4)
+        self.assertFalse(self.mirror.isCurrent())
+        reader = self.mirror.open()
+        self.assertTrue(self.mirror.isCurrent())
+        self.assertEqual(len(reader), 201)
+
+
+class TestSharedIndex(MKEYEDTestCase):
+    """Indexes published to forked workers"""
+
+    def setUp(self):
+        MKEYEDTestCase.setUp(self)
+        self.path, self.gen = self.generate('SHARED', 300, fanout=4)
+        self.shared = SharedIndex.publish(MKEYEDReader(self.path))
+
+    def tearDown(self):
+        self.shared.close()
+        MKEYEDTestCase.tearDown(self)
+
+    def test_lookup(self):
+        """The flattened index should find the same keys as the file's"""
+        reader = MKEYEDReader(self.path)
+        index = list(reader.getIndex().cursor())
+        self.assertEqual(len(self.shared), 300)
+        self.assertEqual(list(self.shared.cursor()), index)
+        self.assertEqual(self.shared.get(self.gen.key(42)), index[42][1])
+        self.assertEqual(self.shared.get(default_key(100000, 23)), None)
+        keys = [key for key, _ in self.shared.cursor(self.gen.key(290))]
+        self.assertEqual(keys, [self.gen.key(i) for i in range(290, 300)])
+
+        cursor = self.shared.cursor()
+        first = [next(cursor).key for _ in range(100)]
+        rest = [key for key, _ in self.shared.resume(cursor.token())]
+        self.assertEqual(first + rest, [self.gen.key(i) for i in range(300)])
+
+    def test_forked_workers(self):
+        """Workers forked after publishing should read through the index"""
+        pids = []
+        for worker in range(3):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    reader = MKEYEDReader(self.path)
+                    self.shared.install(reader)
+                    keys = [self.gen.key(i) for i in range(worker, 300, 3)]
+                    if [reader.read(key) for key in keys] == keys:
+                        status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+    def test_changed_file(self):
+        """An index shouldn't be installed for a file that changed"""
+        self.generate('SHARED', 301, fanout=4)
+        self.assertRaises(ValueError, self.shared.install,
+                          MKEYEDReader(self.path))
+
+
+class WriterTestCase(MKEYEDTestCase):
+    """Writes through the stand-in writer into the scratch directory"""
+
+    def command(self, *args):
+        return ' '.join([sys.executable,
+                         os.path.join(UTILS, 'fake_bbx_writer.py')] +
+                        list(args) + [self.tmpdir])
+
+    def journal(self, filename):
+        with open(os.path.join(self.tmpdir, filename)) as f:
+            return [json.loads(line) for line in f]
+
+
+class TestWriter(WriterTestCase):
+    """Writing through the stand-in writer"""
+
+    def test_one_shot(self):
+        """Each flush runs the writer once"""
+        writer = MKEYEDWriter(command=self.command())
+        writer.write('AGPPI', '090A', '090A rest', nums=[1, 2])
+        writer.delete('AGPPI', '090B')
+        writer.flush()
+        self.assertEqual(
+            [(entry['op'], entry['key']) for entry in self.journal('AGPPI')],
+            [('write', '090A'), ('delete', '090B')])
+
+    def test_session(self):
+        """One writer process should take every batch, and be restarted"""
+        writer = MKEYEDWriter(session=True, command=self.command('--session'))
+        for batch in range(3):
+            writer.write('AGPPI', '090%d' % batch, '090%d' % batch)
+            writer.flush()
+        self.assertEqual(writer._session.starts, 1)
+
+        writer._session.process.kill()
+        writer._session.process.wait()
+        writer.write('AGPPI', '0904', '0904')
+        writer.close()
+        self.assertEqual(writer._session.starts, 2)
+        self.assertEqual(len(self.journal('AGPPI')), 4)
+
+    def test_session_lost_reply(self):
+        """A batch the writer took but didn't answer should raise"""
+        writer = MKEYEDWriter(
+            session=True, command=self.command('--session --fail-after 1'))
+        writer.write('AGPPI', '0901', '0901')
+        writer.flush()
+        writer.write('AGPPI', '0902', '0902')
+        self.assertRaises(BBPyWriterIOError, writer.flush)
+        writer.flush()
+        self.assertEqual(writer._session.starts, 2)
+        writer.close()
+
+    def test_framed(self):
+        """Framed batches should round trip and fail per request"""
+        batch = [{'filename': 'AGPPI', 'key': '090A', 'numcount': '0',
+                  'record': '090A\n1:2\x00'},
+                 {'filename': 'AGPPI', 'key': '090B', 'numcount': '0',
+                  'record': ''}]
+        _, decoded = decodeWriteRequest(encodeWriteRequest(batch, 0))
+        self.assertEqual([request['record'] for request in decoded],
+                         ['090A\n1:2\x00', ''])
+
+        for args in ((), ('--session',)):
+            writer = MKEYEDWriter(
+                session=bool(args), command=self.command(*args),
+                wire_format='framed')
+            writer.write('AGPPI', '090A', '090A\n1\n', nums=[1, 2.5])
+            writer.write('AGPPI', '', 'no key')
+            writer.delete('AGPPI', '090B')
+            with self.assertRaises(BBPyWriterRecordError) as e:
+                writer.flush()
+            self.assertEqual([request['record'] for request, _ in
+                              e.exception.failures], ['no key'])
+            self.assertEqual(writer.batch, [])
+            writer.close()
+        self.assertEqual(
+            [(entry['op'], entry.get('numerics')) for entry in
+             self.journal('AGPPI')],
+            [('write', [1, 2.5]), ('delete', None)] * 2)
+
+        # Cleaning up a writer that failed to start shouldn't raise
+        writer = MKEYEDWriter.__new__(MKEYEDWriter)
+        self.assertRaises(BBPyWriterTypeError, writer.__init__,
+                          wire_format='json')
+        writer.__del__()
+
+
+class ChunkRecordingWriter(MKEYEDWriter):
+    """Remembers the requests sent to the writer"""
+
+    def _sendChunk(self, batch):
+        self.chunks = getattr(self, 'chunks', [])
+        self.chunks.append([request['filename'] for request in batch])
+        MKEYEDWriter._sendChunk(self, batch)
+
+
+class TestWriterLimits(WriterTestCase):
+    """Auto-flushing, chunking and the background flusher"""
+
+    def test_auto_flush(self):
+        """A full batch should be flushed in chunks, grouped by file"""
+        writer = ChunkRecordingWriter(
+            command=self.command(), max_records=5, chunk_size=2,
+            group_by_file=True)
+        for i in range(6):
+            writer.write('AB'[i % 2], '090%d' % i, '090%d' % i)
+        self.assertEqual(writer.chunks, [['A', 'A'], ['A'], ['B', 'B']])
+        self.assertEqual(len(writer.batch), 1)
+        writer.close()
+        self.assertEqual(writer.chunks[-1], ['B'])
+        self.assertEqual([entry['key'] for entry in self.journal('A')],
+                         ['0900', '0902', '0904'])
+        self.assertEqual(len(self.journal('B')), 3)
+
+    def test_background(self):
+        """The flusher should write everything, in order"""
+        writer = MKEYEDWriter(
+            session=True, command=self.command('--session'), max_records=10,
+            max_pending=15, background=True)
+        for i in range(100):
+            writer.write('AGPPI', '%04d' % i, '%04d' % i)
+        writer.flush()
+        self.assertEqual([entry['key'] for entry in self.journal('AGPPI')],
+                         ['%04d' % i for i in range(100)])
+        writer.close()
+
+    def test_background_max_age(self):
+        """An old request should be flushed without another write"""
+        writer = MKEYEDWriter(
+            command=self.command(), max_age=0.05, background=True)
+        writer.write('AGPPI', '0901', '0901')
+        for _ in range(100):
+            if not (writer.batch or writer._inflight):
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(self.journal('AGPPI')), 1)
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
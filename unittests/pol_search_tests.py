@@ -0,0 +1,408 @@
+"""Tests for the policy search helpers, with a stand-in for Policelink"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from collections import namedtuple
+
+try:
+    from urllib2 import HTTPError, urlopen
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+
+UTILS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils')
+sys.path.insert(0, UTILS)
+
+from mkeyed_gen import MKEYEDGenerator
+from mkeyed_registry import ReaderRegistry
+import policy
+from policy import Policy
+import pol_search
+from pol_search import Search
+import pol_search_concurrent
+from pol_search_concurrent import ConcurrentSearch
+from pol_search_daemon import (
+    SearchClient, SearchDaemon, SearchDaemonError, SearchRequestError,
+    run_search)
+from search_profiler import STAGES, SearchProfiler
+
+Record = namedtuple('Record', 'exp')
+PolicyRecord = namedtuple('PolicyRecord', 'pol')
+
+
+class FakePolicelink(object):
+    """Counts billing lookups instead of calling Policelink"""
+
+    def __init__(self):
+        self.fetched = []
+        fake = self
+
+        class Policy(object):
+            def __init__(self, number, exp):
+                self.key = (number, exp)
+
+            def get_billingstatus(self):
+                fake.fetched.append(self.key)
+                self.billing = {'accept': 'T', 'fetch': len(fake.fetched)}
+
+        self.Policy = Policy
+
+
+class FakeSearch(object):
+    """Answers searches with the arguments it was given"""
+
+    calls = []
+
+    @classmethod
+    def get_rewrites(cls, state, count=10):
+        cls.calls.append(('rewrites', state, count))
+        return [{'state': state, 'n': i} for i in range(count)]
+
+    @classmethod
+    def get_rewritten(cls):
+        raise IOError('AGPPI is locked')
+
+
+class SlowPolicy(object):
+    """A Policy whose billing lookup takes a while
+
+    Every third policy number is eligible for rewrite.
+    """
+
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+    lookups = 0
+
+    def __init__(self, record_string, fetch_billing=True):
+        self.record = PolicyRecord(record_string[6:15])
+        if fetch_billing:
+            self.get_billing()
+
+    def get_billing(self):
+        cls = SlowPolicy
+        with cls.lock:
+            cls.lookups += 1
+            cls.running += 1
+            cls.peak = max(cls.peak, cls.running)
+        time.sleep(0.01)
+        with cls.lock:
+            cls.running -= 1
+
+    def is_rewritable(self):
+        return int(self.record.pol) % 3 == 0
+
+
+class TestBillingCache(unittest.TestCase):
+    """Sharing billing statuses between Policy objects"""
+
+    def setUp(self):
+        self.original = policy.policelink
+        self.policelink = policy.policelink = FakePolicelink()
+
+    def tearDown(self):
+        Policy.cache_billing(0)
+        policy.policelink = self.original
+
+    def lookup(self, number, exp='20271231'):
+        pol = Policy.__new__(Policy)
+        pol.policy_number = number
+        pol.record = Record(exp)
+        pol.get_billing()
+        return pol
+
+    def test_off_by_default(self):
+        """Without cache_billing every Policy should fetch its status"""
+        self.assertEqual(Policy.billing_ttl, 0)
+        self.lookup('A1')
+        self.lookup('A1')
+        self.assertEqual(len(self.policelink.fetched), 2)
+        self.assertEqual(len(Policy._billing_cache), 0)
+
+    def test_cached(self):
+        """A status should be reused until it expires"""
+        Policy.cache_billing(ttl=0.2)
+        self.assertEqual(self.lookup('A1').billing['fetch'], 1)
+        self.assertEqual(self.lookup('A1').billing['fetch'], 1)
+        self.assertEqual(self.lookup('A1', exp='20281231').billing['fetch'], 2)
+        time.sleep(0.25)
+        self.assertEqual(self.lookup('A1').billing['fetch'], 3)
+
+    def test_least_recently_used(self):
+        """A full cache should drop the least recently used status"""
+        Policy.cache_billing(size=3)
+        for number in ('A1', 'A2', 'A3', 'A1', 'A4'):
+            self.lookup(number)
+        self.assertEqual(len(Policy._billing_cache), 3)
+        self.assertEqual(
+            [key[0] for key in Policy._billing_cache], ['A3', 'A1', 'A4'])
+        self.lookup('A1')
+        self.lookup('A2')
+        self.assertEqual(self.policelink.fetched,
+                         [(number, '20271231')
+                          for number in ('A1', 'A2', 'A3', 'A4', 'A2')])
+
+
+class TestDaemon(unittest.TestCase):
+    """Searching through the daemon"""
+
+    def setUp(self):
+        FakeSearch.calls = []
+        self.daemon = SearchDaemon(0, searcher=FakeSearch)
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = SearchClient(self.daemon.port, timeout=10)
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.daemon.server_close()
+        self.thread.join()
+
+    def get(self, path):
+        url = 'http://127.0.0.1:%d%s' % (self.daemon.port, path)
+        try:
+            response = urlopen(url, timeout=10)
+        except HTTPError as e:
+            return e.code, json.loads(e.read().decode('utf-8'))
+        try:
+            return response.getcode(), json.loads(
+                response.read().decode('utf-8'))
+        finally:
+            response.close()
+
+    def test_search(self):
+        """Searches should reach the searcher with their arguments"""
+        self.assertEqual(self.client.get_rewrites('OK', 3),
+                         [{'state': 'OK', 'n': i} for i in range(3)])
+        self.assertEqual(len(self.client.get_rewrites('TX')), 10)
+        self.assertEqual(FakeSearch.calls,
+                         [('rewrites', 'OK', 3), ('rewrites', 'TX', 10)])
+        status, body = self.get('/health')
+        self.assertEqual((status, body['requests']), (200, 2))
+
+    def test_errors(self):
+        """Bad requests should get a 400, failed searches a 500"""
+        self.assertEqual(self.get('/rewrites')[0], 400)
+        self.assertEqual(self.get('/rewrites?state=OK&count=ten')[0], 400)
+        self.assertEqual(self.get('/nothing')[0], 404)
+        status, body = self.get('/rewritten')
+        self.assertEqual(status, 500)
+        self.assertIn('AGPPI is locked', body['error'])
+        self.assertRaises(SearchDaemonError, self.client.get_rewritten)
+        self.assertEqual(FakeSearch.calls, [])
+
+    def test_run_search(self):
+        """In-process searches should check their arguments the same way"""
+        self.assertRaises(SearchRequestError, run_search,
+                          FakeSearch, '/rewrites', {'count': '3'})
+        self.assertEqual(
+            len(run_search(FakeSearch, '/rewrites', {'state': 'OK'})), 10)
+
+
+class TestSearch(unittest.TestCase):
+    """Checking AGPPI readers out of the registry"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pol-search-tests-')
+        path = os.path.join(self.tmpdir, 'AGPPI')
+        MKEYEDGenerator(100, fanout=8).write(path)
+        self.registry = ReaderRegistry(idle_timeout=0)
+
+        class GeneratedSearch(Search):
+            datafile = path
+            registry = self.registry
+
+        self.Search = GeneratedSearch
+        self.original = pol_search.Policy
+        pol_search.Policy = SlowPolicy
+
+    def tearDown(self):
+        pol_search.Policy = self.original
+        self.registry.closeIdle()
+        shutil.rmtree(self.tmpdir)
+
+    def test_reader(self):
+        """A search outside a with block shouldn't keep its reader"""
+        search = self.Search()
+        self.assertEqual(self.registry._out, {})
+        self.assertEqual(len(search.find_rewrites(['090N35'], 2)), 3)
+        self.assertEqual(self.registry._out, {})
+        self.assertEqual(len(search.find_rewrites(['090N35'], 2)), 3)
+        self.assertEqual(self.registry.reused, 1)
+
+        with self.Search() as search:
+            reader = search.reader
+            search.find_rewrites(['090N35'], 2)
+            search.find_rewrites(['090N35'], 2)
+            self.assertEqual(list(self.registry._out), [id(reader)])
+        self.assertEqual(self.registry._out, {})
+
+
+class TestConcurrentSearch(unittest.TestCase):
+    """Searching with concurrent reads and billing lookups"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pol-search-tests-')
+        path = os.path.join(self.tmpdir, 'AGPPI')
+        MKEYEDGenerator(400, fanout=8).write(path)
+        self.registry = ReaderRegistry(idle_timeout=0)
+
+        class GeneratedSearch(Search):
+            datafile = path
+            registry = self.registry
+
+        SlowPolicy.running = SlowPolicy.peak = SlowPolicy.lookups = 0
+        self.original = pol_search_concurrent.Policy
+        pol_search_concurrent.Policy = SlowPolicy
+        self.search = ConcurrentSearch(
+            billing_workers=4, search=GeneratedSearch)
+
+    def tearDown(self):
+        self.search.close(wait=True)
+        pol_search_concurrent.Policy = self.original
+        self.registry.closeIdle()
+        shutil.rmtree(self.tmpdir)
+
+    def test_rewrites(self):
+        """Results should come in key order, with lookups run concurrently"""
+        # Like Search.find(), up to count + 1
+        self.assertEqual(self.search.get_rewrites('OK', 20),
+                         ['%09d' % i for i in range(0, 63, 3)])
+        self.assertGreater(SlowPolicy.peak, 1)
+        self.assertLessEqual(SlowPolicy.peak, 4)
+        self.assertEqual(self.registry._out, {})
+        self.assertEqual(len(self.search.get_rewrites('OK', 1000)), 134)
+
+    def test_cancel(self):
+        """A cancelled scan should stop and hand its reader back"""
+        self.search.chunk_size = 10
+        policies = self.search.iter_rewrites('OK', 1000)
+        self.assertEqual(next(policies), '000000000')
+        self.search.cancel()
+        self.assertEqual(list(policies), [])
+        self.assertLess(SlowPolicy.lookups, 30)
+        self.assertEqual(self.registry._out, {})
+
+        stop = threading.Event()
+        policies = self.search.iter_rewrites('OK', 1000, stop=stop)
+        next(policies)
+        policies.close()
+        self.assertTrue(stop.is_set())
+        self.assertEqual(self.registry._out, {})
+
+    def test_cancel_before_start(self):
+        """A scan cancelled before its first result should not run"""
+        policies = self.search.iter_rewrites('OK', 1000)
+        self.search.cancel()
+        self.assertEqual(list(policies), [])
+        self.assertEqual(SlowPolicy.lookups, 0)
+        self.assertEqual(self.registry._out, {})
+        self.assertEqual(len(self.search.get_rewrites('OK', 2)), 3)
+
+
+class TestSearchProfiler(unittest.TestCase):
+    """Timing the stages of a search"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pol-search-tests-')
+        self.profiler = SearchProfiler(trace=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stages(self):
+        """Stages should count towards the search they ran in"""
+        profiler = self.profiler
+        with profiler.search('outer'):
+            with profiler.stage('read', 'K1'):
+                pass
+            with profiler.search('inner'):
+                with profiler.stage('read', 'K1'):
+                    time.sleep(0.01)
+                with profiler.stage('billing', 'K2'):
+                    pass
+        with profiler.stage('read'):
+            pass
+
+        inner, outer = profiler.searches
+        self.assertEqual((inner['name'], outer['name']), ('inner', 'outer'))
+        self.assertEqual(sorted(inner['stages']), ['billing', 'read'])
+        self.assertEqual(outer['stages']['read'][0], 1)
+        self.assertGreaterEqual(outer['elapsed'], inner['elapsed'])
+        count, total, longest = profiler.stages[('K1', 'read')]
+        self.assertEqual(count, 2)
+        self.assertGreaterEqual(longest, 0.01)
+        self.assertEqual(profiler.stages[(None, 'read')][0], 1)
+        self.assertIn('2 searches', profiler.summary())
+
+        path = os.path.join(self.tmpdir, 'trace.json')
+        profiler.dump_trace(path)
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual(len(events), 6)
+        self.assertEqual(set(event['ph'] for event in events), set('X'))
+
+        profiler.clear()
+        self.assertEqual((list(profiler.searches), profiler.stages,
+                          list(profiler.events)), ([], {}, []))
+        untraced = SearchProfiler()
+        with untraced.search('find'):
+            with untraced.stage('read'):
+                pass
+        self.assertEqual(list(untraced.events), [])
+        self.assertEqual(untraced.stages[(None, 'read')][0], 1)
+
+    def test_bounded(self):
+        """Only the latest searches and trace events should be kept"""
+        profiler = SearchProfiler(trace=True, max_searches=3, max_events=4)
+        for i in range(10):
+            with profiler.search('find', i=i):
+                with profiler.stage('read', 'K1'):
+                    pass
+        self.assertEqual(len(profiler.searches), 3)
+        self.assertEqual(len(profiler.events), 4)
+        self.assertEqual(profiler.events[-1]['args'], {'i': 9})
+        self.assertEqual(profiler.stages[('K1', 'read')][0], 10)
+
+    def test_find(self):
+        """Search.find should time each stage for every record it reads"""
+        path = os.path.join(self.tmpdir, 'AGPPI')
+        MKEYEDGenerator(100, fanout=8).write(path)
+
+        class ProfiledSearch(Search):
+            datafile = path
+            registry = ReaderRegistry(idle_timeout=0)
+            profiler = self.profiler
+
+        original = pol_search.Policy
+        pol_search.Policy = SlowPolicy
+        try:
+            with ProfiledSearch() as search:
+                policies = search.find_rewrites(['090N35'], 5)
+        finally:
+            pol_search.Policy = original
+        ProfiledSearch.registry.closeIdle()
+
+        # find() stops once it has more than count policies
+        self.assertEqual(policies, ['%09d' % i for i in range(0, 18, 3)])
+        search, = self.profiler.searches
+        self.assertEqual(search['name'], 'find')
+        self.assertEqual(
+            dict((name, stage[0]) for name, stage in search['stages'].items()),
+            {'index': 1, 'read': 16, 'decode': 16, 'billing': 16,
+             'predicate': 16})
+        self.assertGreaterEqual(search['stages']['billing'][1], 0.16)
+        self.assertEqual(sorted(name for _, name in self.profiler.stages),
+                         sorted(STAGES))
+        self.assertEqual(set(key for key, _ in self.profiler.stages),
+                         set(['090N35']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,8 +6,9 @@ import os
 import sys
 from selenium import webdriver
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+from session_pool import PooledTestCase
 
-class TestVehicle(unittest.TestCase):
+class TestVehicle(PooledTestCase):
     """ 
 Run a host of tests on the Vehicle Section in qq.entry
     """
@@ -31,24 +32,14 @@ Run a host of tests on the Vehicle Section in qq.entry
 
 
 
-    def setUp(self):
-
-
-        self.driver = webdriver.Remote(
-            command_executor = 'http://127.0.0.1:4444/wd/hub',
-            desired_capabilities= DesiredCapabilities.CHROME)
-
-        self.driver.implicitly_wait(10)
-
-
+    # A warm remote Chrome from the pool, see app/session_pool.py
+    browser = 'rch'
 
     def test_title(self):
         self.driver.get('http://www.google.com')
         
         self.assertIn('Google', self.driver.title)
 
-    def tearDown(self):
-        self.driver.close()
     # def reset_page(self, driver, url):
     #     """
     #     Resets the page to perform another action
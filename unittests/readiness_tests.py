@@ -0,0 +1,81 @@
+"""Tests for waiting on page readiness, with a stand-in for the driver"""
+import gc
+import os
+import sys
+import unittest
+
+from selenium.common.exceptions import JavascriptException, TimeoutException
+from selenium.webdriver.common.by import By
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP)
+
+import readiness
+from readiness import NAVIGATIONS, wait_for
+
+
+class FakeDriver(object):
+    """Answers the readiness script, after the given page loads"""
+
+    session_id = 'fake'
+
+    def __init__(self, navigations=0, result=True):
+        self.navigations = navigations
+        self.result = result
+        self.calls = []
+        self.script_timeouts = []
+
+    def set_script_timeout(self, timeout):
+        self.script_timeouts.append(timeout)
+
+    def execute_async_script(self, script, *args):
+        self.calls.append(args)
+        if len(self.calls) <= self.navigations:
+            raise JavascriptException(
+                'javascript error: document unloaded while waiting for '
+                'result')
+        return self.result
+
+
+class TestWaitFor(unittest.TestCase):
+    """Waiting with one script call"""
+
+    def test_wait(self):
+        """The script should get the wait's settings, in milliseconds"""
+        driver = FakeDriver(result='element')
+        self.assertEqual(wait_for(driver, 'vin', timeout=10), 'element')
+        (by, value, quiet, timeout, max_quiet), = driver.calls
+        self.assertEqual((by, value, quiet, max_quiet),
+                         ('name', 'vin', 100, 2000))
+        self.assertTrue(9900 <= timeout <= 10000)
+        self.assertTrue(wait_for(driver, quiet=None))
+        self.assertEqual(driver.calls[1][:3], (None, None, 0))
+        wait_for(driver, (By.XPATH, '//button[text()="Save"]'))
+        self.assertEqual(driver.calls[2][:2],
+                         ('xpath', '//button[text()="Save"]'))
+        self.assertRaises(TimeoutException, wait_for, FakeDriver(result=None))
+
+    def test_script_timeout(self):
+        """The script timeout should only be raised, once per driver"""
+        driver = FakeDriver()
+        wait_for(driver, timeout=10)
+        wait_for(driver, timeout=5)
+        wait_for(driver, timeout=20)
+        self.assertEqual(driver.script_timeouts, [15, 25])
+        self.assertEqual(len(readiness._script_timeouts), 1)
+        del driver
+        gc.collect()
+        self.assertEqual(len(readiness._script_timeouts), 0)
+
+    def test_navigation(self):
+        """A wait should start over on the page navigated to"""
+        driver = FakeDriver(navigations=2)
+        self.assertTrue(wait_for(driver))
+        self.assertEqual(len(driver.calls), 3)
+        driver = FakeDriver(navigations=NAVIGATIONS + 1)
+        self.assertRaises(JavascriptException, wait_for, driver)
+        self.assertEqual(len(driver.calls), NAVIGATIONS + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+"""Tests for the pool of warm WebDriver sessions, with fake browsers"""
+from contextlib import contextmanager
+import os
+import sys
+import unittest
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP)
+
+import session_pool
+from session_pool import (
+    CLEAR_FIREFOX_COOKIES, CLEAR_STORAGE, PooledTestCase, SessionPool,
+    SessionResetError)
+
+
+class FakeSwitchTo(object):
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def window(self, handle):
+        self.driver.current = handle
+
+
+class FakeDriver(object):
+    """A browser that records what was done to it"""
+
+    CONTEXT_CHROME = 'chrome'
+
+    def __init__(self, browser='chrome', healthy=True):
+        self.capabilities = {'browserName': browser}
+        self.is_healthy = healthy
+        self.window_handles = ['w1']
+        self.current = 'w1'
+        self.switch_to = FakeSwitchTo(self)
+        self.url = None
+        self.commands = []
+        self.quit_called = False
+
+    def open_window(self):
+        self.window_handles.append('w{}'.format(len(self.window_handles) + 1))
+
+    def close(self):
+        self.window_handles.remove(self.current)
+
+    def execute_script(self, script, *args):
+        if script == 'return 1;':
+            if not self.is_healthy:
+                raise IOError('browser went away')
+            return 1
+        self.commands.append(script)
+
+    def execute_cdp_cmd(self, cmd, params):
+        if self.capabilities['browserName'] != 'chrome':
+            raise AttributeError(cmd)
+        self.commands.append(cmd)
+
+    def delete_all_cookies(self):
+        self.commands.append('delete_all_cookies')
+
+    def implicitly_wait(self, seconds):
+        self.commands.append(('implicitly_wait', seconds))
+
+    def get(self, url):
+        self.url = url
+
+    def quit(self):
+        self.quit_called = True
+
+
+class FirefoxDriver(FakeDriver):
+    """A Firefox driver that can switch to the chrome context"""
+
+    def __init__(self, **kwargs):
+        FakeDriver.__init__(self, 'firefox', **kwargs)
+        self.contexts = []
+
+    @contextmanager
+    def context(self, context):
+        self.contexts.append(context)
+        yield
+
+
+class FakeFactories(object):
+    """Browser factories that keep every driver they started"""
+
+    def __init__(self):
+        self.started = []
+
+    def factory(self, driver_class, **kwargs):
+        def start():
+            driver = driver_class(**kwargs)
+            self.started.append(driver)
+            return driver
+        return start
+
+    def drivers(self):
+        return {'ch': self.factory(FakeDriver),
+                'ff': self.factory(FirefoxDriver),
+                'old': self.factory(FakeDriver, browser='safari')}
+
+
+class PoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeFactories()
+        self.pool = SessionPool(self.fake.drivers(), max_uses=3, max_idle=1)
+
+
+class TestSessionPool(PoolTestCase):
+    """Checking drivers out and back in"""
+
+    def test_reset(self):
+        """A reused driver should get back to a blank page"""
+        driver = self.pool.acquire('ch')
+        driver.open_window()
+        driver.open_window()
+        driver.url = 'http://qq/entry'
+        self.pool.release(driver)
+
+        self.assertIs(self.pool.acquire('ch'), driver)
+        self.assertEqual(driver.window_handles, ['w1'])
+        self.assertEqual(driver.current, 'w1')
+        self.assertEqual(driver.commands, [
+            CLEAR_STORAGE, 'delete_all_cookies',
+            'Network.clearBrowserCookies'])
+        self.assertEqual(driver.url, 'about:blank')
+        self.assertEqual((self.pool.started, self.pool.reused), (1, 1))
+
+    def test_firefox_cookies(self):
+        """Firefox should clear every site's cookies from its chrome context
+        """
+        driver = self.pool.acquire('ff')
+        self.pool.release(driver)
+        self.assertIs(self.pool.acquire('ff'), driver)
+        self.assertEqual(driver.contexts, ['chrome'])
+        self.assertIn(CLEAR_FIREFOX_COOKIES, driver.commands)
+
+    def test_no_cookie_clearing(self):
+        """A driver that can't clear every site's cookies should be replaced
+        """
+        driver = self.pool.acquire('old')
+        self.pool.release(driver)
+        self.assertRaises(SessionResetError, SessionPool.reset, driver)
+        fresh = self.pool.acquire('old')
+        self.assertIsNot(fresh, driver)
+        self.assertTrue(driver.quit_called)
+        self.assertEqual((self.pool.started, self.pool.reused), (2, 0))
+
+    def test_max_uses(self):
+        """A driver should be quit once it has been used max_uses times"""
+        driver = self.pool.acquire('ch')
+        for _ in range(2):
+            self.pool.release(driver)
+            self.assertIs(self.pool.acquire('ch'), driver)
+        self.assertFalse(driver.quit_called)
+        self.pool.release(driver)
+        self.assertTrue(driver.quit_called)
+        self.assertIsNot(self.pool.acquire('ch'), driver)
+
+    def test_failed(self):
+        """Drivers checked in as failed or that don't answer should be quit
+        """
+        failed = self.pool.acquire('ch')
+        self.pool.release(failed, failed=True)
+        self.assertTrue(failed.quit_called)
+
+        broken = self.pool.acquire('ch')
+        self.assertIsNot(broken, failed)
+        broken.is_healthy = False
+        self.pool.release(broken)
+        self.assertTrue(broken.quit_called)
+        self.assertEqual(len(self.fake.started), 2)
+        self.assertEqual(self.pool.recycled, 2)
+
+    def test_auth(self):
+        """A driver should only be handed out again for the same auth"""
+        agent = self.pool.acquire('ch', auth=('5121', 'test'))
+        self.pool.release(agent)
+        other = self.pool.acquire('ch', auth=('5331', 'test'))
+        anonymous = self.pool.acquire('ch')
+        self.assertEqual(len(set([agent, other, anonymous])), 3)
+        self.pool.release(other)
+        self.pool.release(anonymous)
+        self.assertIs(self.pool.acquire('ch', auth=('5121', 'test')), agent)
+        self.assertIs(self.pool.acquire('ch', auth=('5331', 'test')), other)
+
+    def test_max_idle(self):
+        """Drivers over max_idle should be quit when checked in"""
+        first = self.pool.acquire('ch')
+        second = self.pool.acquire('ch')
+        self.pool.release(first)
+        self.pool.release(second)
+        self.assertFalse(first.quit_called)
+        self.assertTrue(second.quit_called)
+        self.pool.close()
+        self.assertTrue(first.quit_called)
+
+
+class TestPooledTestCase(PoolTestCase):
+    """Running tests with a driver from the pool"""
+
+    def setUp(self):
+        PoolTestCase.setUp(self)
+        self.original = session_pool.pool
+        session_pool.pool = self.pool
+
+    def tearDown(self):
+        session_pool.pool = self.original
+
+    def run_test(self, name):
+        class Test(PooledTestCase):
+            browser = 'ch'
+            auth = ('5121', 'test')
+            drivers = []
+
+            def test_pass(self):
+                Test.drivers.append(self.driver)
+
+            def test_fail(self):
+                Test.drivers.append(self.driver)
+                self.fail('the quote failed')
+
+            def test_error(self):
+                Test.drivers.append(self.driver)
+                raise IOError('the browser crashed')
+
+        result = unittest.TestResult()
+        Test(name).run(result)
+        driver, = Test.drivers
+        return result, driver
+
+    def test_outcome(self):
+        """Drivers of failed tests should be quit, the others kept"""
+        result, driver = self.run_test('test_pass')
+        self.assertTrue(result.wasSuccessful())
+        self.assertFalse(driver.quit_called)
+        self.assertEqual(self.pool._idle[('ch', ('5121', 'test'))][0].driver,
+                         driver)
+
+        result, failed = self.run_test('test_fail')
+        self.assertEqual(len(result.failures), 1)
+        self.assertIs(failed, driver)
+        self.assertTrue(driver.quit_called)
+
+        result, crashed = self.run_test('test_error')
+        self.assertEqual(len(result.errors), 1)
+        self.assertIsNot(crashed, driver)
+        self.assertTrue(crashed.quit_called)
+        self.assertEqual(self.pool._out, {})
+        self.assertEqual(self.pool._idle[('ch', ('5121', 'test'))], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""Tests for page objects working side by side in tabs of one browser"""
+import os
+import sys
+import unittest
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP)
+
+from elements.base import BasePageElement
+from pages.base import BasePage
+from tabs import TabbedBrowser
+
+
+class FakeElement(object):
+    """An input of one tab, usable only while that tab is current"""
+
+    def __init__(self, driver, handle, value):
+        self.driver = driver
+        self.handle = handle
+        self.value = value
+
+    def _check(self):
+        # A real element of another window can't be reached either
+        if self.driver.current_window_handle != self.handle:
+            raise AssertionError('used while tab {} was current'.format(
+                self.driver.current_window_handle))
+
+    def clear(self):
+        self._check()
+        self.value = ''
+
+    def send_keys(self, value):
+        self._check()
+        self.value += value
+
+    def get_attribute(self, name):
+        self._check()
+        return self.value
+
+
+class FakeSwitchTo(object):
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def window(self, handle):
+        self.driver.switches += 1
+        self.driver.current_window_handle = handle
+
+
+class FakeDriver(object):
+    """A Firefox with a vin input in each window"""
+
+    session_id = 'fake'
+    capabilities = {'browserName': 'firefox'}
+
+    def __init__(self):
+        self.window_handles = ['w1']
+        self.current_window_handle = 'w1'
+        self.switch_to = FakeSwitchTo(self)
+        self.switches = 0
+        self.lookups = 0
+        self.elements = {}
+
+    def execute_script(self, script, *args):
+        if 'window.open' in script:
+            self.window_handles.append(
+                'w{}'.format(len(self.window_handles) + 1))
+
+    def get(self, url):
+        handle = self.current_window_handle
+        self.elements[handle] = FakeElement(self, handle, url)
+
+    def set_script_timeout(self, timeout):
+        pass
+
+    def execute_async_script(self, script, name, *args):
+        self.lookups += 1
+        return self.elements[self.current_window_handle]
+
+
+class VinElement(BasePageElement):
+    locator = 'vin'
+
+
+class VehiclePage(BasePage):
+    vin = VinElement()
+
+
+class TestTabPages(unittest.TestCase):
+    """Pages in different tabs of one browser"""
+
+    def setUp(self):
+        self.driver = FakeDriver()
+        self.browser = TabbedBrowser(self.driver)
+        self.browser.open('http://5121:test@qq/entry')
+        self.browser.open('http://5122:test@qq/entry')
+
+    def test_cached_elements(self):
+        """A cached element should be used in its own tab"""
+        first = self.browser['5121'].page(VehiclePage)
+        second = self.browser['5122'].page(VehiclePage)
+        first.vin = 'VIN1'
+        second.vin = 'VIN2'
+        self.assertEqual((first.lookups, second.lookups), (1, 1))
+
+        # Both are cached now, so only the tab switches reach the driver
+        self.assertEqual(first.vin, 'VIN1')
+        self.assertEqual(self.driver.current_window_handle, 'w1')
+        self.assertEqual(second.vin, 'VIN2')
+        self.assertEqual(self.driver.current_window_handle, 'w2')
+        first.vin = 'VIN3'
+        self.assertEqual((first.vin, second.vin), ('VIN3', 'VIN2'))
+        self.assertEqual((first.lookups, second.lookups), (1, 1))
+        self.assertEqual(self.driver.lookups, 2)
+
+    def test_same_tab(self):
+        """Using a page in the current tab shouldn't switch tabs"""
+        page = self.browser['5122'].page(VehiclePage)
+        page.vin = 'VIN1'
+        switches = self.driver.switches
+        self.assertEqual(page.vin, 'VIN1')
+        self.assertEqual(self.driver.switches, switches)
+
+
+if __name__ == '__main__':
+    unittest.main()
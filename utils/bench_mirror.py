@@ -0,0 +1,131 @@
+"""
+Benchmark random reads on a network mount against a local mirror
+
+The network mount is simulated with L{ThrottledFile}, which adds a fixed
+latency to every seek and read and caps the transfer rate.
+
+Usage: python bench_mirror.py DATAFILE [LOOKUPS] [LATENCY_MS]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from mkeyed import MKEYEDReader
+from mkeyed_mirror import MKEYEDMirror
+
+
+class ThrottledFile(object):
+    """A file object that behaves like one on a slow network mount"""
+
+    def __init__(self, path, mode='rb', latency=0.002, bandwidth=50 << 20):
+        """
+        :param path: The local file to wrap.
+        :param mode: The file open mode.
+        :param latency: Seconds added to each seek and read.
+        :param bandwidth: Bytes per second transfered by reads.
+        """
+        self._f = open(path, mode)
+        self.name = self._f.name
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.round_trips = 0
+
+    def seek(self, offset, whence=0):
+        # A seek is only a round trip if it moves away from where we are
+        if offset != self._f.tell() or whence:
+            self.round_trips += 1
+            time.sleep(self.latency)
+        return self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.round_trips += 1
+        time.sleep(self.latency + float(len(data)) / self.bandwidth)
+        return data
+
+    def close(self):
+        self._f.close()
+
+
+def timed(func, *args):
+    """Return the result of calling func and the seconds it took"""
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def lookups(reader, keys):
+    """Read every key, returning the number of records read"""
+    for key in keys:
+        reader.read(key)
+    return len(keys)
+
+
+def main(datafile, count=200, latency=0.002):
+    workdir = tempfile.mkdtemp(prefix='bench-mirror-')
+    try:
+        # A private copy stands in for the remote file, so we can change it
+        remote = os.path.join(workdir, 'REMOTE')
+        shutil.copyfile(datafile, remote)
+
+        def throttled(path, mode='rb'):
+            return ThrottledFile(path, mode, latency)
+
+        reader = MKEYEDReader(remote)
+        keys = [key for key, _ in reader.getIndex().cursor()]
+        reader.close()
+        keys = random.sample(keys, min(count, len(keys)))
+
+        remote_reader = MKEYEDReader(throttled(remote))
+        _, remote_time = timed(lookups, remote_reader, keys)
+        round_trips = remote_reader._f.round_trips
+        remote_reader.close()
+
+        mirror = MKEYEDMirror(
+            remote, os.path.join(workdir, 'mirror'), opener=throttled)
+        copied, copy_time = timed(mirror.refresh)
+        _, noop_time = timed(mirror.refresh)
+
+        mirror_reader = mirror.open(refresh=False)
+        _, mirror_time = timed(lookups, mirror_reader, keys)
+        mirror_reader.close()
+
+        # Change one byte in the middle of the file and refresh again
+        with open(remote, 'r+b') as f:
+            f.seek(os.path.getsize(remote) // 2)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(chr((ord(byte) + 1) % 256))
+        os.utime(remote, None)
+        changed, update_time = timed(mirror.refresh)
+
+        print("File size:            {0} bytes".format(
+            os.path.getsize(remote)))
+        print("Random lookups:       {0}".format(len(keys)))
+        print("Remote lookups:       {0:.3f}s ({1} round trips)".format(
+            remote_time, round_trips))
+        print("Initial mirror copy:  {0:.3f}s ({1} chunks)".format(
+            copy_time, copied))
+        print("Unchanged refresh:    {0:.3f}s".format(noop_time))
+        print("Mirror lookups:       {0:.3f}s".format(mirror_time))
+        print("Refresh after change: {0:.3f}s ({1} chunks)".format(
+            update_time, changed))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark a network mount against a local mirror")
+    parser.add_argument('datafile', help="the MKEYED file to benchmark")
+    parser.add_argument('lookups', type=int, nargs='?', default=200)
+    parser.add_argument('latency_ms', type=float, nargs='?', default=2.0)
+    args = parser.parse_args()
+    main(args.datafile, args.lookups, args.latency_ms / 1000)
@@ -0,0 +1,70 @@
+"""
+Benchmark MKEYEDWriter batch serialization: repr() against the framed format
+
+Times building a batch request, parsing it on the receiving end, and
+parsing the reply, for each wire format.  The repr() request is parsed with
+ast.literal_eval, the safe equivalent of what a Python receiver would do.
+No writer process is run, so only serialization cost is measured.
+
+Usage: python bench_writer.py [RECORDS ...]
+"""
+
+import ast
+import sys
+from timeit import default_timer
+
+from mkeyed import (
+    decodeWriteReply, decodeWriteRequest, encodeWriteReply,
+    encodeWriteRequest)
+from mkeyed_gen import MKEYEDGenerator
+
+
+def make_batch(count):
+    """Return count write requests like MKEYEDWriter queues them"""
+    generator = MKEYEDGenerator(count)
+    batch = []
+    for i in xrange(count):
+        request = {"filename": "AGPPI", "key": generator.key(i),
+                   "record": generator.record(i), "numcount": "0"}
+        if i % 3 == 0:
+            request["numerics"] = str([i, i * 0.5])
+            request["numcount"] = "2"
+        batch.append(request)
+    return batch
+
+
+def timed(func, *args):
+    start = default_timer()
+    result = func(*args)
+    return result, default_timer() - start
+
+
+def bench_repr(batch):
+    request, encode = timed(lambda: ((len(batch), 2) + (batch,)).__str__())
+    _, decode = timed(ast.literal_eval, request)
+    reply = repr('SUCCESS! %d' % len(batch))
+    _, parse_reply = timed(eval, reply)
+    return len(request), encode, decode, parse_reply
+
+
+def bench_framed(batch):
+    request, encode = timed(encodeWriteRequest, batch, 2)
+    _, decode = timed(decodeWriteRequest, request)
+    reply = encodeWriteReply([None] * len(batch))
+    _, parse_reply = timed(decodeWriteReply, reply)
+    return len(request), encode, decode, parse_reply
+
+
+def main(counts):
+    print("Records  Format  Bytes       Encode   Decode   Reply")
+    for count in counts:
+        batch = make_batch(count)
+        for name, bench in (('repr', bench_repr), ('framed', bench_framed)):
+            size, encode, decode, reply = bench(batch)
+            print("{0:7d}  {1:6}  {2:10d}  {3:6.3f}s  {4:6.3f}s  "
+                  "{5:6.3f}s".format(count, name, size, encode, decode,
+                                     reply))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,130 @@
+"""
+Stand-in for the SH.BBX.WRITE PRO5 program, for testing L{MKEYEDWriter}
+without PRO5.
+
+Requests are journaled instead of written to BBx files: every write or
+delete is appended as one JSON line to DIR/<filename>, so tests can check
+what was sent and in which order.  Both the repr() wire format and the
+framed one (see L{mkeyed.encodeWriteRequest}) are accepted.  In the framed
+format, requests with an empty key fail on their own.
+
+Without --session, one request is read up to a null byte and one reply is
+written, like SH.BBX.WRITE.  With --session, requests keep coming as
+frames of an 8 digit ASCII length followed by that many bytes, each
+answered with a frame, until a zero length frame or end of input.
+
+Usage: python fake_bbx_writer.py [--session] [--fail-after N] DIR
+"""
+
+import ast
+import json
+import os
+import sys
+
+from mkeyed import WIRE_MAGIC, decodeWriteRequest, encodeWriteReply
+
+LENGTH_DIGITS = 8
+
+
+def read_exactly(stream, size):
+    """Read size bytes, or fewer only at end of input"""
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def write_frame(stream, payload):
+    stream.write(('%0*d' % (LENGTH_DIGITS, len(payload))).encode('ascii'))
+    stream.write(payload)
+    stream.flush()
+
+
+def journal(datadir, batch):
+    """Append each request in the batch to its file's journal"""
+    for request in batch:
+        path = os.path.join(datadir, request['filename'])
+        entry = {'key': request['key'], 'record': request['record']}
+        if request.get('numerics'):
+            entry['numerics'] = ast.literal_eval(request['numerics'])
+        entry['op'] = 'write' if request['record'] else 'delete'
+        with open(path, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def handle_framed(datadir, payload):
+    """Process one framed request, return the reply"""
+    try:
+        _, batch = decodeWriteRequest(payload)
+    except ValueError as e:
+        return ('ERROR: %s' % e).encode('latin-1')
+    errors = []
+    for request in batch:
+        if not request['key']:
+            errors.append('empty key')
+        else:
+            journal(datadir, [request])
+            errors.append(None)
+    return encodeWriteReply(errors)
+
+
+def handle(datadir, payload):
+    """Process one request, return the reply"""
+    if payload.startswith(WIRE_MAGIC + ' '):
+        return handle_framed(datadir, payload)
+    try:
+        count, _, batch = ast.literal_eval(payload.decode('latin-1'))
+        if count != len(batch):
+            raise ValueError("%d requests for a count of %d" %
+                             (len(batch), count))
+        journal(datadir, batch)
+    except Exception as e:
+        reply = 'ERROR: %s' % e
+    else:
+        reply = 'SUCCESS! %d' % len(batch)
+    return repr(reply).encode('latin-1')
+
+
+def main(argv):
+    session = '--session' in argv
+    args = [arg for arg in argv if arg != '--session']
+    fail_after = None
+    if '--fail-after' in args:
+        i = args.index('--fail-after')
+        fail_after = int(args[i + 1])
+        del args[i:i + 2]
+    if len(args) != 1:
+        sys.stderr.write(__doc__)
+        return 2
+    datadir = args[0]
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    if not session:
+        payload = stdin.read()
+        if not payload.startswith(WIRE_MAGIC + ' '):
+            payload = payload.rstrip(b'\x00')
+        stdout.write(handle(datadir, payload))
+        stdout.flush()
+        return 0
+
+    handled = 0
+    while True:
+        header = read_exactly(stdin, LENGTH_DIGITS)
+        if len(header) < LENGTH_DIGITS or not int(header):
+            return 0
+        payload = read_exactly(stdin, int(header))
+        if fail_after is not None and handled >= fail_after:
+            # Act like a crashed interpreter
+            return 1
+        write_frame(stdout, handle(datadir, payload))
+        handled += 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+# vi: set tabstop=4 expandtab textwidth=80 filetype=python:
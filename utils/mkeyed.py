@@ -5,9 +5,15 @@ Python utilities for reading and writing MKEYED files
 @author: Equity Insurance Group
 """
 
+import base64
+import hashlib
+import math
 import struct
+import threading
+import time
+from timeit import default_timer
 from bisect import bisect_left
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from struct import unpack
 from subprocess import Popen, PIPE
 from bbpy.util import convIntFromString
@@ -41,6 +47,51 @@ def log(fmt, *args, **kwargs):
     pass
 
 
+ScanToken = namedtuple('ScanToken', ['keynum', 'lastkey', 'path'])
+
+# Version, keynum, has last key, path length; then (address, step) per block
+SCAN_TOKEN_HEADER = struct.Struct("!BBBB")
+SCAN_TOKEN_STEP = struct.Struct("!QL")
+SCAN_TOKEN_VERSION = 1
+
+
+def encodeScanToken(keynum, lastkey, path=()):
+    """Pack a scan position into a URL-safe string.
+
+    :param keynum: The keynum of the index scanned.
+    :param lastkey: The last key returned, or None.
+    :param path: (block address, step) pairs from the root block down.
+    :return: The token.
+    """
+    data = [SCAN_TOKEN_HEADER.pack(
+        SCAN_TOKEN_VERSION, keynum, lastkey is not None, len(path))]
+    data.extend(SCAN_TOKEN_STEP.pack(address, step) for address, step in path)
+    data.append(lastkey or "")
+    return base64.urlsafe_b64encode("".join(data))
+
+
+def decodeScanToken(token):
+    """Unpack a token made by L{encodeScanToken}.
+
+    :return: A L{ScanToken}.
+    :raises BBPyScanTokenError: If the token is damaged or unknown.
+    """
+    try:
+        data = base64.urlsafe_b64decode(str(token))
+        version, keynum, haskey, depth = SCAN_TOKEN_HEADER.unpack_from(data)
+        if version != SCAN_TOKEN_VERSION:
+            raise BBPyScanTokenError("Unknown scan token version %d" % version)
+        offset = SCAN_TOKEN_HEADER.size
+        path = []
+        for _ in xrange(depth):
+            path.append(SCAN_TOKEN_STEP.unpack_from(data, offset))
+            offset += SCAN_TOKEN_STEP.size
+    except (TypeError, ValueError, struct.error) as e:
+        raise BBPyScanTokenError("Bad scan token: %s" % e)
+    lastkey = data[offset:] if haskey else None
+    return ScanToken(keynum, lastkey, tuple(path))
+
+
 class MKEYEDReader(object):
     """Reader for MKEYED data files
 
@@ -55,12 +106,19 @@ class MKEYEDReader(object):
         each item in this list is a member of a primary key.  But since we
         are using BBx records, it contains each definition uses the offset
         and length of the key field data.
+    :ivar _bloom: An optional L{MKEYEDBloomFilter} checked before
+        searching the index for a key
     :ivar _currentkey: The last key returned.
     :ivar _cursor_spec: The parameters used to initialize the cursor
     :ivar _cursor: A read cursor that will return the next key, record
     :ivar _filelength: The length of the file in bytes (not currently used)
+    :ivar _header: Every value of the MKEYED header, as last read
     :ivar _indexblocks: A list of the file offsets (addresses) of the
         index blocks
+    :ivar _stats: Optional L{MKEYEDIOStats} counters, see
+        L{enableInstrumentation}
+    :ivar _recordcache: An optional L{MKEYEDRecordCache} of decoded records
+    :ivar _validated: When the header was last checked for changes
     :ivar _keycount: The number of keys in the MKEYED file, should == len(keys)
     :ivar _keysize: The size in characters of a record key, this is not always
         accurate.  Use self.getKeylength() to always get the accurate keysize.
@@ -72,7 +130,8 @@ class MKEYEDReader(object):
     :ivar _recordsize: The total size in bytes of a record
     :ivar _type: The filetype of the data file opened (should be FT_MKEYED)
 
-    :group Public Methods: open, close, find, read*, getStats, getKeylength
+    :group Public Methods: open, close, find, read*, resume, scanToken,
+        getStats, getKeylength
     :group Support Methods: next, __*__, _set*, _split*, _*MKEYED*, _check*,
         _readFileHeader
     """
@@ -103,6 +162,10 @@ class MKEYEDReader(object):
         self._addressexclusions = set()
         self._constants = {}
         self._indexes = {}
+        self._bloom = None
+        self._recordcache = None
+        self._validated = 0
+        self._stats = None
 
         # Open the BBx Data file
         self.open(f, mode)
@@ -178,15 +241,20 @@ class MKEYEDReader(object):
 
     def readGenerator(
             self, key=None, keynum=None, field=0, numerics=False,
-            stripzeros=False):
+            stripzeros=False, token=None):
         """
         Create a read generator.
         :param field: field specifies the field of the record to return, this
             is for numerics
         :param numerics: Specifies if numerics should be returned with the
             string record.  If True, then the L{field} parameter is ignored.
+        :param token: Continue a scan saved with L{scanToken} instead of
+            starting at the key.
         :return: A generator
         """
+        if token is not None:
+            self.resume(token, keynum, stripzeros=stripzeros, readAll=True)
+            key = keynum = None
         data = self.readRecord(
             key=key, keynum=keynum, stripzeros=stripzeros, readAll=True)
         while data:
@@ -199,6 +267,108 @@ class MKEYEDReader(object):
             except (BBPyKeyNotFoundError, MKEYEDReaderEOF):
                 raise StopIteration
 
+    def readBatches(
+            self, key="", batch_size=1000, keynum=None, field=0,
+            numerics=False, stripzeros=False, keysonly=False, reuse=False,
+            nonumerics=False):
+        """
+        Read all records matching the key, in lists of batch_size records.
+
+        Unlike readAll, memory use is bounded by the batch size.  Unlike
+        readGenerator, the index is walked directly and each batch's records
+        are read in file order, which saves seeks and per-record overhead.
+
+        :note: readBatches() does not touch the current key pointer.
+        :param key: The full or partial key to match.  "" matches every
+            record in the file.
+        :param batch_size: The most records in one batch.
+        :param keynum: Keynum refers to which key in an MKEYED file the key
+            should be searched on.
+        :param field: field specifies the field of the record to return, this
+            is for numerics
+        :param numerics: Specifies if numerics should be returned with the
+            string record.  If True, then the L{field} parameter is ignored.
+        :param keysonly: Return the keys instead of records.
+        :param reuse: Refill the same list for every batch.  The caller must
+            be done with a batch before asking for the next one.
+        :param nonumerics: Don't force fields after the first to numerics
+        :return: A generator of lists, in key order.
+        """
+        if keynum is not None:
+            self._setKeyNum(keynum)
+        if not self._recordcount:
+            return
+
+        entries = []
+        batch = []
+        for entry in self.getIndex().cursor(key or None):
+            if key and not entry[0].startswith(key):
+                break
+            entries.append(entry)
+            if len(entries) == batch_size:
+                self._fillBatch(
+                    batch, entries, field, numerics, stripzeros, keysonly,
+                    nonumerics)
+                yield batch
+                del entries[:]
+                if reuse:
+                    del batch[:]
+                else:
+                    batch = []
+        if entries:
+            self._fillBatch(
+                batch, entries, field, numerics, stripzeros, keysonly,
+                nonumerics)
+            yield batch
+
+    def readChunk(
+            self, key="", size=1000, token=None, keynum=None, field=0,
+            numerics=False, stripzeros=False, keysonly=False):
+        """
+        Read one chunk of the records matching the key, and a token for the
+        next chunk.
+
+        A long scan can be split into chunks that are read one at a time,
+        by different processes if need be, by passing each returned token
+        (and the same key) to the next call.
+
+        :note: readChunk() does not touch the current key pointer.
+        :param key: The full or partial key to match.  "" matches every
+            record in the file.
+        :param size: The most records in the chunk.
+        :param token: The token returned with the previous chunk, or None
+            for the first chunk.
+        :param keynum: Keynum refers to which key in an MKEYED file the key
+            should be searched on.
+        :param field: See L{readBatches}.
+        :param numerics: See L{readBatches}.
+        :param keysonly: Return the keys instead of records.
+        :return: (records, token) with the records in key order.  token is
+            None once there are no records left.
+        """
+        if keynum is not None:
+            self._setKeyNum(keynum)
+        if not self._recordcount:
+            return [], None
+
+        index = self.getIndex()
+        if token is None:
+            cursor = index.cursor(key or None)
+        else:
+            cursor = index.resume(token)
+        entries = []
+        token = None
+        for entry in cursor:
+            if key and not entry[0].startswith(key):
+                break
+            entries.append(entry)
+            if len(entries) == size:
+                token = cursor.token()
+                break
+        batch = []
+        self._fillBatch(batch, entries, field, numerics, stripzeros, keysonly)
+        return batch, token
+
     def find(self, key=None, keynum=None, field=0):
         """\
         find() acts just like read() with one exception.  Current key pointer
@@ -248,6 +418,21 @@ class MKEYEDReader(object):
         result = self.readRecord(key, keynum)
         return result[field]
 
+    def readAddress(self, address, stripzeros=False, nonumerics=False):
+        """Return the record stored at a file address as a tuple of fields.
+
+        :note: readAddress() does not touch the current key pointer, so it
+            can be used while walking an index cursor.
+        :param address: The record address, as found in an index entry.
+        :param stripzeros: This will strip off the last field as long as it
+            only contains '\x00's
+        :param nonumerics: Don't force fields after the first to numerics
+        :return: The record as a tuple of fields
+        :raises BBPyKeyNotFoundError: BBPyKeyNotFoundError if the address is
+            null
+        """
+        return self._readDecoded(address, stripzeros, nonumerics)
+
     # Parameters when a cursor is initialized
     CursorSpec = namedtuple(
         'CursorSpec', ['key', 'keynum', 'stripzeros', 'readAll', 'nonumerics'])
@@ -292,6 +477,14 @@ class MKEYEDReader(object):
                 spec_key = self._cursor_spec.key
             except AttributeError:
                 spec_key = None
+        if (key is not None and self._bloom is not None and
+                self._bloom.keynum == keynum and
+                not self._bloom.mayContain(key)):
+            # Nothing starts with this key, skip the index search
+            self._cursor_spec, self._cursor = None, None
+            message = "The requested key (%s) is not in the data file: %s."
+            raise BBPyKeyNotFoundError(key, message % (key, self.filename))
+
         new_cursorspec = self.CursorSpec(
             spec_key, keynum, stripzeros, readAll, nonumerics)
         if self._cursor_spec != new_cursorspec:
@@ -306,15 +499,12 @@ class MKEYEDReader(object):
 
         if key is None or (found_key is not None and found_key == key):
             # If the key we found == the key we are searching for, we're good
-            data = self._readMKEYEDRecord(found_addr)
-
-            # split our data into fields
+            # read the record and split our data into fields
             if readAll:
                 return ((found_key, found_addr),
-                        self._splitRecordIntoFields(data, stripzeros))
+                        self._readDecoded(found_addr, stripzeros))
             else:
-                return self._splitRecordIntoFields(
-                    data, stripzeros, nonumerics=nonumerics)
+                return self._readDecoded(found_addr, stripzeros, nonumerics)
 
         elif found_key is not None and found_key.startswith(key):
             # If they are not equal but what we found starts with our search
@@ -381,9 +571,181 @@ class MKEYEDReader(object):
             # equivalent of EOFError
             raise StopIteration
 
-    def getStats(self):
-        """Returns a tuple of the keysize, record count, and record size."""
-        return (self.getKeylength(), self._recordcount, self._recordsize)
+    def scanToken(self):
+        """\
+        Return a token for the current key pointer, see L{resume}.
+
+        :return: A string, or None if nothing has been read yet.
+        """
+        if self._cursor is None:
+            return None
+        return self._cursor.token()
+
+    def resume(
+            self, token, keynum=None, stripzeros=False, readAll=False,
+            nonumerics=False):
+        """\
+        Move the current key pointer to where a saved scan stopped.
+
+        The next readRecord() (with no key and the same stripzeros, readAll
+        and nonumerics arguments) or read() returns the record after the
+        last one read before L{scanToken} was called.
+
+        :note: resume() modifies the current key pointer.
+        :param token: A token from L{scanToken} or L{readChunk}.
+        :param keynum: The keynum the token is for.
+        :raises BBPyScanTokenError: If the token can't be used with this file.
+        """
+        if keynum is not None:
+            self._setKeyNum(keynum)
+        self._cursor = self.getIndex().resume(token)
+        self._cursor_spec = self.CursorSpec(
+            None, self.keynum, stripzeros, readAll, nonumerics)
+        self._currentkey = self._cursor.lastkey
+
+    def getStats(self, extended=False):
+        """Returns a tuple of the keysize, record count, and record size.
+
+        :param extended: Return a dict that also includes the counters of
+            the optional lookup helpers.
+        """
+        if not extended:
+            return (self.getKeylength(), self._recordcount, self._recordsize)
+
+        stats = {
+            'keylength': self.getKeylength(),
+            'recordcount': self._recordcount,
+            'recordsize': self._recordsize,
+        }
+        if self._bloom is not None:
+            stats['bloom_checks'] = self._bloom.checks
+            stats['bloom_saved'] = self._bloom.saved
+        if self._recordcache is not None:
+            stats['cache_hits'] = self._recordcache.hits
+            stats['cache_misses'] = self._recordcache.misses
+            stats['cache_size'] = len(self._recordcache)
+        if self._stats is not None:
+            stats.update(self._stats.asDict())
+        return stats
+
+    def enableInstrumentation(self):
+        """\
+        Start counting I/O and decoding work: seeks, bytes read and time
+        spent reading, index blocks decoded, tree depth per lookup, records
+        split and numeric conversions.  The counters are reported by
+        getStats(extended=True).
+
+        Without instrumentation, the only cost left is a None check in the
+        counted methods.
+
+        :return: The L{MKEYEDIOStats} being updated.
+        """
+        if self._stats is None:
+            self._stats = MKEYEDIOStats()
+            self._f = MKEYEDInstrumentedFile(self._f, self._stats)
+            for index in self._indexes.values():
+                if isinstance(index, MKEYEDIndex):
+                    index.mkeyed_file = self._f
+                    index.stats = self._stats
+        return self._stats
+
+    def disableInstrumentation(self):
+        """Stop counting and unwrap the data file."""
+        if self._stats is not None:
+            self._f = self._f.wrapped
+            for index in self._indexes.values():
+                if isinstance(index, MKEYEDIndex):
+                    index.mkeyed_file = self._f
+                    index.stats = None
+            self._stats = None
+
+    def profile(self, enabled=True):
+        """\
+        Return a context manager measuring the work done inside it.
+
+        :param enabled: If False the profile does nothing, so callers can
+            leave the with statement in place.
+        :return: A L{MKEYEDProfile}.
+        """
+        return MKEYEDProfile(self, enabled)
+
+    def enableRecordCache(self, size=1024, validate_interval=1.0):
+        """\
+        Keep the most recently read records decoded, by record address.
+
+        The cache is dropped when the file header shows records were added
+        or removed.  The header is checked at most every validate_interval
+        seconds, so a change can go unnoticed for that long.
+
+        :param size: The maximum number of decoded records to keep.
+        :param validate_interval: Seconds between checks of the header.
+        """
+        self._recordcache = MKEYEDRecordCache(size, validate_interval)
+        self._validated = time.time()
+
+    def disableRecordCache(self):
+        """Stop caching decoded records."""
+        self._recordcache = None
+
+    def refreshHeader(self):
+        """\
+        Re-read the MKEYED header and drop everything decoded from the file
+        if it changed.
+
+        :return: True if the header changed.
+        """
+        stamp = self._headerStamp()
+        # Drop any buffered data so the header is read from the file
+        if hasattr(self._f, "flush"):
+            self._f.flush()
+        self._readMKEYEDHeader()
+        self._validated = time.time()
+        if stamp == self._headerStamp():
+            return False
+        self._indexes = {}
+        self._bloom = None
+        if self._recordcache is not None:
+            self._recordcache.clear()
+        return True
+
+    def buildBloomFilter(self, fp_rate=0.01, prefixes=(), path=None):
+        """\
+        Build a Bloom filter from the keys of the current index and use it
+        to answer lookups for missing keys without searching the index.
+
+        :param fp_rate: The target rate of false positives, the fraction of
+            missing keys that still need an index search.
+        :param prefixes: Partial key lengths to add as well, so lookups of
+            partial keys of these lengths can also be answered.
+        :param path: If given, save the filter to this sidecar file.
+        :return: The L{MKEYEDBloomFilter}.
+        """
+        bloom = MKEYEDBloomFilter(
+            len(self), fp_rate, self.keynum, self.getKeylength(), prefixes,
+            self._headerStamp())
+        for key, _ in self.getIndex().cursor():
+            bloom.add(key)
+        if path:
+            bloom.save(path)
+        self._bloom = bloom
+        return bloom
+
+    def loadBloomFilter(self, path):
+        """\
+        Use a Bloom filter saved by L{buildBloomFilter}.
+
+        :param path: The sidecar file holding the filter.
+        :return: The L{MKEYEDBloomFilter}.
+        :raises BBPyBloomFilterError: BBPyBloomFilterError if the filter was
+            built for a different version of the data file.
+        """
+        bloom = MKEYEDBloomFilter.load(path)
+        if bloom.stamp != self._headerStamp():
+            raise BBPyBloomFilterError(
+                "%s was built for a different version of %s." %
+                (path, self.filename))
+        self._bloom = bloom
+        return bloom
 
     def getKeylength(self):
         """\
@@ -500,6 +862,7 @@ class MKEYEDReader(object):
         data = f.read(self._constants['header_size'])
         header = struct.unpack(self._constants['header_layout'], data)
 
+        self._header = header
         self._keycount = header[0]
         self._nextaddr = header[2]
         # the normal header has recordcount of zero for MKEYED files
@@ -551,6 +914,46 @@ class MKEYEDReader(object):
             raise BBPyKeyNotFoundError
         return self._f.read(self._recordsize)
 
+    def _headerStamp(self):
+        """Return header values that change whenever records are added"""
+        return (self._nextaddr, self._recordcount, self._filelength)
+
+    def _readDecoded(self, address, stripzeros=False, nonumerics=False):
+        """Read and split a record, going through the record cache"""
+        cache = self._recordcache
+        if cache is None:
+            return self._splitRecordIntoFields(
+                self._readMKEYEDRecord(address), stripzeros,
+                nonumerics=nonumerics)
+
+        if time.time() - self._validated > cache.validate_interval:
+            self.refreshHeader()
+        cachekey = (address, stripzeros, nonumerics)
+        result = cache.get(cachekey)
+        if result is None:
+            result = self._splitRecordIntoFields(
+                self._readMKEYEDRecord(address), stripzeros,
+                nonumerics=nonumerics)
+            cache.put(cachekey, result)
+        return result
+
+    def _fillBatch(
+            self, batch, entries, field, numerics, stripzeros, keysonly,
+            nonumerics=False):
+        """Add the records (or keys) for index entries to a batch"""
+        if keysonly:
+            batch.extend([key for key, _ in entries])
+            return
+        # Read in address order, then put the records back in key order
+        records = [None] * len(entries)
+        for i in sorted(xrange(len(entries)), key=lambda i: entries[i][1]):
+            records[i] = self._readDecoded(
+                entries[i][1], stripzeros, nonumerics)
+        if numerics:
+            batch.extend(records)
+        else:
+            batch.extend([record[field] for record in records])
+
     def _setKeyNum(self, keynum):
         """Set the current keynum and clear cursor parameters."""
         if keynum != self.keynum:
@@ -565,9 +968,25 @@ class MKEYEDReader(object):
         if keynum not in self._indexes:
             self._indexes[keynum] = MKEYEDIndex(
                 keynum, self._f, self.getKeylength(),
-                self._indexblocks[keynum], self._constants['addr_size'])
+                self._indexblocks[keynum], self._constants['addr_size'],
+                self._stats)
         return self._indexes[keynum]
 
+    def setIndex(self, index, keynum=None):
+        """\
+        Use a prebuilt index for a keynum instead of decoding index blocks.
+
+        :param index: Any object with an L{MKEYEDIndex}-compatible cursor()
+            method, such as a shared memory index.
+        :param keynum: The keynum the index is for.  Defaults to the current
+            keynum.
+        """
+        if keynum is None:
+            keynum = self.keynum
+        self._indexes[keynum] = index
+        if keynum == self.keynum:
+            self._cursor, self._cursor_spec = None, None
+
     def _splitRecordIntoFields(self, data, stripzeros=False, nonumerics=False):
         """Split a MKEYED record into the delimited fields
         :param data: Data to read
@@ -585,6 +1004,7 @@ class MKEYEDReader(object):
         # We now have a nonumerics for all fields in case we don't
         # want the conversion at all
         result.append(fields[0])
+        stats = self._stats
         for x in fields[1:]:
             if nonumerics:
                 result.append(x)
@@ -598,6 +1018,11 @@ class MKEYEDReader(object):
                 # this is valid data or not.  The application needs to
                 # handle it.
                 result.append(f)
+        # Counted afterwards, so reads without instrumentation don't pay
+        # for it
+        if stats is not None and not nonumerics:
+            stats.numeric_conversions += sum(
+                1 for f in result[1:] if type(f) is float)
 
         if stripzeros:
             tmp = map(lambda x: x == '\x00', result[-1])
@@ -609,6 +1034,9 @@ class MKEYEDReader(object):
         if not result:
             result = ('', ())
 
+        if stats is not None:
+            stats.records_split += 1
+
         return result  # This is read-only
 
 
@@ -625,7 +1053,8 @@ class MKEYEDIndex(object):
     """
 
     def __init__(
-            self, keynum, mkeyed_file, keylength, root_address, pointer_size):
+            self, keynum, mkeyed_file, keylength, root_address, pointer_size,
+            stats=None):
         """Initialize a L{MKEYEDIndex} instance.
 
         :param keynum: The number of this key index
@@ -633,12 +1062,15 @@ class MKEYEDIndex(object):
         :param keylength: The length of keys in this index.
         :param root_address: The address of the root index block.
         :param ptr_size: The size of address pointers in this MKEYED file.
+        :param stats: Optional L{MKEYEDIOStats} to count decoded blocks and
+            lookup depths in.
         """
         self.keynum = keynum
         self.mkeyed_file = mkeyed_file
         self.keylength = keylength
         self.root_address = root_address
         self.pointer_size = pointer_size
+        self.stats = stats
         self.blocks = {}
 
     def get_block(self, block_address=None):
@@ -650,7 +1082,8 @@ class MKEYEDIndex(object):
         address = block_address or self.root_address
         if address not in self.blocks:
             self.blocks[address] = MKEYEDIndexBlock(
-                self.mkeyed_file, self.keylength, address, self.pointer_size)
+                self.mkeyed_file, self.keylength, address, self.pointer_size,
+                self.stats)
         return self.blocks[address]
 
     EdgeResult = namedtuple(
@@ -695,39 +1128,152 @@ class MKEYEDIndex(object):
             block = self.get_block(result.next_index)
             result = block.find(searchkey)
             positions.append(result.pos)
+        if self.stats is not None:
+            self.stats.countLookup(len(positions))
         return self.FindResult(tuple(positions), *result[1:])
 
     def cursor(self, searchkey=None):
         """Return (key, record_ptr) pairs starting at searchkey
 
         :param searchkey: A full key, partial key, or None
-        :return the first key, record_ptr pair after the searchkey
+        :return an L{MKEYEDIndexCursor} over the first key, record_ptr pair
+            after the searchkey
+        """
+        return MKEYEDIndexCursor(self, self._path(searchkey)[0])
+
+    def resume(self, token):
+        """Continue a scan saved with L{MKEYEDIndexCursor.token}.
+
+        If the blocks on the saved path have changed since the token was
+        made, the scan continues after the last key returned instead, found
+        by searching the index.  In an index with duplicate keys, that can
+        return entries with the last key again.
+
+        :param token: A token string.
+        :return an L{MKEYEDIndexCursor} over the entries after the last one
+            returned before the token was made.
+        :raises BBPyScanTokenError: If the token can't be read or is for
+            another index.
+        """
+        scan = decodeScanToken(token)
+        if scan.keynum != self.keynum:
+            raise BBPyScanTokenError(
+                "Token is for key %d, not key %d" % (scan.keynum, self.keynum))
+        path = self._checkPath(scan.path, scan.lastkey)
+        if path is None:
+            path, exact = self._path(scan.lastkey)
+            if exact:
+                # Skip the last key returned
+                path[-1][1] += 1
+        return MKEYEDIndexCursor(self, path, scan.lastkey)
+
+    def _path(self, searchkey=None):
+        """Return the path to searchkey for a cursor, and whether it was found
+
+        :return ([[block, step], ...], found)
         """
         if searchkey is None:
             result = self.first()
+            found = False
         else:
             result = self.find(searchkey)
-        positions = result.positions
-        block_tree = []
+            found = bool(result.record_ptr)
+        path = []
         block = self.get_block()
-        for position in positions:
-            block_tree.append(block.iterator(position))
+        for position in result.positions:
+            path.append([block, position * 2 + 1])
             next_index = block.index_ptrs[position]
             if next_index:
                 block = self.get_block(next_index)
+        return path, found
 
-        while block_tree:
-            try:
-                item = block_tree[-1].next()
-            except StopIteration:
-                block_tree.pop()
-            else:
-                if isinstance(item, MKEYEDIndexBlock.KeyResult):
-                    yield item
-                else:
-                    assert isinstance(item, MKEYEDIndexBlock.IndexResult)
-                    block = self.get_block(item.index_ptr)
-                    block_tree.append(block.iterator())
+    def _checkPath(self, saved, lastkey):
+        """Return a saved path as [[block, step], ...] if it is still valid
+
+        Every block has to be the one its parent points to now, and the last
+        block has to hold the last key returned where the path says.
+
+        :return The path, or None.
+        """
+        if not saved:
+            return None
+        path = []
+        address = self.root_address
+        for depth, (block_address, step) in enumerate(saved):
+            if block_address != address:
+                return None
+            block = self.get_block(block_address)
+            if not 0 <= step <= 2 * len(block.keys) + 1:
+                return None
+            path.append([block, step])
+            if depth < len(saved) - 1:
+                # A block below this one was entered from an odd step
+                if not step % 2:
+                    return None
+                address = block.index_ptrs[step // 2]
+        block, step = path[-1]
+        if lastkey is not None and (
+                step % 2 or not step or block.keys[step // 2 - 1] != lastkey):
+            return None
+        return path
+
+
+class MKEYEDIndexCursor(object):
+    """
+    Walks an L{MKEYEDIndex} in key order, returning (key, record_ptr) pairs
+
+    The position is kept as the path of index blocks from the root to the
+    current block, with a step in each.  Even steps 2n are the index block
+    before key n, odd steps 2n + 1 are key n.  L{token} saves the path and
+    the last key returned so the walk can be continued later, from another
+    reader or process, with L{MKEYEDIndex.resume}.
+
+    :ivar index: The L{MKEYEDIndex} walked.
+    :ivar lastkey: The last key returned, or None.
+    """
+
+    def __init__(self, index, path, lastkey=None):
+        """
+        :param index: The L{MKEYEDIndex} to walk.
+        :param path: A list of [L{MKEYEDIndexBlock}, step] lists from the
+            root block down.
+        :param lastkey: The last key returned before this position.
+        """
+        self.index = index
+        self.lastkey = lastkey
+        self._path = path
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return the next L{MKEYEDIndexBlock.KeyResult}"""
+        path = self._path
+        while path:
+            frame = path[-1]
+            block, step = frame
+            pos = step // 2
+            if step % 2:
+                if pos >= len(block.keys):
+                    path.pop()
+                    continue
+                frame[1] = step + 1
+                self.lastkey = block.keys[pos]
+                return MKEYEDIndexBlock.KeyResult(
+                    self.lastkey, block.record_ptrs[pos])
+            frame[1] = step + 1
+            index_ptr = block.index_ptrs[pos]
+            if index_ptr:
+                path.append([self.index.get_block(index_ptr), 0])
+        raise StopIteration
+
+    __next__ = next
+
+    def token(self):
+        """Return the position as a string for L{MKEYEDIndex.resume}"""
+        return encodeScanToken(
+            self.index.keynum, self.lastkey,
+            [(block.start, step) for block, step in self._path])
 
 
 class MKEYEDIndexBlock(object):
@@ -760,8 +1306,10 @@ class MKEYEDIndexBlock(object):
     block may be scanned many times.
     """
 
-    def __init__(self, mkeyed_file, keylength, start, ptr_size):
+    def __init__(self, mkeyed_file, keylength, start, ptr_size, stats=None):
         """Read the index block at this location."""
+        if stats is not None:
+            stats.blocks_decoded += 1
         self.start = start
         layout1, layout2 = {
             4: ('!BL', '!LL'),
@@ -934,29 +1482,495 @@ class MKEYEDIndexBlock(object):
                 pos += 1
 
 
+class MKEYEDIOStats(object):
+    """
+    Counters for the work done by an instrumented L{MKEYEDReader}
+
+    :ivar seeks: Seeks that moved the file position.
+    :ivar reads: Calls to read the file.
+    :ivar bytes_read: Bytes returned by those reads.
+    :ivar read_time: Seconds spent in seeks and reads.
+    :ivar blocks_decoded: Index blocks read and decoded.
+    :ivar lookups: Key searches through the index tree.
+    :ivar lookup_depth: Index blocks visited by all key searches.
+    :ivar max_depth: The most index blocks visited by one key search.
+    :ivar records_split: Records split into fields.
+    :ivar numeric_conversions: Fields converted to numerics.
+    """
+
+    COUNTERS = (
+        "seeks", "reads", "bytes_read", "read_time", "blocks_decoded",
+        "lookups", "lookup_depth", "max_depth", "records_split",
+        "numeric_conversions")
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+
+    def countLookup(self, depth):
+        """Count a key search that visited depth index blocks"""
+        self.lookups += 1
+        self.lookup_depth += depth
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def asDict(self):
+        """Return the counters as a dict"""
+        return dict((name, getattr(self, name)) for name in self.COUNTERS)
+
+
+class MKEYEDInstrumentedFile(object):
+    """Wrap a data file to count seeks, reads and the time they take"""
+
+    def __init__(self, wrapped, stats):
+        self.wrapped = wrapped
+        self.stats = stats
+        self.name = getattr(wrapped, "name", "StringIO")
+
+    def seek(self, offset, whence=0):
+        stats = self.stats
+        start = default_timer()
+        if whence or offset != self.wrapped.tell():
+            stats.seeks += 1
+        result = self.wrapped.seek(offset, whence)
+        stats.read_time += default_timer() - start
+        return result
+
+    def read(self, size=-1):
+        stats = self.stats
+        start = default_timer()
+        data = self.wrapped.read(size)
+        stats.read_time += default_timer() - start
+        stats.reads += 1
+        stats.bytes_read += len(data)
+        return data
+
+    def tell(self):
+        return self.wrapped.tell()
+
+    def flush(self):
+        return self.wrapped.flush()
+
+    def close(self):
+        return self.wrapped.close()
+
+
+class MKEYEDProfile(object):
+    """
+    Measure the work an L{MKEYEDReader} does inside a with statement
+
+    Instrumentation is turned on for the duration if it wasn't already.
+
+    :ivar elapsed: Wall time in seconds spent inside the with statement.
+    :ivar counters: The change in each L{MKEYEDIOStats} counter, except
+        max_depth, which is the deepest key search inside the with statement.
+    """
+
+    def __init__(self, reader, enabled=True):
+        self.reader = reader
+        self.enabled = enabled
+        self.elapsed = 0.0
+        self.counters = {}
+        self._started = None
+        self._owned = False
+        self._before = None
+        self._max_depth = 0
+
+    def __enter__(self):
+        if self.enabled:
+            self._owned = self.reader._stats is None
+            stats = self.reader.enableInstrumentation()
+            self._before = stats.asDict()
+            # Track the deepest search in this window, and put the reader's
+            # high water mark back on exit
+            self._max_depth = stats.max_depth
+            stats.max_depth = 0
+            self._started = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return
+        self.elapsed = default_timer() - self._started
+        stats = self.reader._stats
+        after = stats.asDict()
+        self.counters = dict(
+            (name, after[name] - self._before[name]) for name in after)
+        self.counters["max_depth"] = after["max_depth"]
+        stats.max_depth = max(self._max_depth, after["max_depth"])
+        if self._owned:
+            self.reader.disableInstrumentation()
+
+    def __str__(self):
+        lines = ["{0:<20} {1:.6f}".format("elapsed", self.elapsed)]
+        for name in MKEYEDIOStats.COUNTERS:
+            if name in self.counters:
+                lines.append("{0:<20} {1}".format(name, self.counters[name]))
+        return "\n".join(lines)
+
+
+class MKEYEDRecordCache(object):
+    """
+    A bounded least-recently-used cache of decoded records
+
+    Records are stored as the tuples returned by
+    L{MKEYEDReader._splitRecordIntoFields}, which are read-only, so the same
+    tuple can safely be handed to every caller.
+
+    :ivar size: The maximum number of records kept.
+    :ivar validate_interval: Seconds between checks of the file header.
+    :ivar hits: The number of lookups answered from the cache.
+    :ivar misses: The number of lookups that had to read the file.
+    """
+
+    def __init__(self, size=1024, validate_interval=1.0):
+        self.size = size
+        self.validate_interval = validate_interval
+        self.hits = 0
+        self.misses = 0
+        self._records = OrderedDict()
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, cachekey):
+        """Return a cached record and mark it recently used, or None"""
+        try:
+            record = self._records.pop(cachekey)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._records[cachekey] = record
+        self.hits += 1
+        return record
+
+    def put(self, cachekey, record):
+        """Cache a record, evicting the least recently used if full"""
+        self._records[cachekey] = record
+        if len(self._records) > self.size:
+            self._records.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached record"""
+        self._records.clear()
+
+
+class MKEYEDBloomFilter(object):
+    """
+    A Bloom filter over the keys of an MKEYED index
+
+    The filter answers "is this key definitely missing?" without reading any
+    index blocks.  A lookup it can't rule out still has to search the index;
+    the fraction of missing keys that get through is the false positive rate
+    the filter was sized for.
+
+    Full keys are always added.  Partial key lookups can be answered only for
+    the prefix lengths the filter was built with.
+
+    :ivar keynum: The keynum of the filtered index.
+    :ivar keylength: The length of a full key.
+    :ivar prefixes: The partial key lengths that were also added.
+    :ivar stamp: Header values of the data file the filter was built from.
+    :ivar checks: The number of lookups the filter could answer.
+    :ivar saved: The number of those lookups that skipped the index search.
+    """
+
+    HEADER = struct.Struct("!8sQIIIH")
+    MAGIC = "MKBLOOM1"
+
+    def __init__(
+            self, capacity, fp_rate=0.01, keynum=0, keylength=0, prefixes=(),
+            stamp=None):
+        """Size an empty filter.
+
+        :param capacity: The number of keys that will be added.
+        :param fp_rate: The target rate of false positives.
+        """
+        entries = max(1, capacity * (1 + len(prefixes)))
+        self.bitcount = max(8, int(math.ceil(
+            -entries * math.log(fp_rate) / (math.log(2) ** 2))))
+        self.hashcount = max(1, int(round(
+            float(self.bitcount) / entries * math.log(2))))
+        self.bits = bytearray((self.bitcount + 7) // 8)
+        self.keynum = keynum
+        self.keylength = keylength
+        self.prefixes = tuple(sorted(prefixes))
+        self.stamp = tuple(stamp or (0, 0, 0))
+        self.checks = 0
+        self.saved = 0
+
+    def _positions(self, key):
+        """Return the bit positions for a key, using double hashing"""
+        h1, h2 = unpack("!QQ", hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.bitcount for i in xrange(self.hashcount)]
+
+    def add(self, key):
+        """Add a full key, and its prefixes of the configured lengths"""
+        for value in [key] + [key[:n] for n in self.prefixes if n < len(key)]:
+            for pos in self._positions(value):
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+    def mayContain(self, key):
+        """\
+        Return False only if no key in the index starts with this key.
+
+        Keys that are neither full keys nor one of the prefix lengths can't
+        be checked and always return True.
+        """
+        if len(key) != self.keylength and len(key) not in self.prefixes:
+            return True
+        self.checks += 1
+        if key in self:
+            return True
+        self.saved += 1
+        return False
+
+    def save(self, path):
+        """Write the filter to a sidecar file."""
+        with open(path, "wb") as f:
+            f.write(self.HEADER.pack(
+                self.MAGIC, self.bitcount, self.hashcount, self.keynum,
+                self.keylength, len(self.prefixes)))
+            f.write(struct.pack("!%dH" % len(self.prefixes), *self.prefixes))
+            f.write(struct.pack("!3Q", *self.stamp))
+            f.write(str(self.bits))
+
+    @classmethod
+    def load(cls, path):
+        """Read a filter written by L{save}.
+
+        :raises BBPyBloomFilterError: BBPyBloomFilterError if the file isn't
+            a saved filter.
+        """
+        with open(path, "rb") as f:
+            header = f.read(cls.HEADER.size)
+            try:
+                (magic, bitcount, hashcount, keynum, keylength,
+                 prefixcount) = cls.HEADER.unpack(header)
+            except struct.error:
+                magic = None
+            if magic != cls.MAGIC:
+                raise BBPyBloomFilterError(
+                    "%s is not a saved Bloom filter." % path)
+            prefixes = struct.unpack(
+                "!%dH" % prefixcount, f.read(2 * prefixcount))
+            stamp = struct.unpack("!3Q", f.read(24))
+            bits = bytearray(f.read())
+
+        bloom = cls(1, keynum=keynum, keylength=keylength, prefixes=prefixes,
+                    stamp=stamp)
+        bloom.bitcount = bitcount
+        bloom.hashcount = hashcount
+        bloom.bits = bits
+        return bloom
+
+
+# The framed wire format for writer requests and replies.  A request is
+# "MKW2 <count> <maxnumerics>\n" followed by each request as an op byte,
+# W(rite) or D(elete), and the filename, key, record and numerics as
+# "<length>:<bytes>".  A reply is "MKW2 <count>\n" followed by one line per
+# request, "OK" or "ERR <message>".
+WIRE_MAGIC = "MKW2"
+WIRE_FIELDS = ("filename", "key", "record", "numerics")
+
+
+def encodeWriteRequest(batch, maxnumerics):
+    """Encode writer requests in the framed wire format.
+
+    :param batch: Request dicts, as queued by L{MKEYEDWriter}.
+    :param maxnumerics: The most numerics in any request.
+    :return: The request string.
+    """
+    parts = ["%s %d %d\n" % (WIRE_MAGIC, len(batch), maxnumerics)]
+    append = parts.append
+    for request in batch:
+        filename = request["filename"]
+        key = request["key"]
+        record = request["record"]
+        numerics = request.get("numerics", "")
+        append("%s%d:%s%d:%s%d:%s%d:%s" % (
+            "W" if record else "D", len(filename), filename, len(key), key,
+            len(record), record, len(numerics), numerics))
+    return "".join(parts)
+
+
+def decodeWriteRequest(data):
+    """Decode a request made by L{encodeWriteRequest}.
+
+    :return: (maxnumerics, [request dict, ...])
+    :raises ValueError: If the request is malformed.
+    """
+    end = data.index("\n")
+    magic, count, maxnumerics = data[:end].split(" ")
+    if magic != WIRE_MAGIC:
+        raise ValueError("Not a %s request" % WIRE_MAGIC)
+    pos = end + 1
+    batch = []
+    for _ in xrange(int(count)):
+        if data[pos:pos + 1] not in ("W", "D"):
+            raise ValueError("Bad request at byte %d" % pos)
+        pos += 1
+        request = {}
+        for name in WIRE_FIELDS:
+            colon = data.index(":", pos)
+            length = int(data[pos:colon])
+            request[name] = data[colon + 1:colon + 1 + length]
+            if len(request[name]) != length:
+                raise ValueError("Request ends in the %s" % name)
+            pos = colon + 1 + length
+        batch.append(request)
+    if pos != len(data):
+        raise ValueError("%d bytes after the last request" % (len(data) - pos))
+    return int(maxnumerics), batch
+
+
+def encodeWriteReply(errors):
+    """Encode per-request results in the framed wire format.
+
+    :param errors: An error message, or None for success, per request.
+    :return: The reply string.
+    """
+    lines = ["%s %d" % (WIRE_MAGIC, len(errors))]
+    lines.extend(
+        "OK" if error is None else "ERR " + " ".join(str(error).split())
+        for error in errors)
+    return "\n".join(lines) + "\n"
+
+
+def decodeWriteReply(data):
+    """Decode a reply made by L{encodeWriteReply}.
+
+    :return: An error message, or None for success, per request.
+    :raises ValueError: If the reply is malformed.
+    """
+    lines = data.split("\n")
+    magic, count = lines[0].split(" ")
+    if magic != WIRE_MAGIC:
+        raise ValueError("Not a %s reply" % WIRE_MAGIC)
+    errors = []
+    for line in lines[1:int(count) + 1]:
+        if line == "OK":
+            errors.append(None)
+        elif line.startswith("ERR "):
+            errors.append(line[4:])
+        else:
+            raise ValueError("Bad result %r" % line)
+    if len(errors) != int(count):
+        raise ValueError("%d results for %s requests" % (len(errors), count))
+    return errors
+
+
 class MKEYEDWriter(object):
-    """Builds a batch of write requests and passes to SH.BBX.WRITE"""
+    """Builds a batch of write requests and passes to SH.BBX.WRITE
+
+    By default requests are kept until flush() is called.  With max_records,
+    max_bytes or max_age set, the batch is flushed as soon as it gets that
+    big or old, which keeps memory bounded on bulk loads.  max_age is only
+    checked when a request is added, unless a background flusher is used.
+
+    With background=True, a thread does the flushing so callers don't wait
+    on BBx.  When max_pending requests are waiting, write() and delete()
+    block until the flusher catches up.  An error in the flusher is raised
+    by the next write(), delete(), flush() or close(), and the requests
+    that weren't written are kept to be sent again.  Call close() when
+    done: the flusher thread keeps the writer from being garbage collected.
+
+    :ivar batch: The queued requests.
+    :ivar max_records: Flush when this many requests are queued.
+    :ivar max_bytes: Flush when the queued keys and records are this big.
+    :ivar max_age: Flush when the oldest queued request is this many
+        seconds old.
+    :ivar chunk_size: The most requests sent to BBx at once.  Bigger
+        batches are sent in several requests.
+    :ivar group_by_file: Sort each batch by filename before sending, and
+        end chunks where a file's requests end, so each request to BBx
+        writes to one file.  The order of requests to the same file is
+        kept.
+    :ivar wire_format: "repr" sends batches as a Python repr() and eval()s
+        the reply, which is what SH.BBX.WRITE has always taken.  "framed"
+        uses the length prefixed format of L{encodeWriteRequest}, which is
+        faster to build and parse on large batches and reports a result
+        per request; SH.BBX.WRITE is passed a FRAMED argument for it.
+    """
 
-    def __init__(self, configpath=""):
+    def __init__(
+            self, configpath="", session=False, command=None,
+            max_records=None, max_bytes=None, max_age=None, chunk_size=None,
+            group_by_file=False, background=False, max_pending=None,
+            wire_format="repr"):
         """
         :param configpath: Allows the programmer to specify a path to
             place in front of the config file (bbw.config).
+        :param session: Keep one writer process running for every flush
+            instead of starting one per flush, see L{MKEYEDWriterSession}.
+            SH.BBX.WRITE is passed a SESSION argument.
+        :param command: A shell command to run instead of PRO5, such as
+            fake_bbx_writer.py for testing.
+        :param max_records: See L{max_records}.
+        :param max_bytes: See L{max_bytes}.
+        :param max_age: See L{max_age}.
+        :param chunk_size: See L{chunk_size}.
+        :param group_by_file: See L{group_by_file}.
+        :param background: Flush from a background thread.
+        :param max_pending: With background, the most requests queued or
+            being written before adding more blocks.  Defaults to twice
+            max_records, or 10000.
+        :param wire_format: See L{wire_format}.
 
         :return: Instance of a L{MKEYEDWriter}.
         """
 
+        if wire_format not in ("repr", "framed"):
+            raise BBPyWriterTypeError(
+                "Unknown wire format %r" % (wire_format,))
+        self.wire_format = wire_format
+        self._lock = threading.Condition()
         self.clear()
         if configpath and configpath[-1] != "/":
             configpath += "/"
         self.configpath = configpath
+        self.command = command
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.chunk_size = chunk_size
+        self.group_by_file = group_by_file
+        self._session = None
+        if session:
+            self._session = MKEYEDWriterSession(self._command(session=True))
+
+        self._error = None
+        self._closing = False
+        self._flushnow = False
+        self._inflight = 0
+        self._flusher = None
+        if background:
+            self.max_pending = max_pending or 2 * (max_records or 5000)
+            self._flusher = threading.Thread(
+                target=self._flushLoop, name="MKEYEDWriter flusher")
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def clear(self):
         """ Reset this instance, clear any queued write requests. """
         self.batch = []
+        self._bytes = 0
+        self._queued_at = None
 
     def delete(self, file, key):
         """ Add a delete request to the batch. """
-        self.batch.append(
+        self._queue(
             {"filename": str(file), "key": str(key), "record": "",
              "numcount": "0"})
 
@@ -995,42 +2009,315 @@ class MKEYEDWriter(object):
         file = str(file)
         # OK, now we can add it to the queue.
         if not nums:
-            self.batch.append(
+            self._queue(
                 {"filename": file, "key": key, "record": rec, "numcount": "0"})
         else:
-            self.batch.append(
+            self._queue(
                 {"filename": file, "key": key, "record": rec,
                  "numerics": str(nums), "numcount": str(len(nums))})
 
-    def flush(self):
-        """ Send the batched write requests to the BBx slave routine. """
+    def _queue(self, request):
+        """ Add a request to the batch, flushing if a limit is reached. """
+        size = len(request["key"]) + len(request["record"])
+        with self._lock:
+            self._raiseError()
+            if self._flusher is not None:
+                # Backpressure: wait for the flusher to catch up
+                while (len(self.batch) + self._inflight >= self.max_pending
+                       and self._error is None):
+                    self._lock.wait()
+                self._raiseError()
+            first = not self.batch
+            if first:
+                self._queued_at = time.time()
+            self.batch.append(request)
+            self._bytes += size
+            due = self._due()
+            # The flusher waits without a timeout on an empty batch, wake it
+            # to start timing max_age
+            if self._flusher is not None and (
+                    due or (first and self.max_age is not None)):
+                self._lock.notify_all()
+        if due and self._flusher is None:
+            self.flush()
+
+    def _due(self):
+        """ Return True if the batch has reached a flush limit. """
+        if not self.batch:
+            return False
+        return bool(
+            (self.max_records and len(self.batch) >= self.max_records) or
+            (self.max_bytes and self._bytes >= self.max_bytes) or
+            (self.max_age is not None and
+             time.time() - self._queued_at >= self.max_age))
+
+    def _raiseError(self):
+        """ Raise, once, an error from the background flusher. """
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _command(self, session=False):
+        """ Return the shell command that runs the writer. """
+        if self.command:
+            return self.command
 
         # add a path if we have one
         config = self.configpath + PRO5CONFIG
+        cmd = "%s -q -c%s -tIO %s" % (PRO5, config, 'SH.BBX.WRITE')
+        args = []
+        if session:
+            args.append("SESSION")
+        if self.wire_format == "framed":
+            args.append("FRAMED")
+        if args:
+            cmd += " - " + " ".join(args)
+        return cmd
 
-        if self.batch != []:
+    def flush(self):
+        """ Send the batched write requests to the BBx slave routine. """
+
+        if self._flusher is not None:
+            with self._lock:
+                self._flushnow = True
+                self._lock.notify_all()
+                while (self.batch or self._inflight) and self._error is None:
+                    self._lock.wait()
+                self._raiseError()
+            return
 
-            # grab the max numeric size, BBx needs this to not waste memory
-            maxnumerics = reduce(lambda x, y: x > y and x or y,
-                                 map(lambda x: int(x['numcount']), self.batch))
-            outbuff = (len(self.batch), maxnumerics) + (self.batch,)
-            cmd = "%s -q -c%s -tIO %s" % (PRO5, config, 'SH.BBX.WRITE')
-            p = Popen([cmd], shell=True, stdin=PIPE, stdout=PIPE)
-            p.stdin.write(outbuff.__str__() + '\x00')
+        if self.batch != []:
+            try:
+                self._send(self.batch)
+            finally:
+                batch = self.batch
+                self.clear()
+                if batch:
+                    # Keep what wasn't written for the next flush
+                    self.batch = batch
+                    self._bytes = sum(len(request["key"]) +
+                                      len(request["record"])
+                                      for request in batch)
+                    self._queued_at = time.time()
+
+    def _send(self, batch):
+        """\
+        Send requests to BBx in chunks, removing each chunk from batch once
+        it is written.
+        """
+        if self.group_by_file:
+            batch.sort(key=lambda request: request["filename"])
+        while batch:
+            size = min(self.chunk_size or len(batch), len(batch))
+            if self.group_by_file:
+                filename = batch[0]["filename"]
+                for i in xrange(1, size):
+                    if batch[i]["filename"] != filename:
+                        size = i
+                        break
+            try:
+                self._sendChunk(batch[:size])
+            except BBPyWriterRecordError:
+                # BBx went through the whole chunk, don't send it again
+                del batch[:size]
+                raise
+            del batch[:size]
+
+    def _sendChunk(self, batch):
+        """ Send one request to BBx. """
+
+        # grab the max numeric size, BBx needs this to not waste memory
+        maxnumerics = reduce(lambda x, y: x > y and x or y,
+                             map(lambda x: int(x['numcount']), batch))
+        if self.wire_format == "framed":
+            request = encodeWriteRequest(batch, maxnumerics)
+        else:
+            outbuff = (len(batch), maxnumerics) + (batch,)
+            request = outbuff.__str__()
+        if self._session is not None:
+            output = self._session.send(request)
+        else:
+            if self.wire_format == "repr":
+                request += '\x00'
+            p = Popen([self._command()], shell=True, stdin=PIPE,
+                      stdout=PIPE)
+            p.stdin.write(request)
             p.stdin.close()
             output = p.stdout.read()
             p.stdout.close()
+
+        if self.wire_format == "framed":
             try:
-                resp = eval(output)
-            except:
-                resp = 'Failed on evaluating: "%s"' % output
-            if resp.find("SUCCESS!") == -1:
-                raise BBPyWriterIOError(resp)
-            self.clear()
+                errors = decodeWriteReply(output)
+            except ValueError:
+                raise BBPyWriterIOError(output)
+            if len(errors) != len(batch):
+                raise BBPyWriterIOError(
+                    "%d results for %d requests" % (len(errors), len(batch)))
+            failures = [(request, error)
+                        for request, error in zip(batch, errors)
+                        if error is not None]
+            if failures:
+                raise BBPyWriterRecordError(failures)
+            return
+
+        try:
+            resp = eval(output)
+        except:
+            resp = 'Failed on evaluating: "%s"' % output
+        if resp.find("SUCCESS!") == -1:
+            raise BBPyWriterIOError(resp)
+
+    def _flushLoop(self):
+        """ Flush batches from the background thread until closed. """
+        lock = self._lock
+        while True:
+            with lock:
+                while not (self.batch and self._error is None and (
+                        self._closing or self._flushnow or self._due() or
+                        len(self.batch) >= self.max_pending)):
+                    if self._closing and (
+                            self._error is not None or not self.batch):
+                        return
+                    timeout = None
+                    if self.max_age is not None and self._queued_at:
+                        timeout = max(0.01, self._queued_at + self.max_age -
+                                      time.time())
+                    lock.wait(timeout)
+                batch = self.batch
+                self.clear()
+                self._flushnow = False
+                self._inflight = len(batch)
+            try:
+                self._send(batch)
+            except Exception as e:
+                with lock:
+                    self._error = e
+                    # Put back what wasn't written, ahead of newer requests
+                    self.batch[:0] = batch
+                    self._bytes = sum(len(request["key"]) +
+                                      len(request["record"])
+                                      for request in self.batch)
+                    self._queued_at = time.time()
+            finally:
+                with lock:
+                    self._inflight = 0
+                    lock.notify_all()
+
+    def close(self):
+        """ Flush, then stop the flusher and writer session if there are any.
+        """
+        try:
+            if self._flusher is not None:
+                with self._lock:
+                    self._closing = True
+                    self._lock.notify_all()
+                self._flusher.join()
+                with self._lock:
+                    self._raiseError()
+            else:
+                self.flush()
+        finally:
+            if self._session is not None:
+                self._session.close()
 
     def __del__(self):
         """ Called to clean up this object when it gets deleted. """
-        self.flush()
+        # Nothing was started if __init__ failed before the flusher was set
+        if hasattr(self, "_flusher"):
+            self.close()
+
+
+class MKEYEDWriterSession(object):
+    """
+    A long-lived writer process that takes many batches
+
+    Starting PRO5 costs much more than the writes in a typical batch, so a
+    session starts the writer once and sends it each batch as a frame: the
+    length of the request as 8 ASCII digits, then the request.  Replies
+    come back framed the same way.  A zero length frame ends the session.
+
+    If the process has died, it is started again for the next batch.  A
+    batch is only sent again if the process died before taking it.  If it
+    died after that, the batch may or may not have been written, so
+    L{BBPyWriterIOError} is raised instead.
+
+    :ivar command: The shell command that runs the writer.
+    :ivar process: The running writer, or None.
+    :ivar starts: How many times the writer has been started.
+    """
+
+    LENGTH_DIGITS = 8
+
+    def __init__(self, command):
+        self.command = command
+        self.process = None
+        self.starts = 0
+
+    @property
+    def alive(self):
+        """True if the writer process is running"""
+        return self.process is not None and self.process.poll() is None
+
+    def _start(self):
+        self.close()
+        self.process = Popen(
+            [self.command], shell=True, stdin=PIPE, stdout=PIPE)
+        self.starts += 1
+
+    def send(self, request):
+        """Send one request and return the reply.
+
+        :param request: The request string.
+        :return: The reply string.
+        :raises BBPyWriterIOError: If the writer can't be reached or ended
+            without replying.
+        """
+        if len(request) >= 10 ** self.LENGTH_DIGITS:
+            raise BBPyWriterIOError(
+                "A %d byte request is too large for one frame" % len(request))
+        frame = "%0*d%s" % (self.LENGTH_DIGITS, len(request), request)
+        for attempt in (1, 2):
+            if not self.alive:
+                self._start()
+            try:
+                self.process.stdin.write(frame)
+                self.process.stdin.flush()
+                break
+            except (IOError, OSError):
+                # The writer died before taking the batch, so it's safe to
+                # start another and send it again
+                self.close()
+        else:
+            raise BBPyWriterIOError("The writer session can't be started.")
+
+        stdout = self.process.stdout
+        header = stdout.read(self.LENGTH_DIGITS)
+        reply = None
+        if len(header) == self.LENGTH_DIGITS and header.isdigit():
+            reply = stdout.read(int(header))
+            if len(reply) != int(header):
+                reply = None
+        if reply is None:
+            self.close()
+            raise BBPyWriterIOError(
+                "The writer session ended without replying, the batch may "
+                "not have been written.")
+        return reply
+
+    def close(self):
+        """End the writer process, if it is running."""
+        process, self.process = self.process, None
+        if process is None:
+            return
+        try:
+            if process.poll() is None:
+                process.stdin.write("0" * self.LENGTH_DIGITS)
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        process.stdout.close()
+        process.wait()
 
 
 class MKEYEDKey(object):
@@ -1153,6 +2440,14 @@ class BBPyWrongFileTypeError(Exception):
     """Raised if the data file is not a type MKEYEDReader can read"""
 
 
+class BBPyBloomFilterError(Exception):
+    """Raised if a saved Bloom filter can't be used for the data file"""
+
+
+class BBPyScanTokenError(Exception):
+    """Raised if a scan token can't be read or is for another index"""
+
+
 class MKEYEDReaderEOF(Exception):
     """Used as a flag in the event the reader reaches the End Of File (EOF)"""
 
@@ -1165,6 +2460,21 @@ class BBPyWriterIOError(Exception):
     """Raised when the writer cannot communicate with the server."""
 
 
+class BBPyWriterRecordError(BBPyWriterIOError):
+    """Raised when BBx reports that some requests in a batch failed
+
+    The other requests in the batch were written.
+
+    :ivar failures: (request, error message) pairs.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        BBPyWriterIOError.__init__(
+            self, "%d requests failed, the first: %s" % (
+                len(failures), failures[0][1]))
+
+
 class BBPyWriterUnknownError(Exception):
     """Raised whenever the server returns and error code"""
 
@@ -0,0 +1,288 @@
+"""
+Index health and layout analysis for MKEYED files
+
+A degraded index tree (duplicate keys left by failed rebalances, uneven
+depth, half-empty blocks) slows lookups down without raising any error.
+L{analyze} walks a whole index once, in key order, keeping only the blocks on
+the current path in memory, and reports what it found.
+
+Usage: python mkeyed_analyze.py [--json] DATAFILE [KEYNUM]
+"""
+
+import json
+import math
+import sys
+
+from mkeyed import MKEYEDReader, MKEYEDIndexBlock
+
+
+class LevelStats(object):
+    """Totals for the index blocks at one depth of the tree"""
+
+    def __init__(self):
+        self.blocks = 0
+        self.entries = 0
+        self.min_entries = None
+        self.max_entries = 0
+
+    def add(self, entries):
+        self.blocks += 1
+        self.entries += entries
+        if self.min_entries is None or entries < self.min_entries:
+            self.min_entries = entries
+        self.max_entries = max(self.max_entries, entries)
+
+
+class IndexReport(object):
+    """The result of analyzing one index
+
+    :ivar keys: Keys found in the index.
+    :ivar recordcount: Records according to the file header.
+    :ivar blocks: Index blocks reached from the root.
+    :ivar levels: A L{LevelStats} per depth, the root is depth 0.
+    :ivar capacity: Entries per block used for fill factors.
+    :ivar min_leaf_depth: Depth of the shallowest leaf block.
+    :ivar max_leaf_depth: Depth of the deepest leaf block.
+    :ivar duplicate_keys: Keys equal to the key before them.
+    :ivar out_of_order_keys: Keys less than the key before them.
+    :ivar shared_blocks: Blocks referenced more than once.  The walk doesn't
+        descend into them again, so this also catches loops.
+    :ivar bad_pointers: Record or block addresses outside the file.
+    :ivar index_bytes: Bytes used by the reachable index blocks.
+    :ivar unreferenced_bytes: File bytes not accounted for by the headers,
+        the records in the index and the reachable index blocks, which
+        estimates orphaned blocks and free space.
+    :ivar lookup_reads: Total blocks read to look up every key once with a
+        cold index.
+    """
+
+    def __init__(self):
+        self.keys = 0
+        self.recordcount = 0
+        self.blocks = 0
+        self.levels = []
+        self.capacity = 0
+        self.min_leaf_depth = None
+        self.max_leaf_depth = 0
+        self.duplicate_keys = 0
+        self.out_of_order_keys = 0
+        self.shared_blocks = 0
+        self.bad_pointers = 0
+        self.index_bytes = 0
+        self.unreferenced_bytes = 0
+        self.lookup_reads = 0
+
+    @property
+    def depth(self):
+        """The number of levels in the tree"""
+        return len(self.levels)
+
+    @property
+    def average_lookup_reads(self):
+        """Blocks read to look up a key with a cold index, on average"""
+        return float(self.lookup_reads) / self.keys if self.keys else 0.0
+
+    @property
+    def ideal_depth(self):
+        """The depth of a fully packed tree holding the same keys"""
+        if not self.keys or self.capacity < 1:
+            return 0
+        return int(math.ceil(
+            math.log(self.keys + 1) / math.log(self.capacity + 1)))
+
+    def fill_factor(self, level):
+        """The fraction of entry slots used at a depth"""
+        stats = self.levels[level]
+        if not stats.blocks or not self.capacity:
+            return 0.0
+        return float(stats.entries) / (stats.blocks * self.capacity)
+
+    def problems(self):
+        """Return a list of reasons the index should be rebuilt"""
+        problems = []
+        if self.duplicate_keys:
+            problems.append("%d duplicate keys" % self.duplicate_keys)
+        if self.out_of_order_keys:
+            problems.append("%d keys out of order" % self.out_of_order_keys)
+        if self.shared_blocks:
+            problems.append("%d blocks referenced more than once" %
+                            self.shared_blocks)
+        if self.bad_pointers:
+            problems.append("%d pointers outside the file" %
+                            self.bad_pointers)
+        if self.keys != self.recordcount:
+            problems.append("%d keys for %d records" %
+                            (self.keys, self.recordcount))
+        if self.max_leaf_depth != self.min_leaf_depth:
+            problems.append("leaves between depth %s and %s" %
+                            (self.min_leaf_depth, self.max_leaf_depth))
+        if self.depth > self.ideal_depth + 1:
+            problems.append("depth %d where %d would do" %
+                            (self.depth, self.ideal_depth))
+        return problems
+
+    @property
+    def needs_rebuild(self):
+        return bool(self.problems())
+
+    def asDict(self):
+        """Return the report as plain data, for JSON output"""
+        return {
+            'keys': self.keys,
+            'recordcount': self.recordcount,
+            'blocks': self.blocks,
+            'depth': self.depth,
+            'ideal_depth': self.ideal_depth,
+            'capacity': self.capacity,
+            'levels': [
+                {'blocks': level.blocks, 'entries': level.entries,
+                 'min_entries': level.min_entries,
+                 'max_entries': level.max_entries,
+                 'fill_factor': self.fill_factor(i)}
+                for i, level in enumerate(self.levels)],
+            'min_leaf_depth': self.min_leaf_depth,
+            'max_leaf_depth': self.max_leaf_depth,
+            'duplicate_keys': self.duplicate_keys,
+            'out_of_order_keys': self.out_of_order_keys,
+            'shared_blocks': self.shared_blocks,
+            'bad_pointers': self.bad_pointers,
+            'index_bytes': self.index_bytes,
+            'unreferenced_bytes': self.unreferenced_bytes,
+            'average_lookup_reads': self.average_lookup_reads,
+            'problems': self.problems(),
+        }
+
+    def format(self):
+        """Return the report as text"""
+        lines = [
+            "Keys:                 %d (header says %d records)" % (
+                self.keys, self.recordcount),
+            "Index blocks:         %d (%d bytes)" % (
+                self.blocks, self.index_bytes),
+            "Depth:                %d (packed tree: %d)" % (
+                self.depth, self.ideal_depth),
+            "Leaf depths:          %s to %s" % (
+                self.min_leaf_depth, self.max_leaf_depth),
+            "Block reads/lookup:   %.2f" % self.average_lookup_reads,
+            "Unreferenced bytes:   %d" % self.unreferenced_bytes,
+            "",
+            "Level  Blocks  Entries  Min  Max  Fill",
+        ]
+        for i, level in enumerate(self.levels):
+            lines.append("%5d %7d %8d %4s %4d %5.0f%%" % (
+                i, level.blocks, level.entries, level.min_entries,
+                level.max_entries, 100 * self.fill_factor(i)))
+        lines.append("")
+        problems = self.problems()
+        if problems:
+            lines.append("Needs rebuilding: " + "; ".join(problems))
+        else:
+            lines.append("Index looks healthy.")
+        return "\n".join(lines)
+
+
+def analyze(reader, keynum=None, capacity=None):
+    """Walk an index once and report on its health and layout.
+
+    :param reader: An open L{MKEYEDReader}.
+    :param keynum: The index to analyze, defaults to the current keynum.
+    :param capacity: The number of entries an index block can hold.
+        Defaults to the most entries found in any block.
+    :return: An L{IndexReport}.
+    """
+    if keynum is not None:
+        reader._setKeyNum(keynum)
+    f = reader._f
+    keylength = reader.getKeylength()
+    ptr_size = reader._constants['addr_size']
+    filelength = reader._filelength
+    report = IndexReport()
+    report.recordcount = reader._recordcount
+
+    visited = set()
+
+    def decode(address, depth):
+        """Decode a block and count it, or return None if already seen"""
+        if address in visited:
+            report.shared_blocks += 1
+            return None
+        if filelength and address >= filelength:
+            report.bad_pointers += 1
+            return None
+        visited.add(address)
+        block = MKEYEDIndexBlock(f, keylength, address, ptr_size)
+        while len(report.levels) <= depth:
+            report.levels.append(LevelStats())
+        report.levels[depth].add(len(block.keys))
+        report.blocks += 1
+        report.index_bytes += block.index_size
+        if not any(block.index_ptrs):
+            if report.min_leaf_depth is None or \
+                    depth < report.min_leaf_depth:
+                report.min_leaf_depth = depth
+            report.max_leaf_depth = max(report.max_leaf_depth, depth)
+        return block
+
+    previous = None
+    root = decode(reader._indexblocks[reader.keynum], 0)
+    # Only the blocks on the path to the current key are kept
+    stack = [(root.iterator(), 0)] if root else []
+    while stack:
+        iterator, depth = stack[-1]
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stack.pop()
+            continue
+        if isinstance(item, MKEYEDIndexBlock.IndexResult):
+            block = decode(item.index_ptr, depth + 1)
+            if block is not None:
+                stack.append((block.iterator(), depth + 1))
+            continue
+
+        report.keys += 1
+        report.lookup_reads += depth + 1
+        if not item.record_ptr or (
+                filelength and item.record_ptr >= filelength):
+            report.bad_pointers += 1
+        if previous is not None:
+            if item.key == previous:
+                report.duplicate_keys += 1
+            elif item.key < previous:
+                report.out_of_order_keys += 1
+        previous = item.key
+
+    report.capacity = capacity or max(
+        [level.max_entries for level in report.levels] or [0])
+    if filelength:
+        record_bytes = report.keys * (
+            reader._recordsize + reader._constants['record_offset'])
+        constants = reader._constants
+        data_start = max(
+            constants['header_start'] + constants['header_size'] +
+            ptr_size * (len(reader._indexblocks) + 1),
+            constants['keydef_start'] + 48 * 8)
+        report.unreferenced_bytes = max(
+            0, filelength - data_start - record_bytes - report.index_bytes)
+    return report
+
+
+def main(argv):
+    as_json = '--json' in argv
+    args = [arg for arg in argv if arg != '--json']
+    if not args:
+        print(__doc__)
+        return 1
+    reader = MKEYEDReader(args[0])
+    report = analyze(reader, int(args[1]) if len(args) > 1 else None)
+    if as_json:
+        print(json.dumps(report.asDict(), indent=2, sort_keys=True))
+    else:
+        print(report.format())
+    return 1 if report.needs_rebuild else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+# vi: set tabstop=4 expandtab textwidth=80 filetype=python:
@@ -0,0 +1,219 @@
+"""
+Benchmarks for the MKEYED reader
+
+Generates a synthetic file with L{mkeyed_gen} (or uses an existing one) and
+times the common access patterns: point lookups of present and missing keys
+with a cold and a warm index, prefix scans, full scans, readBatches and
+readAll.  Results are printed as one JSON document so runs can be compared
+across versions.
+
+Usage: python mkeyed_bench.py [--records N] [--layout 2GB|4GB]
+           [--fanout N] [--keylength N] [--recordsize N] [--fields N]
+           [--lookups N] [--repeat N] [--file DATAFILE] [--output PATH]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+from mkeyed import MKEYEDReader, BBPyKeyNotFoundError
+from mkeyed_gen import MKEYEDGenerator, default_key
+
+
+def percentile(samples, fraction):
+    """Return the sample at a fraction (0..1) of the sorted samples"""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def result(name, ops, seconds, samples=None):
+    """Build one benchmark result"""
+    entry = {
+        'name': name,
+        'ops': ops,
+        'seconds': seconds,
+        'ops_per_sec': ops / seconds if seconds else None,
+    }
+    if samples:
+        entry['p50_us'] = percentile(samples, 0.5) * 1e6
+        entry['p95_us'] = percentile(samples, 0.95) * 1e6
+        entry['max_us'] = max(samples) * 1e6
+    return entry
+
+
+def best_of(repeat, func, *args):
+    """Run func repeat times, return (ops, seconds) of the fastest run"""
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        ops = func(*args)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best[1]:
+            best = (ops, elapsed)
+    return best
+
+
+def lookups(reader, keys, missing=False):
+    """Look up each key, returning per-lookup timings"""
+    samples = []
+    for key in keys:
+        start = default_timer()
+        try:
+            reader.find(key)
+        except BBPyKeyNotFoundError:
+            if not missing:
+                raise
+        samples.append(default_timer() - start)
+    return samples
+
+
+def cold_lookups(path, keys):
+    """Look up each key with a newly opened reader"""
+    samples = []
+    for key in keys:
+        start = default_timer()
+        MKEYEDReader(path).find(key)
+        samples.append(default_timer() - start)
+    return samples
+
+
+def full_scan(path):
+    reader = MKEYEDReader(path)
+    return sum(1 for _ in reader)
+
+
+def generator_scan(path):
+    reader = MKEYEDReader(path)
+    return sum(1 for _ in reader.readGenerator(numerics=True))
+
+
+def batch_scan(path, batch_size=1000):
+    reader = MKEYEDReader(path)
+    return sum(len(batch) for batch in reader.readBatches(
+        batch_size=batch_size, numerics=True, reuse=True))
+
+
+def read_all(path, prefix=''):
+    return len(MKEYEDReader(path).readAll(prefix, numerics=True))
+
+
+def run(path, lookup_keys, missing_keys, prefix, repeat):
+    """Run every benchmark against a data file, return the results"""
+    results = []
+
+    samples = cold_lookups(path, lookup_keys)
+    results.append(result(
+        'point_lookup_cold', len(samples), sum(samples), samples))
+
+    reader = MKEYEDReader(path)
+    lookups(reader, lookup_keys)  # decode the index blocks
+    samples = lookups(reader, lookup_keys)
+    results.append(result(
+        'point_lookup_warm', len(samples), sum(samples), samples))
+
+    samples = lookups(reader, missing_keys, missing=True)
+    results.append(result(
+        'point_miss_warm', len(samples), sum(samples), samples))
+
+    for name, func, args in (
+            ('prefix_scan', read_all, (path, prefix)),
+            ('full_scan', full_scan, (path,)),
+            ('read_generator', generator_scan, (path,)),
+            ('read_batches', batch_scan, (path,)),
+            ('read_all', read_all, (path,))):
+        ops, seconds = best_of(repeat, func, *args)
+        results.append(result(name, ops, seconds))
+    return results
+
+
+def version():
+    """Return the git revision of this tree, or None"""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).strip().decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="MKEYED reader benchmarks")
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--layout', default='2GB', choices=['2GB', '4GB'])
+    parser.add_argument('--fanout', type=int, default=32)
+    parser.add_argument('--keylength', type=int, default=23)
+    parser.add_argument('--recordsize', type=int, default=256)
+    parser.add_argument('--fields', type=int, default=4)
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--file', help="benchmark an existing data file")
+    parser.add_argument('--output', help="write results here, not stdout")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    workdir = None
+    try:
+        if args.file:
+            path = args.file
+            keys = [key for key, _ in MKEYEDReader(path).getIndex().cursor()]
+            lookup_keys = rng.sample(keys, min(args.lookups, len(keys)))
+            # Bump the last character to get keys that (probably) don't exist
+            missing_keys = [key[:-1] + chr((ord(key[-1]) + 1) % 256)
+                            for key in lookup_keys]
+            missing_keys = list(set(missing_keys) - set(keys))
+            prefix = keys[len(keys) // 2][:max(1, len(keys[0]) - 2)]
+            params = {'file': path}
+        else:
+            workdir = tempfile.mkdtemp(prefix='mkeyed-bench-')
+            path = os.path.join(workdir, 'BENCH')
+            # Even key numbers only, so odd ones are known to be missing
+            generator = MKEYEDGenerator(
+                args.records, keylength=args.keylength,
+                recordsize=args.recordsize, fields=args.fields,
+                fanout=args.fanout, layout=args.layout, step=2)
+            generator.write(path)
+            count = min(args.lookups, args.records)
+            picks = rng.sample(range(args.records), count)
+            lookup_keys = [generator.key(i) for i in picks]
+            missing_keys = [
+                default_key(i * 2 + 1, args.keylength) for i in picks]
+            # Keys sharing all but the last few digits of the key number
+            # cover a small slice of the file
+            digits = len(str(max(1, args.records // 50))) - 1
+            prefix = generator.key(args.records // 2)[
+                :len(generator.prefix) + 9 - digits]
+            params = dict(vars(args))
+
+        report = {
+            'version': version(),
+            'python': platform.python_version(),
+            'timestamp': time.time(),
+            'params': params,
+            'file_size': os.path.getsize(path),
+            'results': run(path, lookup_keys, missing_keys, prefix,
+                           args.repeat),
+        }
+    finally:
+        if workdir:
+            shutil.rmtree(workdir)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
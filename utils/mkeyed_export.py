@@ -0,0 +1,312 @@
+"""
+Columnar snapshots of MKEYED files for analysis
+
+L{export} streams the records of an MKEYED file into one column per field,
+so analyses can memory-map the columns they need instead of scanning the
+BBx file each time.  Records are read with L{MKEYEDReader.readBatches}, one
+chunk at a time, so memory use is bounded by the chunk size.  The files
+are standard NumPy .npy files, but NumPy is only needed to load them.
+
+An export directory holds:
+
+- manifest.json: the row count, the columns, and the source file with its
+  header stamp.  It is written last, so an export without one is
+  incomplete.
+- <name>.npy: float64 values, for a numeric column.
+- <name>.offsets.npy and <name>.data.npy: int64 offsets (one more than the
+  rows) and uint8 bytes, for a text column.  Row i is
+  data[offsets[i]:offsets[i + 1]].
+
+Fields are split as L{MKEYEDReader._splitRecordIntoFields} splits them,
+and the first field is always text.  Whether the other fields are numeric
+is decided from the first chunk: a field is numeric if all of its values
+there convert to floats.  Later values that don't convert are stored as
+NaN and counted in the manifest.  Records with fewer fields get NaN or an
+empty string, and fields past the last column are dropped and counted.
+
+Usage: python mkeyed_export.py DATAFILE OUTDIR [PREFIX]
+"""
+
+import json
+import os
+import struct
+import sys
+import time
+
+from mkeyed import MKEYEDReader
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MANIFEST = 'manifest.json'
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+# Magic, header length and header, padded so the data is 64 byte aligned
+NPY_HEADER_SIZE = 128
+NAN = float('nan')
+
+
+class NpyWriter(object):
+    """Appends values to a one dimensional .npy file"""
+
+    def __init__(self, path, descr, code):
+        """
+        :param path: The file to write.
+        :param descr: The NumPy type, such as '<f8'.
+        :param code: The matching struct format character, such as 'd'.
+        """
+        self.path = path
+        self.descr = descr
+        self.code = code
+        self.count = 0
+        self._f = open(path, 'wb')
+        self._writeHeader()
+
+    def _writeHeader(self):
+        """Write the header for the values so far at the start of the file"""
+        header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (
+            self.descr, self.count)
+        header = header.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 3) + '\n'
+        self._f.seek(0)
+        self._f.write(NPY_MAGIC + struct.pack('<H', len(header)) + header)
+        self._f.seek(0, os.SEEK_END)
+
+    def append(self, values):
+        """Append a list of values"""
+        if values:
+            self._f.write(struct.pack(
+                '<%d%s' % (len(values), self.code), *values))
+            self.count += len(values)
+
+    def appendBytes(self, data):
+        """Append a uint8 array's worth of bytes"""
+        self._f.write(data)
+        self.count += len(data)
+
+    def close(self):
+        """Write the final shape and close the file"""
+        if not self._f.closed:
+            self._writeHeader()
+            self._f.close()
+
+
+class NumericColumn(object):
+    """A float64 column
+
+    :ivar non_numeric: Values stored as NaN because they weren't numbers.
+    :ivar missing: Rows stored as NaN because they had too few fields.
+    """
+
+    type = 'float64'
+
+    def __init__(self, outdir, name):
+        self.name = name
+        self.file = name + '.npy'
+        self.non_numeric = 0
+        self.missing = 0
+        self._out = NpyWriter(os.path.join(outdir, self.file), '<f8', 'd')
+
+    def append(self, values):
+        """Append a chunk of field values, None for missing fields"""
+        out = []
+        for value in values:
+            if value is None:
+                self.missing += 1
+                out.append(NAN)
+                continue
+            try:
+                out.append(float(value))
+            except ValueError:
+                self.non_numeric += 1
+                out.append(NAN)
+        self._out.append(out)
+
+    def close(self):
+        self._out.close()
+
+    def asDict(self):
+        return {'name': self.name, 'type': self.type, 'file': self.file,
+                'non_numeric': self.non_numeric, 'missing': self.missing}
+
+
+class TextColumn(object):
+    """A column of byte strings, stored as offsets into one array of bytes
+
+    :ivar missing: Rows stored as empty strings because they had too few
+        fields.
+    """
+
+    type = 'text'
+
+    def __init__(self, outdir, name):
+        self.name = name
+        self.offsets_file = name + '.offsets.npy'
+        self.data_file = name + '.data.npy'
+        self.missing = 0
+        self._end = 0
+        self._offsets = NpyWriter(
+            os.path.join(outdir, self.offsets_file), '<i8', 'q')
+        self._data = NpyWriter(
+            os.path.join(outdir, self.data_file), '|u1', 'B')
+        self._offsets.append([0])
+
+    def append(self, values):
+        """Append a chunk of field values, None for missing fields"""
+        offsets = []
+        data = []
+        for value in values:
+            if value is None:
+                self.missing += 1
+                value = ''
+            self._end += len(value)
+            offsets.append(self._end)
+            data.append(value)
+        self._offsets.append(offsets)
+        self._data.appendBytes(''.join(data))
+
+    def close(self):
+        self._offsets.close()
+        self._data.close()
+
+    def asDict(self):
+        return {'name': self.name, 'type': self.type,
+                'offsets_file': self.offsets_file,
+                'data_file': self.data_file, 'missing': self.missing}
+
+
+def _is_numeric(value):
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def _make_columns(outdir, chunk, names):
+    """Create a column per field, typed from the first chunk"""
+    columns = []
+    for i in xrange(max(len(record) for record in chunk)):
+        name = names[i] if names and i < len(names) else 'field_%d' % i
+        values = [record[i] for record in chunk if i < len(record)]
+        if i and all(_is_numeric(value) for value in values):
+            columns.append(NumericColumn(outdir, name))
+        else:
+            columns.append(TextColumn(outdir, name))
+    return columns
+
+
+def export(reader, outdir, key="", chunk_size=10000, names=None,
+           stripzeros=True):
+    """Write the records matching a key as columns.
+
+    :param reader: An open L{MKEYEDReader}.
+    :param outdir: The directory to write, created if need be.  Columns
+        already there are overwritten.
+    :param key: The full or partial key to match.  "" exports every record.
+    :param chunk_size: Records read and written at a time.
+    :param names: Optional column names, in field order.  Other columns are
+        named field_<n>.
+    :param stripzeros: Drop the last field of a record if it is only the
+        null padding after the record.
+    :return: The manifest, as a dict.
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    manifest_path = os.path.join(outdir, MANIFEST)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    columns = None
+    rows = 0
+    dropped = 0
+    try:
+        for chunk in reader.readBatches(
+                key, batch_size=chunk_size, numerics=True,
+                stripzeros=stripzeros, reuse=True, nonumerics=True):
+            if columns is None:
+                columns = _make_columns(outdir, chunk, names)
+            width = len(columns)
+            for i, column in enumerate(columns):
+                column.append([record[i] if i < len(record) else None
+                               for record in chunk])
+            dropped += sum(len(record) - width for record in chunk
+                           if len(record) > width)
+            rows += len(chunk)
+    finally:
+        for column in columns or ():
+            column.close()
+
+    manifest = {
+        'source': reader.filename,
+        'stamp': list(reader._headerStamp()),
+        'key': key,
+        'keynum': reader.keynum,
+        'rows': rows,
+        'dropped_fields': dropped,
+        'columns': [column.asDict() for column in columns or ()],
+        'created': time.time(),
+    }
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(temp_path, manifest_path)
+    return manifest
+
+
+def read_manifest(outdir):
+    """Return the manifest of an export directory"""
+    with open(os.path.join(outdir, MANIFEST)) as f:
+        return json.load(f)
+
+
+def is_current(outdir, reader):
+    """Return True if the export was made from the file reader has open,
+    and the file hasn't changed since.
+    """
+    try:
+        manifest = read_manifest(outdir)
+    except (IOError, OSError, ValueError):
+        return False
+    return (manifest['source'] == reader.filename and
+            tuple(manifest['stamp']) == reader._headerStamp())
+
+
+def load(outdir):
+    """Memory-map the columns of an export with NumPy.
+
+    :return: (manifest, columns) where columns maps names to float64 arrays
+        for numeric columns and (offsets, data) array pairs for text.
+    """
+    if numpy is None:
+        raise RuntimeError("Loading exported columns needs NumPy.")
+    manifest = read_manifest(outdir)
+    columns = {}
+    for column in manifest['columns']:
+        if column['type'] == 'text':
+            columns[column['name']] = (
+                numpy.load(os.path.join(outdir, column['offsets_file']),
+                           mmap_mode='r'),
+                numpy.load(os.path.join(outdir, column['data_file']),
+                           mmap_mode='r'))
+        else:
+            columns[column['name']] = numpy.load(
+                os.path.join(outdir, column['file']), mmap_mode='r')
+    return manifest, columns
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(__doc__)
+        return 1
+    manifest = export(MKEYEDReader(argv[0]), argv[1],
+                      argv[2] if len(argv) > 2 else "")
+    print("%d rows, %d columns written to %s" % (
+        manifest['rows'], len(manifest['columns']), argv[1]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+# vi: set tabstop=4 expandtab textwidth=80 filetype=python:
@@ -0,0 +1,232 @@
+"""
+Synthetic MKEYED file generator
+
+Writes MKEYED files that L{MKEYEDReader} reads like production data, without
+needing production data.  Both the 2GB (FT_MKEYED) and 4GB (FT_MKEYED4GB)
+layouts are supported.  The layout written is:
+
+- the "<<bbx>>" file header,
+- the MKEYED header and root index addresses, and the key definitions, at
+  the offsets in L{MKEYEDReader.ALL_CONSTANTS},
+- the records, in key order, one fixed-size slot each,
+- the index blocks, children before their parents, so every address is
+  known when a block is written.
+
+The index is a balanced B-tree with at most fanout keys per block.  Keys and
+records are computed from the record number, so files of any size are
+written without holding them in memory.
+
+Usage: python mkeyed_gen.py PATH RECORDS [2GB|4GB]
+"""
+
+import struct
+import sys
+
+from mkeyed import MKEYEDReader, FT_MKEYED, FT_MKEYED4GB
+
+LAYOUTS = {
+    '2GB': FT_MKEYED,
+    '4GB': FT_MKEYED4GB,
+}
+
+# Where records start, after the headers and key definitions
+DATA_START = {
+    FT_MKEYED: 0x200,
+    FT_MKEYED4GB: 0x400,
+}
+
+# The 4-byte prefix the 4GB layout puts before each record
+RECORD_PREFIX = '\xfe' * 4
+
+
+def default_key(i, keylength, prefix='090N35', step=1):
+    """Return the key for record number i"""
+    key = prefix + '%09d' % (i * step)
+    return key.ljust(keylength, 'X')[:keylength]
+
+
+class MKEYEDGenerator(object):
+    """Writes a synthetic MKEYED file
+
+    :ivar records: The number of record slots written.
+    :ivar deleted: Record numbers left out of the index.
+    :ivar keylength: The length of every key.
+    :ivar recordsize: The size in bytes of a record.
+    :ivar fields: The number of numeric fields after the key field.
+    :ivar fanout: The most keys in one index block.
+    :ivar filetype: FT_MKEYED or FT_MKEYED4GB.
+    """
+
+    def __init__(
+            self, records, keylength=23, recordsize=256, fields=4, fanout=32,
+            layout='2GB', prefix='090N35', step=1, keyfunc=None,
+            deleted=()):
+        """
+        :param records: The number of records to write.
+        :param keylength: The length of every key.
+        :param recordsize: The size in bytes of a record.
+        :param fields: The number of numeric fields after the key field.
+        :param fanout: The most keys in one index block, at most 255.
+        :param layout: '2GB' or '4GB'.
+        :param prefix: The start of every key.
+        :param step: Key numbers go up by this much, so steps above 1 leave
+            room for keys that are missing from the file.
+        :param keyfunc: Optional callable returning the key for a record
+            number.  Keys must come out in ascending order.
+        :param deleted: Record numbers written to their slots but left out
+            of the index, like records that were deleted.
+        """
+        if layout.upper() not in LAYOUTS:
+            raise ValueError("Unknown layout %r" % layout)
+        if not 1 < fanout < 256:
+            raise ValueError("fanout must be between 2 and 255")
+        if not 0 < keylength < 256:
+            raise ValueError("keylength must be between 1 and 255")
+        self.records = records
+        self.keylength = keylength
+        self.recordsize = recordsize
+        self.fields = fields
+        self.fanout = fanout
+        self.filetype = LAYOUTS[layout.upper()]
+        self.prefix = prefix
+        self.step = step
+        self.keyfunc = keyfunc
+        self.deleted = frozenset(deleted)
+        # The record numbers in the index, by position
+        self._indexed = [i for i in xrange(records) if i not in self.deleted]
+
+        constants = MKEYEDReader.ALL_CONSTANTS[self.filetype]
+        self.constants = constants
+        self.addr_layout = constants['addr_layout']
+        self.slot = constants['record_offset'] + recordsize
+        self.data_start = DATA_START[self.filetype]
+
+        # The key, then up to five digits per field, each with a newline
+        if keylength + 1 + fields * 6 > recordsize:
+            raise ValueError("%d fields don't fit in %d bytes" %
+                             (fields, recordsize))
+
+    def key(self, i):
+        """Return the key of record number i"""
+        if self.keyfunc:
+            return self.keyfunc(i)
+        return default_key(i, self.keylength, self.prefix, self.step)
+
+    def record(self, i):
+        """Return the unpadded record for record number i"""
+        values = [self.key(i)]
+        for field in xrange(1, self.fields + 1):
+            values.append(str((i * field) % 100000))
+        return '\n'.join(values) + '\n'
+
+    def address(self, i):
+        """Return the address of record number i"""
+        return self.data_start + i * self.slot
+
+    def _capacity(self, height):
+        """The most keys a tree of this height can hold"""
+        return (self.fanout + 1) ** height - 1
+
+    def _writeBlock(self, f, prev_index, entries):
+        """Write an index block at the end of f and return its address"""
+        address = f.tell()
+        pack = struct.Struct(self.addr_layout).pack
+        f.write(struct.pack('!B', len(entries)) + pack(prev_index))
+        f.write(''.join(key + pack(record_ptr) + pack(next_index)
+                        for key, record_ptr, next_index in entries))
+        return address
+
+    def _writeTree(self, f, lo, hi, height):
+        """Write the subtree for the indexed records at positions lo..hi-1,
+        return the root address"""
+        count = hi - lo
+        if count <= 0:
+            return 0
+        if height == 1:
+            return self._writeBlock(f, 0, [
+                (self.key(i), self.address(i), 0)
+                for i in self._indexed[lo:hi]])
+
+        # Use as few children as fit, and spread the keys evenly over them
+        below = self._capacity(height - 1)
+        children = max(2, -(-(count + 1) // (below + 1)))
+        separators = children - 1
+        rest = count - separators
+        pos = lo
+        child_ptrs = []
+        separator_ids = []
+        for child in xrange(children):
+            size = rest // children + (1 if child < rest % children else 0)
+            child_ptrs.append(self._writeTree(f, pos, pos + size, height - 1))
+            pos += size
+            if child < separators:
+                separator_ids.append(pos)
+                pos += 1
+        return self._writeBlock(f, child_ptrs[0], [
+            (self.key(self._indexed[i]), self.address(self._indexed[i]),
+             child_ptrs[n + 1])
+            for n, i in enumerate(separator_ids)])
+
+    def write(self, path):
+        """Write the file.
+
+        :param path: Where to write it.
+        :return: The path.
+        """
+        with open(path, 'wb') as f:
+            f.write('\x00' * self.data_start)
+            prefix = RECORD_PREFIX if self.constants['record_offset'] else ''
+            for i in xrange(self.records):
+                f.write(prefix + self.record(i).ljust(
+                    self.recordsize, '\x00'))
+
+            height = 1
+            while self._capacity(height) < len(self._indexed):
+                height += 1
+            root = self._writeTree(f, 0, len(self._indexed), height)
+            filelength = f.tell()
+            if self.filetype == FT_MKEYED and filelength >= 1 << 31:
+                raise ValueError("Too big for the 2GB layout, use 4GB")
+
+            self._writeHeaders(f, root, filelength)
+        return path
+
+    def _writeHeaders(self, f, root, filelength):
+        """Write the file header, MKEYED header and key definitions"""
+        constants = self.constants
+        f.seek(0)
+        f.write('<<bbx>>' + struct.pack(
+            '!BBLH', self.filetype, self.keylength, 0, self.recordsize))
+
+        f.seek(constants['header_start'])
+        nextaddr = self.address(self.records)
+        f.write(struct.pack(
+            constants['header_layout'], 1, self.data_start, nextaddr,
+            len(self._indexed), 0, 0, 0, filelength))
+        # Root index addresses, ended by a null address
+        f.write(struct.pack(constants['addr_layout'], root))
+        f.write(struct.pack(constants['addr_layout'], 0))
+
+        f.seek(constants['keydef_start'])
+        f.write(struct.pack('!BBHBBH', 0, 0, 0, self.keylength, 0, 0))
+        f.write(struct.pack('!BBHBBH', 255, 0, 0, 0, 0, 0))
+
+
+def generate(path, records, **kwargs):
+    """Write a synthetic MKEYED file, see L{MKEYEDGenerator} for options.
+
+    :return: The L{MKEYEDGenerator} used, for its key() and record().
+    """
+    generator = MKEYEDGenerator(records, **kwargs)
+    generator.write(path)
+    return generator
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    generate(sys.argv[1], int(sys.argv[2]),
+             layout=sys.argv[3] if len(sys.argv) > 3 else '2GB')
+
+# vi: set tabstop=4 expandtab textwidth=80 filetype=python:
@@ -0,0 +1,213 @@
+"""
+Incremental scans of MKEYED files
+
+Some jobs scan a whole file every day to pick a few values out of each
+record, when only the records written since the last run can have changed
+the answer.  An L{IncrementalScan} keeps a checkpoint of the last scan: the
+file's MKEYED header, the records a value was picked out of, and in a
+sidecar file a checksum of the key held in each record slot.
+
+- If the header and the file are unchanged, the saved answer is returned
+  without reading anything.
+- Otherwise the index is walked, without reading records, and only the
+  records in slots whose key checksum changed are read: new records, and
+  records written into the slots of deleted ones.  The matches in slots
+  that no longer hold a key are dropped.
+- If the file was replaced (different device or inode), got shorter or its
+  next record address went back, the checkpoint is thrown away and every
+  record is read.
+
+A record rewritten in place under the same key is not read again, so the
+value picked out of a record must not change while its key stays.
+"""
+
+from array import array
+import json
+import os
+import zlib
+
+from mkeyed_registry import file_stamp
+
+CHECKPOINT_VERSION = 3
+
+
+def key_checksum(key):
+    """Return a 32 bit checksum of a key"""
+    return zlib.crc32(key) & 0xffffffff
+
+
+def _saved(value):
+    """Return value with its strings as JSON can hold any bytes in them"""
+    if isinstance(value, str):
+        return value.decode('latin-1')
+    if isinstance(value, (list, tuple)):
+        return [_saved(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_saved(k), _saved(v)) for k, v in value.items())
+    return value
+
+
+def _loaded(value):
+    """Undo L{_saved}, so loaded values have the types a scan returns"""
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    if isinstance(value, list):
+        return [_loaded(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_loaded(k), _loaded(v)) for k, v in value.items())
+    return value
+
+
+def slot_checksums(values=()):
+    """Return an array of key checksums, one per record slot"""
+    checksums = array('I', values)
+    if checksums.itemsize != 4:
+        checksums = array('L', values)
+    return checksums
+
+
+class IncrementalScan(object):
+    """Scans a file, reading only the records added since the last scan
+
+    :ivar path: The JSON checkpoint file.
+    :ivar slots_path: The sidecar holding the key checksum of each slot.
+    :ivar extract: Called with each record's fields, as strings, returns
+        the value to keep, or None to skip the record.  Values must be
+        JSON serializable.
+    :ivar name: Stored in the checkpoint; a checkpoint saved under another
+        name is not used.  Change it when extract changes.
+    :ivar records_read: Records read by the last scan.
+    :ivar full_scan: True if the last scan couldn't use the checkpoint.
+    :ivar index_walked: True if the last scan walked the index.
+    """
+
+    def __init__(self, path, extract, name=''):
+        self.path = path
+        self.slots_path = path + '.slots'
+        self.extract = extract
+        self.name = name
+        self.records_read = 0
+        self.full_scan = False
+        self.index_walked = False
+
+    def _load(self, reader, keynum, slot):
+        """Return the checkpoint and slot checksums if they can be used with
+        reader's file, or None"""
+        try:
+            with open(self.path) as f:
+                checkpoint = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        stamp = file_stamp(reader.filename)
+        if (checkpoint.get('version') != CHECKPOINT_VERSION or
+                checkpoint.get('name') != self.name or
+                checkpoint.get('source') != reader.filename or
+                checkpoint['keynum'] != keynum or
+                checkpoint['slot'] != slot or
+                tuple(checkpoint['file']) != stamp[:2] or
+                stamp[2] < checkpoint['size'] or
+                reader._nextaddr < checkpoint['nextaddr']):
+            return None
+        checksums = slot_checksums()
+        try:
+            with open(self.slots_path, 'rb') as f:
+                checksums.fromfile(f, checkpoint['slots'])
+        except (IOError, OSError, EOFError):
+            return None
+        checkpoint['matches'] = [
+            (key.encode('latin-1'), address, _loaded(value))
+            for key, address, value in checkpoint['matches']]
+        return checkpoint, checksums
+
+    def _save(self, reader, keynum, slot, matches, checksums):
+        """Write the checkpoint for a finished scan"""
+        temp_path = self.slots_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            checksums.tofile(f)
+        os.rename(temp_path, self.slots_path)
+
+        stamp = file_stamp(reader.filename)
+        checkpoint = {
+            'version': CHECKPOINT_VERSION,
+            'name': self.name,
+            'source': reader.filename,
+            'keynum': keynum,
+            'file': list(stamp[:2]),
+            'size': stamp[2],
+            'mtime': stamp[3],
+            'header': list(reader._header),
+            'nextaddr': reader._nextaddr,
+            'slot': slot,
+            'slots': len(checksums),
+            'matches': [(key.decode('latin-1'), address, _saved(value))
+                        for key, address, value in matches],
+        }
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            # dumps() uses the C encoder, dump() doesn't
+            f.write(json.dumps(checkpoint))
+        os.rename(temp_path, self.path)
+
+    def scan(self, reader, keynum=0):
+        """Return the extracted values for every record, in key order.
+
+        :param reader: An open L{MKEYEDReader}.
+        :param keynum: The index to walk.
+        :return: A list of the values extract didn't return None for.
+        """
+        self.records_read = 0
+        self.index_walked = False
+        reader.refreshHeader()
+        reader._setKeyNum(keynum)
+        slot = reader._recordsize + reader._constants['record_offset']
+        loaded = self._load(reader, keynum, slot)
+        self.full_scan = loaded is None
+        if self.full_scan:
+            known, old = {}, slot_checksums()
+        else:
+            checkpoint, old = loaded
+            stamp = file_stamp(reader.filename)
+            if (stamp[2:] == (checkpoint['size'], checkpoint['mtime']) and
+                    checkpoint['header'] == list(reader._header)):
+                return [value for _, _, value in checkpoint['matches']]
+            known = dict((address, value)
+                         for _, address, value in checkpoint['matches'])
+        matches, checksums = self._walk(reader, slot, known, old)
+        self._save(reader, keynum, slot, matches, checksums)
+        return [value for _, _, value in matches]
+
+    def _walk(self, reader, slot, known, old):
+        """Walk the index, reading the records in slots whose key changed.
+
+        :param known: The value for each address in a matching slot that
+            was already read.
+        :param old: The key checksum of each slot at the last scan.
+        :return: The (key, address, value) matches in key order, and the
+            key checksum of each slot now, 0 for slots holding no key.
+        """
+        self.index_walked = True
+        checksums = slot_checksums([0]) * (reader._nextaddr // slot)
+        matches = []
+        if not len(reader):
+            return matches, checksums
+        for key, address in reader.getIndex().cursor():
+            i = address // slot
+            checksum = key_checksum(key)
+            checksums[i] = checksum
+            if i < len(old) and old[i] == checksum:
+                value = known.get(address)
+            else:
+                value = self.extract(
+                    reader.readAddress(address, nonumerics=True))
+                self.records_read += 1
+            if value is not None:
+                matches.append((key, address, value))
+        return matches, checksums
+
+    def remove(self):
+        """Delete the checkpoint, so the next scan reads every record"""
+        for path in (self.path, self.slots_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+# vi: set tabstop=4 expandtab textwidth=80 filetype=python:
@@ -0,0 +1,226 @@
+"""
+Join operators for MKEYED files
+
+Two files can be correlated without nested lookups as long as at least one
+side comes out of its index in join key order:
+
+- If both sides are ordered, L{merge_join} walks both indexes once, side by
+  side.
+- If only one side is ordered, L{lookup_join} reads the other side once,
+  sorts it in batches and probes the ordered side's index for each batch.
+  Sorted probes revisit the same index blocks, which stay cached in the
+  L{MKEYEDIndex}.
+
+L{join} picks the right one for a pair of streams.
+"""
+
+from collections import namedtuple
+from itertools import groupby, islice
+from operator import attrgetter
+
+# Entries produced by a stream: the join key, the index key and the address
+# of the record.  record holds the fields when the stream already read them.
+JoinRow = namedtuple('JoinRow', ['joinkey', 'key', 'record_ptr', 'record'])
+
+
+def _keyfunc(joinkey):
+    """Turn a join key mapping into a function of the index key
+
+    :param joinkey: None for the full key, an int for a key prefix of that
+        length, a slice of the key, or a callable taking the key.
+    """
+    if joinkey is None:
+        return lambda key: key
+    if isinstance(joinkey, int):
+        return lambda key: key[:joinkey]
+    if isinstance(joinkey, slice):
+        return lambda key: key[joinkey]
+    return joinkey
+
+
+class KeyedStream(object):
+    """Index entries of an MKEYED file, joined on (part of) the key
+
+    :ivar reader: The L{MKEYEDReader} to read from.
+    :ivar prefix: Only keys starting with this prefix are streamed.
+    :ivar ordered: True if the join keys come out in ascending order.
+    """
+
+    def __init__(
+            self, reader, prefix=None, joinkey=None, seek=None,
+            ordered=None, stripzeros=False, nonumerics=False):
+        """
+        :param reader: An open L{MKEYEDReader}.
+        :param prefix: Only stream keys starting with this prefix.
+        :param joinkey: How to get the join key from an index key. None
+            joins on the full key, an int on a key prefix of that length,
+            a slice on that part of the key, and a callable gets the key.
+        :param seek: A callable mapping a join key to the key prefix to look
+            up when this stream is probed.  Defaults to the join key itself,
+            which is right for full keys and key prefixes.
+        :param ordered: Whether join keys come out in order.  Full keys and
+            key prefixes always do; for anything else it defaults to False.
+        :param stripzeros: Passed on when reading records.
+        :param nonumerics: Passed on when reading records.
+        """
+        self.reader = reader
+        self.prefix = prefix
+        self.joinkey = _keyfunc(joinkey)
+        self.seek = seek or (lambda value: value)
+        if ordered is None:
+            ordered = joinkey is None or isinstance(joinkey, int)
+        self.ordered = ordered
+        self.stripzeros = stripzeros
+        self.nonumerics = nonumerics
+
+    def __iter__(self):
+        return self._scan(self.prefix)
+
+    def _scan(self, prefix):
+        """Yield L{JoinRow}s for keys starting with prefix"""
+        for key, record_ptr in self.reader.getIndex().cursor(prefix):
+            if prefix and not key.startswith(prefix):
+                return
+            yield JoinRow(self.joinkey(key), key, record_ptr, None)
+
+    def lookup(self, joinkey):
+        """Yield the L{JoinRow}s matching a join key"""
+        prefix = self.seek(joinkey)
+        if self.prefix and not (
+                prefix.startswith(self.prefix) or
+                self.prefix.startswith(prefix)):
+            return
+        for row in self._scan(prefix):
+            if row.joinkey == joinkey:
+                yield row
+
+    def fetch(self, row):
+        """Return the fields of the record for a L{JoinRow}"""
+        if row.record is not None:
+            return row.record
+        return self.reader.readAddress(
+            row.record_ptr, self.stripzeros, self.nonumerics)
+
+
+class RecordStream(KeyedStream):
+    """Records of an MKEYED file, joined on a value from the record
+
+    The records are read in key order, so the join keys are usually not
+    ordered and this stream ends up on the probe side of L{lookup_join}.
+    """
+
+    def __init__(
+            self, reader, joinkey, prefix=None, where=None, ordered=False,
+            stripzeros=False, nonumerics=False):
+        """
+        :param reader: An open L{MKEYEDReader}.
+        :param joinkey: A callable taking the tuple of record fields and
+            returning the join key.
+        :param prefix: Only stream records whose key starts with prefix.
+        :param where: An optional callable taking the tuple of record fields,
+            records it returns False for are skipped.
+        :param ordered: Set if the join keys are known to come out in order.
+        """
+        KeyedStream.__init__(
+            self, reader, prefix=prefix, ordered=ordered,
+            stripzeros=stripzeros, nonumerics=nonumerics)
+        self.recordkey = joinkey
+        self.where = where
+
+    def _scan(self, prefix):
+        for row in KeyedStream._scan(self, prefix):
+            record = KeyedStream.fetch(self, row)
+            if self.where is None or self.where(record):
+                yield row._replace(joinkey=self.recordkey(record),
+                                   record=record)
+
+    def lookup(self, joinkey):
+        raise TypeError("A RecordStream can't be probed by join key.")
+
+
+def merge_join(left, right):
+    """Join two ordered streams in one pass over each
+
+    :param left: An ordered L{KeyedStream}.
+    :param right: An ordered L{KeyedStream}.
+    :return: A generator of (left record, right record) pairs, in join key
+        order.  Duplicate join keys produce every pairing.
+    """
+    assert left.ordered and right.ordered, "Both streams must be ordered."
+    by_joinkey = attrgetter('joinkey')
+    right_groups = groupby(right, by_joinkey)
+    try:
+        right_key, right_rows = next(right_groups)
+    except StopIteration:
+        return
+    for left_key, left_rows in groupby(left, by_joinkey):
+        while right_key < left_key:
+            try:
+                right_key, right_rows = next(right_groups)
+            except StopIteration:
+                return
+        if right_key != left_key:
+            continue
+        # groupby groups can only be walked once
+        right_rows = list(right_rows)
+        for left_row in left_rows:
+            left_record = left.fetch(left_row)
+            for right_row in right_rows:
+                yield left_record, right.fetch(right_row)
+
+
+def lookup_join(probe, indexed, batch_size=1000, probe_is_left=True):
+    """Join an unordered stream against an ordered one
+
+    The probe stream is read once.  Its rows are collected in batches,
+    sorted by join key, and each distinct join key is looked up in the
+    indexed stream, so consecutive lookups descend through the same,
+    already decoded, index blocks.
+
+    :param probe: Any L{KeyedStream}.
+    :param indexed: An ordered L{KeyedStream} that supports lookup().
+    :param batch_size: The number of probe rows sorted together.
+    :param probe_is_left: Yield (probe, indexed) pairs if True, otherwise
+        (indexed, probe) pairs.
+    :return: A generator of record pairs, sorted by join key within each
+        batch.
+    """
+    assert indexed.ordered, "The indexed stream must be ordered."
+    by_joinkey = attrgetter('joinkey')
+    rows = iter(probe)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        batch.sort(key=by_joinkey)
+        for joinkey, probe_rows in groupby(batch, by_joinkey):
+            matches = list(indexed.lookup(joinkey))
+            if not matches:
+                continue
+            for probe_row in probe_rows:
+                probe_record = probe.fetch(probe_row)
+                for match in matches:
+                    if probe_is_left:
+                        yield probe_record, indexed.fetch(match)
+                    else:
+                        yield indexed.fetch(match), probe_record
+
+
+def join(left, right, batch_size=1000):
+    """Inner join two streams using the cheapest available strategy
+
+    :param left: A L{KeyedStream}.
+    :param right: A L{KeyedStream}.
+    :param batch_size: The batch size used if a lookup join is needed.
+    :return: A generator of (left record, right record) pairs.
+    :raises ValueError: If neither stream is ordered.
+    """
+    if left.ordered and right.ordered:
+        return merge_join(left, right)
+    if right.ordered:
+        return lookup_join(left, right, batch_size)
+    if left.ordered:
+        return lookup_join(right, left, batch_size, probe_is_left=False)
+    raise ValueError("At least one side of a join must be key ordered.")
+
+# vi: set tabstop=4 expandtab textwidth=80 filetype=python:
@@ -0,0 +1,219 @@
+"""
+Local read-through mirrors of MKEYED files
+
+Data files under /eic/data live on a shared network mount, where every index
+block read is a round trip.  A L{MKEYEDMirror} keeps a copy of a file on
+local disk (tmpfs when available) and opens readers on the copy.
+
+The copy is split into fixed-size chunks with a checksum for each one, kept
+in a manifest next to the copy, so a refresh can tell which chunks changed.
+The mount doesn't offer checksums of its own and a chunk's size and mtime
+can't be told apart from the file's, so a refresh still reads the whole
+source, sequentially.  Only the changed chunks are written: the old copy is
+copied locally to a new file beside it, the changed chunks are written over
+it and it is renamed into place, so readers that have the old copy open,
+in this process or another, keep reading a complete file.  If no chunk
+changed nothing is written and the old copy is kept.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from mkeyed import MKEYEDReader
+
+CHUNK_SIZE = 1 << 20
+
+
+def default_mirror_dir():
+    """Return the default mirror directory, in tmpfs when there is one"""
+    if os.path.isdir('/dev/shm'):
+        base = '/dev/shm'
+    else:
+        base = tempfile.gettempdir()
+    return os.path.join(base, 'mkeyed-mirror')
+
+
+class MKEYEDMirror(object):
+    """A local copy of an MKEYED file, refreshed chunk by chunk
+
+    :ivar source: The path of the mirrored file.
+    :ivar path: The path of the local copy.
+    :ivar manifest_path: The path of the chunk manifest for the copy.
+    :ivar chunk_size: The size in bytes of the compared chunks.
+    :ivar last_copied: The number of chunks written by the last refresh.
+    """
+
+    def __init__(
+            self, source, mirror_dir=None, chunk_size=CHUNK_SIZE,
+            opener=open):
+        """
+        :param source: The full path to the BBx data file to mirror.
+        :param mirror_dir: The directory for local copies.  Defaults to
+            L{default_mirror_dir}.
+        :param chunk_size: The size in bytes of the compared chunks.
+        :param opener: Used to open the source file, for testing with a
+            throttled stand-in for the network mount.
+        """
+        self.source = source
+        mirror_dir = mirror_dir or default_mirror_dir()
+        if not os.path.isdir(mirror_dir):
+            os.makedirs(mirror_dir)
+        # Keep the whole source path so that files with the same name in
+        # different directories don't share a copy.
+        name = os.path.abspath(source).strip(os.sep).replace(os.sep, '_')
+        self.path = os.path.join(mirror_dir, name)
+        self.manifest_path = self.path + '.chunks'
+        self.chunk_size = chunk_size
+        self.opener = opener
+        self.last_copied = 0
+
+    def _stamp(self):
+        """Return what identifies the current version of the source"""
+        st = os.stat(self.source)
+        return [st.st_ino, st.st_size, st.st_mtime]
+
+    def _loadManifest(self):
+        """Return the saved manifest, or None if it's missing or unusable"""
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if manifest.get('chunk_size') != self.chunk_size:
+            return None
+        if not os.path.exists(self.path):
+            return None
+        return manifest
+
+    def _saveManifest(self, manifest):
+        """Replace the manifest in one step so a crash can't corrupt it"""
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, self.manifest_path)
+
+    def isCurrent(self):
+        """Return True if the copy matches the source's inode, size and
+        mtime"""
+        manifest = self._loadManifest()
+        return manifest is not None and manifest['stamp'] == self._stamp()
+
+    def refresh(self, force=False):
+        """Bring the local copy up to date with the source.
+
+        :param force: Compare every chunk even if the source's inode, size
+            and mtime haven't changed.
+        :return: The number of chunks that changed.
+        """
+        stamp = self._stamp()
+        manifest = self._loadManifest()
+        if manifest and manifest['stamp'] == stamp and not force:
+            self.last_copied = 0
+            return 0
+
+        digests = manifest['digests'] if manifest else []
+        # Invalidate the manifest first, a half-refreshed copy must not be
+        # mistaken for a current one.
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+        new_digests = []
+        copied = 0
+        size = 0
+        tmp = dst = None
+        src = self.opener(self.source, 'rb')
+        try:
+            while True:
+                chunk = src.read(self.chunk_size)
+                if not chunk:
+                    break
+                i = len(new_digests)
+                digest = hashlib.md5(chunk).hexdigest()
+                new_digests.append(digest)
+                size += len(chunk)
+                if i < len(digests) and digests[i] == digest:
+                    continue
+                copied += 1
+                if dst is None:
+                    tmp, dst = self._startCopy(digests)
+                dst.seek(i * self.chunk_size)
+                dst.write(chunk)
+            if dst is None and (len(new_digests) != len(digests) or
+                                not os.path.exists(self.path) or
+                                os.path.getsize(self.path) != size):
+                # Nothing changed but the source got shorter, or is empty
+                tmp, dst = self._startCopy(digests)
+            if dst is not None:
+                dst.truncate(size)
+                dst.close()
+                os.chmod(tmp, 0o644)
+                os.rename(tmp, self.path)
+        except BaseException:
+            if dst is not None:
+                dst.close()
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            raise
+        finally:
+            src.close()
+
+        self._saveManifest({
+            'source': self.source,
+            'stamp': stamp,
+            'chunk_size': self.chunk_size,
+            'digests': new_digests,
+        })
+        self.last_copied = copied
+        return copied
+
+    def _startCopy(self, digests):
+        """Start a new copy beside the current one, holding its content if
+        digests describe it.
+
+        :return: The new file's path, and the file open for writing.
+        """
+        fd, tmp = tempfile.mkstemp(
+            prefix=os.path.basename(self.path) + '.', suffix='.tmp',
+            dir=os.path.dirname(self.path))
+        dst = os.fdopen(fd, 'r+b')
+        if digests:
+            try:
+                with open(self.path, 'rb') as f:
+                    shutil.copyfileobj(f, dst, self.chunk_size)
+            except BaseException:
+                dst.close()
+                os.remove(tmp)
+                raise
+        return tmp, dst
+
+    def open(self, refresh=True):
+        """Open an L{MKEYEDReader} on the local copy.
+
+        :param refresh: Refresh the copy first.
+        :return: Instance of a L{MKEYEDReader}.
+        """
+        if refresh or not os.path.exists(self.path):
+            self.refresh()
+        return MKEYEDReader(self.path)
+
+    def remove(self):
+        """Delete the local copy and its manifest"""
+        for path in (self.manifest_path, self.path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def mirrored_reader(source, mirror_dir=None, chunk_size=CHUNK_SIZE):
+    """Open a reader for source on an up to date local copy.
+
+    :param source: The full path to a BBx data file.
+    :param mirror_dir: The directory for local copies.
+    :param chunk_size: The size in bytes of the compared chunks.
+    :return: Instance of a L{MKEYEDReader}.
+    """
+    return MKEYEDMirror(source, mirror_dir, chunk_size).open()
+
+# vi: set tabstop=4 expandtab textwidth=80 filetype=python:
@@ -0,0 +1,170 @@
+"""
+Open MKEYED readers shared within a process
+
+Opening a L{MKEYEDReader} is cheap, but its index starts cold: the first
+lookups decode the index blocks they pass through.  A L{ReaderRegistry}
+keeps readers open after use, per file path, and hands them out again so
+later searches in the same process start with a warm index.
+
+A reader has a cursor, so it is used by one caller at a time: acquire()
+checks a reader out and release() checks it back in.  Readers are reopened
+when their file is replaced or changed (device, inode, size or mtime), and
+closed after sitting unused for idle_timeout seconds.
+
+Typical use::
+
+    with readers.reader('/eic/data/AGPPI') as reader:
+        reader.read(key)
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from mkeyed import MKEYEDReader
+
+
+def file_stamp(path):
+    """Return what identifies the current version of a file"""
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+class ReaderRegistry(object):
+    """A pool of open readers per file path
+
+    :ivar idle_timeout: Seconds an unused reader stays open.
+    :ivar max_idle: The most unused readers kept per path.
+    :ivar opener: Called with a path to open a reader.
+    :ivar opened: Readers opened so far.
+    :ivar reused: Readers handed out again so far.
+    """
+
+    def __init__(self, idle_timeout=300.0, max_idle=4, opener=MKEYEDReader):
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.opener = opener
+        self.opened = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+        # path -> [(reader, stamp, released at), ...], most recent last
+        self._idle = {}
+        # id(reader) -> (path, stamp) for checked out readers
+        self._out = {}
+        self._reaper = None
+
+    def __len__(self):
+        """Return the number of idle readers"""
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+    def acquire(self, path, opener=None):
+        """Check out a reader for a file, opening one if none is idle.
+
+        :param path: The data file.
+        :param opener: Called with the path to open a reader, instead of
+            L{opener}.
+        :return: An L{MKEYEDReader} positioned before the first key.
+        """
+        stamp = file_stamp(path)
+        stale = []
+        reader = None
+        with self._lock:
+            idle = self._idle.get(path, [])
+            while idle:
+                candidate, candidate_stamp, _ = idle.pop()
+                if candidate_stamp == stamp:
+                    reader = candidate
+                    self.reused += 1
+                    break
+                stale.append(candidate)
+            if not idle:
+                self._idle.pop(path, None)
+        for old in stale:
+            old.close()
+
+        if reader is None:
+            reader = (opener or self.opener)(path)
+            self.opened += 1
+        else:
+            reader._setKeyNum(0)
+            reader._cursor, reader._cursor_spec = None, None
+        with self._lock:
+            self._out[id(reader)] = (path, stamp)
+        return reader
+
+    def release(self, reader):
+        """Check a reader back in.
+
+        :param reader: A reader from L{acquire}.
+        """
+        with self._lock:
+            path, stamp = self._out.pop(id(reader))
+            idle = self._idle.setdefault(path, [])
+            idle.append((reader, stamp, time.time()))
+            extra = idle[:-self.max_idle] if self.max_idle else idle[:]
+            del idle[:len(extra)]
+            if not idle:
+                del self._idle[path]
+            self._startReaper()
+        for old, _, _ in extra:
+            old.close()
+
+    @contextmanager
+    def reader(self, path, opener=None):
+        """Check out a reader for the length of a with block"""
+        reader = self.acquire(path, opener)
+        try:
+            yield reader
+        finally:
+            self.release(reader)
+
+    def closeIdle(self, older_than=None):
+        """Close idle readers.
+
+        :param older_than: Only close readers unused for this many seconds.
+            None closes them all.
+        :return: The number closed.
+        """
+        cutoff = time.time() - (older_than or 0)
+        closing = []
+        with self._lock:
+            for path, idle in list(self._idle.items()):
+                keep = [entry for entry in idle if entry[2] > cutoff]
+                closing.extend(entry[0] for entry in idle if entry[2] <= cutoff)
+                if keep:
+                    self._idle[path] = keep
+                else:
+                    del self._idle[path]
+        for reader in closing:
+            reader.close()
+        return len(closing)
+
+    def _startReaper(self):
+        """Start the thread closing idle readers, if it isn't running.
+
+        Called with the lock held.
+        """
+        if self._reaper is not None or not self.idle_timeout:
+            return
+        self._reaper = threading.Thread(
+            target=self._reap, name="MKEYED reader reaper")
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    def _reap(self):
+        """Close readers as they time out, until none are idle"""
+        while True:
+            time.sleep(max(0.01, self.idle_timeout / 4.0))
+            self.closeIdle(self.idle_timeout)
+            with self._lock:
+                if not self._idle:
+                    self._reaper = None
+                    return
+
+
+# The registry shared by everything in the process
+readers = ReaderRegistry()
+
+# vi: set tabstop=4 expandtab textwidth=80 filetype=python:
@@ -0,0 +1,182 @@
+"""
+Decoded MKEYED indexes shared between processes
+
+Each process reading an MKEYED file decodes its own copy of the index blocks.
+A L{SharedIndex} flattens an index once into a single anonymous shared mmap:
+a small header, every key back to back in key order, then the record address
+for each key.  Worker processes forked after publishing inherit the mapping
+and search it in place, so the index is held in RAM once no matter how many
+workers there are, and a worker can start reading as soon as it starts.
+
+Typical use::
+
+    shared = SharedIndex.publish(MKEYEDReader(path))
+    # in each worker, after fork()
+    reader = MKEYEDReader(path)
+    shared.install(reader)
+"""
+
+import mmap
+import struct
+
+from mkeyed import (
+    MKEYEDIndexBlock, BBPyScanTokenError, decodeScanToken, encodeScanToken)
+
+# magic, keynum, keylength, count, then the header stamp of the data file
+HEADER = struct.Struct('!8sIIQQQQ')
+MAGIC = b'MKSHIDX1'
+ADDRESS = struct.Struct('!Q')
+
+
+class SharedIndex(object):
+    """A read-only flattened index in shared memory
+
+    :ivar keynum: The keynum of the index.
+    :ivar keylength: The length of every key.
+    :ivar stamp: The (next address, record count, file length) of the data
+        file when it was published.
+    """
+
+    def __init__(self, buf):
+        self._buf = buf
+        (magic, self.keynum, self.keylength, self._count,
+         nextaddr, recordcount, filelength) = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a shared MKEYED index: %r" % (magic,))
+        self.stamp = (nextaddr, recordcount, filelength)
+        self._keys_start = HEADER.size
+        self._addrs_start = self._keys_start + self._count * self.keylength
+
+    @classmethod
+    def publish(cls, reader):
+        """Flatten the current index of a reader into shared memory.
+
+        Publish before forking the workers; they inherit the mapping.
+
+        :param reader: An open L{MKEYEDReader}.
+        :return: The L{SharedIndex}.
+        """
+        keys = []
+        addrs = []
+        for key, record_ptr in reader.getIndex().cursor():
+            keys.append(key)
+            addrs.append(record_ptr)
+        keylength = reader.getKeylength()
+        size = HEADER.size + len(keys) * (keylength + ADDRESS.size)
+        buf = mmap.mmap(-1, size)
+        HEADER.pack_into(
+            buf, 0, MAGIC, reader.keynum, keylength, len(keys),
+            reader._nextaddr, reader._recordcount, reader._filelength)
+        pos = HEADER.size
+        buf[pos:pos + len(keys) * keylength] = b''.join(keys)
+        pos += len(keys) * keylength
+        buf[pos:size] = struct.pack('!%dQ' % len(addrs), *addrs)
+        return cls(buf)
+
+    def __len__(self):
+        return self._count
+
+    def _key(self, i):
+        start = self._keys_start + i * self.keylength
+        return bytes(self._buf[start:start + self.keylength])
+
+    def _address(self, i):
+        return ADDRESS.unpack_from(
+            self._buf, self._addrs_start + i * ADDRESS.size)[0]
+
+    def _bisect(self, key):
+        """Return the position of the first key >= key"""
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, key):
+        """Return the record address for a full key, or None"""
+        pos = self._bisect(key)
+        if pos < self._count and self._key(pos) == key:
+            return self._address(pos)
+        return None
+
+    def cursor(self, searchkey=None):
+        """Return (key, record_ptr) pairs starting at searchkey
+
+        :param searchkey: A full key, partial key, or None
+        :return the first key, record_ptr pair after the searchkey
+        """
+        pos = 0 if searchkey is None else self._bisect(searchkey)
+        return SharedIndexCursor(self, pos)
+
+    def resume(self, token):
+        """Continue a scan after the last key saved in a token.
+
+        Tokens from L{MKEYEDIndex} cursors work too; only their last key is
+        used.
+
+        :raises BBPyScanTokenError: If the token can't be read or is for
+            another index.
+        """
+        scan = decodeScanToken(token)
+        if scan.keynum != self.keynum:
+            raise BBPyScanTokenError(
+                "Token is for key %d, not key %d" % (scan.keynum, self.keynum))
+        if scan.lastkey is None:
+            return SharedIndexCursor(self, 0)
+        pos = self._bisect(scan.lastkey)
+        if pos < self._count and self._key(pos) == scan.lastkey:
+            pos += 1
+        return SharedIndexCursor(self, pos, scan.lastkey)
+
+    def matches(self, reader):
+        """Return True if reader's data file hasn't changed since publishing"""
+        return self.stamp == (
+            reader._nextaddr, reader._recordcount, reader._filelength)
+
+    def install(self, reader):
+        """Make reader use this index for its keynum.
+
+        :raises ValueError: If the data file changed since publishing.
+        """
+        if not self.matches(reader):
+            raise ValueError(
+                "%s changed since its index was shared." % reader.filename)
+        reader.setIndex(self, self.keynum)
+
+    def close(self):
+        """Unmap the index in this process"""
+        if self._buf is not None:
+            self._buf.close()
+            self._buf = None
+
+
+class SharedIndexCursor(object):
+    """Walks a L{SharedIndex} in key order, like L{MKEYEDIndexCursor}"""
+
+    def __init__(self, index, pos, lastkey=None):
+        self.index = index
+        self.pos = pos
+        self.lastkey = lastkey
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return the next L{MKEYEDIndexBlock.KeyResult}"""
+        if self.pos >= self.index._count:
+            raise StopIteration
+        self.lastkey = self.index._key(self.pos)
+        address = self.index._address(self.pos)
+        self.pos += 1
+        return MKEYEDIndexBlock.KeyResult(self.lastkey, address)
+
+    __next__ = next
+
+    def token(self):
+        """Return the position as a string for resume()"""
+        return encodeScanToken(self.index.keynum, self.lastkey)
+
+# vi: set tabstop=4 expandtab textwidth=80 filetype=python:
@@ -1,16 +1,51 @@
 '''Handles identifying policies available for rewrite'''
 
-from bbpy.files.mkeyed import MKEYEDReader
+from contextlib import contextmanager
+
+from mkeyed import MKEYEDReader
+from mkeyed_incremental import IncrementalScan
+from mkeyed_join import KeyedStream, RecordStream, join
+from mkeyed_mirror import MKEYEDMirror
+from mkeyed_registry import readers
 from policy import Policy
+from search_profiler import NullProfiler
 import utils
 
 
+def rewritten_policy(fields):
+    '''Return the policy number of a DBFW21 rewrite trigger record
+
+    Args:
+        fields (tuple): The record's fields
+
+    Returns:
+        The policy number, or None for other records
+    '''
+    record = fields[0]
+    if record[20:21] == 'T':
+        return record[26:35]
+    return None
+
+
 class Search(object):
     '''Rewrite policy finder'''
 
     keylength = 23
     datafile = '/eic/data/AGPPI'
     dbfw21_file = '/eic/data/DBFW21'
+    # Set to a local directory (e.g. under /dev/shm) to read the data files
+    # through a local mirror instead of the network mount
+    mirror_dir = None
+    # Set to True to measure reader I/O for each find() in last_profile
+    profile = False
+    # Open readers are shared with other searches in the process, so their
+    # decoded indexes stay warm between searches
+    registry = readers
+    # Set to a JSON file for find_rewritten() to keep its results in, so
+    # later calls only read the DBFW21 records written since
+    rewritten_checkpoint = None
+    # Set to a search_profiler.SearchProfiler to time the stages of find()
+    profiler = None
 
     def __init__(self):
         '''Initialize a policy search
@@ -18,7 +53,62 @@ class Search(object):
         Returns:
             policies (list): List of policy numbers
         '''
-        self.reader = MKEYEDReader(self.datafile)
+        # Only checked out for a with block; otherwise each search checks
+        # one out and returns it, so none is left pinned
+        self.reader = None
+        self.last_profile = None
+
+    def __enter__(self):
+        if self.reader is None:
+            self.reader = self.open_reader(self.datafile)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''Return the AGPPI reader to the registry'''
+        if self.reader is not None:
+            self.close_reader(self.reader)
+            self.reader = None
+
+    @contextmanager
+    def _agppi(self):
+        '''Use the AGPPI reader of the with block, or check one out for the
+        length of this block'''
+        if self.reader is not None:
+            yield self.reader
+            return
+        reader = self.open_reader(self.datafile)
+        try:
+            yield reader
+        finally:
+            self.close_reader(reader)
+
+    @classmethod
+    def open_reader(cls, path):
+        '''Check out a reader on a data file from the registry, opened
+        through the local mirror if one is configured
+
+        Args:
+            path (str): Full path to the data file
+
+        Returns:
+            An MKEYEDReader, to be returned with close_reader()
+        '''
+        return cls.registry.acquire(path, opener=cls._open)
+
+    @classmethod
+    def close_reader(cls, reader):
+        '''Return a reader from open_reader() to the registry'''
+        cls.registry.release(reader)
+
+    @classmethod
+    def _open(cls, path):
+        '''Open a new reader for open_reader()'''
+        if cls.mirror_dir:
+            return MKEYEDMirror(path, cls.mirror_dir).open()
+        return MKEYEDReader(path)
 
     def find(self, keys, count, filter_by=lambda policy: True):
         '''Find records that meet requirements
@@ -31,13 +121,37 @@ class Search(object):
         Returns
             A list of policies
         '''
+        profiler = self.profiler or NullProfiler()
+        with self._agppi() as reader:
+            with reader.profile(enabled=self.profile) as profile:
+                with profiler.search('find', count=count):
+                    policies = self._find(
+                        reader, keys, count, filter_by, profiler)
+        if self.profile:
+            self.last_profile = profile
+        return policies
+
+    def _find(self, reader, keys, count, filter_by, profiler):
+        '''Run the search for find()'''
         policies = []
         for key in keys:
-            start_key = utils.get_starting_key(key, self.keylength, self.reader)
-
-            for rec in self.reader.readGenerator(start_key):
-                pol = Policy(rec)
-                if filter_by(pol):
+            with profiler.stage('index', key):
+                start_key = utils.get_starting_key(
+                    key, self.keylength, reader)
+
+            records = reader.readGenerator(start_key)
+            while True:
+                with profiler.stage('read', key):
+                    rec = next(records, None)
+                if rec is None:
+                    break
+                with profiler.stage('decode', key):
+                    pol = Policy(rec, fetch_billing=False)
+                with profiler.stage('billing', key):
+                    pol.get_billing()
+                with profiler.stage('predicate', key):
+                    matched = filter_by(pol)
+                if matched:
                     policies.append(pol.record.pol.strip())
 
                 if len(policies) > count:
@@ -93,19 +207,70 @@ class Search(object):
             filter_by=lambda policy: policy.is_endorsable()
         )
 
-    def find_rewritten(self):
+    def find_rewritten(self, checkpoint=None):
         '''Search for policies that were rewritten the day before
 
+        Args:
+            checkpoint (str): A checkpoint file from an earlier call, see
+                mkeyed_incremental.  Defaults to rewritten_checkpoint.
+                Without one, every record is read.
+
         Returns:
             List of policies 
         '''
-        reader = MKEYEDReader(self.dbfw21_file)
-        policies = [
-            record[26:35]
-            for record in reader
-            if record[20:21] == 'T'
-        ]
+        checkpoint = checkpoint or self.rewritten_checkpoint
+        reader = self.open_reader(self.dbfw21_file)
+        try:
+            if checkpoint:
+                scan = IncrementalScan(
+                    checkpoint, rewritten_policy, name='rewritten')
+                policies = scan.scan(reader)
+            else:
+                policies = [
+                    record[26:35]
+                    for record in reader
+                    if record[20:21] == 'T'
+                ]
+        finally:
+            self.close_reader(reader)
+
+        return policies
+
+    def find_rewritten_eligible(
+            self, filter_by=lambda policy: policy.is_rewritable()):
+        '''Search for policies rewritten the day before that still qualify
 
+        DBFW21 is read once and its policy numbers are looked up in AGPPI in
+        sorted batches, rather than searching AGPPI once per policy.
+
+        Args:
+            filter_by: Filter criteria for the AGPPI policy
+
+        Returns:
+            List of policies
+        '''
+        policies = []
+        with self._agppi() as agppi:
+            dbfw21 = self.open_reader(self.dbfw21_file)
+            rewritten = RecordStream(
+                dbfw21,
+                joinkey=lambda record: record[0][26:35],
+                where=lambda record: record[0][20:21] == 'T'
+            )
+            current = KeyedStream(
+                agppi,
+                prefix=utils.company_code,
+                joinkey=utils.policy_key,
+                seek=lambda policy: utils.company_code + policy,
+                ordered=True
+            )
+            try:
+                for _, record in join(rewritten, current):
+                    pol = Policy(record[0])
+                    if filter_by(pol):
+                        policies.append(pol.record.pol.strip())
+            finally:
+                self.close_reader(dbfw21)
         return policies
 
     @staticmethod
@@ -120,9 +285,8 @@ class Search(object):
             A list of policies
         '''
         keys = utils.get_keys(state)
-        searcher = Search()
-        rewrites = searcher.find_rewrites(keys, count)
-        return rewrites
+        with Search() as searcher:
+            return searcher.find_rewrites(keys, count)
 
     @staticmethod
     def get_renewals(state, count=10):
@@ -136,9 +300,8 @@ class Search(object):
             A list of policies
         '''
         keys = utils.get_keys(state)
-        searcher = Search()
-        renewals = searcher.find_renewals(keys, count)
-        return renewals
+        with Search() as searcher:
+            return searcher.find_renewals(keys, count)
 
     @staticmethod
     def get_endorsements(state, count=10):
@@ -152,9 +315,8 @@ class Search(object):
             A list of policies
         '''
         keys = utils.get_keys(state)
-        searcher = Search()
-        endorsements = searcher.find_endorsements(keys, count)
-        return endorsements
+        with Search() as searcher:
+            return searcher.find_endorsements(keys, count)
 
     @staticmethod
     def get_rewritten():
@@ -163,5 +325,16 @@ class Search(object):
         Returns:
             A list of policies
         '''
-        searcher = Search()
-        return searcher.find_rewritten()
+        with Search() as searcher:
+            return searcher.find_rewritten()
+
+    @staticmethod
+    def get_rewritten_eligible():
+        '''Retrieve policies rewritten the day before that are still eligible
+        for rewrite
+
+        Returns:
+            A list of policies
+        '''
+        with Search() as searcher:
+            return searcher.find_rewritten_eligible()
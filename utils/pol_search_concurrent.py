@@ -0,0 +1,198 @@
+'''Concurrent versions of the Search entry points
+
+Searches read AGPPI on a small thread pool and run billing lookups, which
+wait on the network, concurrently on another.  Matching policy numbers come
+out of an iterator as they are found, in key order, while the next chunk of
+records is already being read.  The iterator blocks while it waits on the
+pools, so it is driven from one thread, such as a worker of an event loop's
+executor, to keep orchestration code from blocking on the scan.
+
+A scan stops promptly when its iterator is closed, when its stop event is
+set or when ConcurrentSearch.cancel() is called, including scans not
+iterated yet.  At most one more record is read after that, and billing
+lookups that haven't started are skipped.
+
+Like Search.find(), a scan returns up to count + 1 policies.
+
+Typical use::
+
+    with ConcurrentSearch() as search:
+        for policy in search.iter_rewrites('OK', 10):
+            ...
+'''
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+from pol_search import Search
+from policy import Policy
+import utils
+
+
+class ConcurrentSearch(object):
+    '''Policy searches that read and look up billing concurrently'''
+
+    # Records read from AGPPI per trip to the disk pool
+    chunk_size = 50
+
+    def __init__(self, disk_workers=2, billing_workers=8, search=Search):
+        '''Create the thread pools
+
+        Args:
+            disk_workers (int): Threads reading data files
+            billing_workers (int): Billing lookups run at once
+            search: The Search class whose readers and settings are used
+        '''
+        self.search = search
+        self._disk = ThreadPool(disk_workers)
+        self._billing = ThreadPool(billing_workers)
+        self._scans = set()
+        self._cancels = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self, wait=False):
+        '''Stop every scan and shut the thread pools down
+
+        Args:
+            wait (bool): Wait for the reads and lookups already started
+        '''
+        self.cancel()
+        self._disk.close()
+        self._billing.close()
+        if wait:
+            self._disk.join()
+            self._billing.join()
+
+    def cancel(self):
+        '''Stop every scan, started or not'''
+        with self._lock:
+            self._cancels += 1
+            scans = list(self._scans)
+        for stop in scans:
+            stop.set()
+
+    def _read_chunk(self, records, stop):
+        '''Read the next chunk of records, on the disk pool'''
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= self.chunk_size or stop.is_set():
+                break
+        return chunk
+
+    @staticmethod
+    def _check(record, filter_by, stop):
+        '''Build a Policy, which looks up its billing, and filter it'''
+        if stop.is_set():
+            return None
+        policy = Policy(record)
+        if filter_by(policy):
+            return policy.record.pol.strip()
+        return None
+
+    def find(self, keys, count, filter_by=lambda policy: True, stop=None):
+        '''Find records that meet requirements
+
+        Args:
+            keys (list): List of keys to use as starting keys
+            count (int): Number of results to return; like Search.find(),
+                the scan stops once it has more than count
+            filter_by: Filter criteria
+            stop (threading.Event): Set to stop the scan
+
+        Returns:
+            An iterator of policy numbers, in key order
+        '''
+        # Taken now, so a cancel() before the first next() stops the scan
+        with self._lock:
+            cancels = self._cancels
+        return self._scan(keys, count, filter_by, stop or threading.Event(),
+                          cancels)
+
+    def _scan(self, keys, count, filter_by, stop, cancels):
+        '''Run the scan for find()'''
+        with self._lock:
+            self._scans.add(stop)
+            if self._cancels != cancels:
+                stop.set()
+        search = self.search
+        reader = None
+        reading = None
+        found = 0
+        try:
+            reader = self._disk.apply_async(
+                search.open_reader, (search.datafile,)).get()
+            for key in keys:
+                start_key = self._disk.apply_async(
+                    utils.get_starting_key,
+                    (key, search.keylength, reader)).get()
+                records = reader.readGenerator(start_key)
+                reading = self._disk.apply_async(
+                    self._read_chunk, (records, stop))
+                while not stop.is_set():
+                    chunk = reading.get()
+                    if not chunk:
+                        break
+                    # Read ahead while the billing lookups run
+                    reading = self._disk.apply_async(
+                        self._read_chunk, (records, stop))
+                    checks = [self._billing.apply_async(
+                        self._check, (record, filter_by, stop))
+                        for record in chunk]
+                    for check in checks:
+                        policy = check.get()
+                        if stop.is_set():
+                            return
+                        if policy is None:
+                            continue
+                        yield policy
+                        found += 1
+                        if found > count:
+                            return
+        finally:
+            # Skips the lookups still queued for this scan
+            stop.set()
+            with self._lock:
+                self._scans.discard(stop)
+            if reader is not None:
+                # Hand the reader back once nothing is reading from it
+                if reading is not None:
+                    reading.wait()
+                search.close_reader(reader)
+
+    def iter_rewrites(self, state, count=10, stop=None):
+        '''Iterate over policies eligible for rewrite, see find()'''
+        return self.find(utils.get_keys(state), count,
+                         lambda policy: policy.is_rewritable(), stop)
+
+    def iter_renewals(self, state, count=10, stop=None):
+        '''Iterate over policies eligible for renewal, see find()'''
+        return self.find(utils.get_keys(state), count,
+                         lambda policy: policy.is_renewable(), stop)
+
+    def iter_endorsements(self, state, count=10, stop=None):
+        '''Iterate over policies eligible for endorsing, see find()'''
+        return self.find(utils.get_keys(state), count,
+                         lambda policy: policy.is_endorsable(), stop)
+
+    def get_rewrites(self, state, count=10):
+        '''Retrieve a list of policies eligible for rewrite'''
+        return list(self.iter_rewrites(state, count))
+
+    def get_renewals(self, state, count=10):
+        '''Retrieve a list of policies eligible for renewal'''
+        return list(self.iter_renewals(state, count))
+
+    def get_endorsements(self, state, count=10):
+        '''Retrieve a list of policies eligible for endorsing'''
+        return list(self.iter_endorsements(state, count))
+
+    def get_rewritten(self):
+        '''Retrieve a list of policies that were rewritten the day before'''
+        return self._disk.apply_async(self.search.get_rewritten).get()
@@ -0,0 +1,261 @@
+'''Long-running local policy search service, and a client for it
+
+The daemon keeps one process alive so readers, decoded indexes and billing
+statuses stay warm between searches.  It answers JSON over HTTP on
+localhost, one thread per request:
+
+    GET /rewrites?state=OK&count=10
+    GET /renewals?state=OK&count=10
+    GET /endorsements?state=OK&count=10
+    GET /rewritten
+    GET /health
+
+Searches reply with {"policies": [...]}, failures with {"error": "..."} and
+a 400 status for a missing or bad argument, or a 500 status otherwise.
+
+The daemon turns on Policy's billing cache, so statuses fetched for one
+search are reused by the next for five minutes.
+
+SearchClient has the same get_* methods as Search.  When the daemon isn't
+running it runs the search in-process instead, so callers don't need to
+care.  The client only imports pol_search for that fallback, so it starts
+quickly when the daemon is up.
+
+Usage: python pol_search_daemon.py [--port PORT]
+'''
+
+import errno
+import json
+import socket
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import urlencode
+    from urllib2 import HTTPError, URLError, urlopen
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import parse_qs, urlencode, urlparse
+    from urllib.request import urlopen
+
+HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Paths served, and the Search method and arguments for each
+SEARCHES = {
+    '/rewrites': ('get_rewrites', ('state', 'count')),
+    '/renewals': ('get_renewals', ('state', 'count')),
+    '/endorsements': ('get_endorsements', ('state', 'count')),
+    '/rewritten': ('get_rewritten', ()),
+}
+
+
+class SearchDaemonError(Exception):
+    '''Raised when the daemon reports a failed search'''
+
+
+class SearchRequestError(ValueError):
+    '''Raised when a search is missing an argument or given a bad one'''
+
+
+def not_running(error):
+    '''Return True if a request error means nothing is listening'''
+    reason = getattr(error, 'reason', error)
+    return getattr(reason, 'errno', None) == errno.ECONNREFUSED
+
+
+def run_search(searcher, path, params):
+    '''Run the search for a request path
+
+    Args:
+        searcher: The Search class, or anything with the same get_* methods
+        path (str): One of the SEARCHES paths
+        params (dict): Query parameters, each a single string
+
+    Returns:
+        A list of policies
+
+    Raises:
+        SearchRequestError: If state is missing or count isn't a number
+    '''
+    method, names = SEARCHES[path]
+    args = []
+    for name in names:
+        if name not in params:
+            # count has a default, the others are required
+            if name == 'count':
+                break
+            raise SearchRequestError('Missing %s' % name)
+        value = params[name]
+        if name == 'count':
+            try:
+                value = int(value)
+            except ValueError:
+                raise SearchRequestError('Bad count %r' % value)
+        args.append(value)
+    return getattr(searcher, method)(*args)
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    '''Answers one search request'''
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((name, values[-1])
+                      for name, values in parse_qs(url.query).items())
+        if url.path == '/health':
+            self.reply(200, {'status': 'ok',
+                             'uptime': time.time() - self.server.started,
+                             'requests': self.server.requests})
+            return
+        if url.path not in SEARCHES:
+            self.reply(404, {'error': 'Unknown search %s' % url.path})
+            return
+
+        self.server.count_request()
+        try:
+            policies = run_search(self.server.searcher, url.path, params)
+        except SearchRequestError as e:
+            self.reply(400, {'error': str(e)})
+        except Exception as e:
+            self.reply(500, {'error': '%s: %s' % (type(e).__name__, e)})
+        else:
+            self.reply(200, {'policies': list(policies)})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+class SearchDaemon(ThreadingMixIn, HTTPServer):
+    '''HTTP server running each search in its own thread'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=DEFAULT_PORT, searcher=None, verbose=False,
+                 billing_ttl=300):
+        '''Start listening on localhost
+
+        Args:
+            port (int): The port, 0 picks a free one
+            searcher: The Search class to use, imported if not given
+            verbose (bool): Log each request to stderr
+            billing_ttl (int): Seconds to reuse billing statuses for when
+                searching with Search, 0 to always fetch them
+        '''
+        if searcher is None:
+            from pol_search import Search
+            from policy import Policy
+            Policy.cache_billing(billing_ttl)
+            searcher = Search
+        self.searcher = searcher
+        self.verbose = verbose
+        self.started = time.time()
+        self.requests = 0
+        self._lock = threading.Lock()
+        HTTPServer.__init__(self, (HOST, port), SearchHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+
+class SearchClient(object):
+    '''Runs searches through the daemon, or in-process without one'''
+
+    def __init__(self, port=DEFAULT_PORT, timeout=300, fallback=True):
+        '''Create a client
+
+        Args:
+            port (int): The daemon's port
+            timeout (int): Seconds to wait for a search
+            fallback (bool): Search in-process when the daemon isn't running
+        '''
+        self.port = port
+        self.timeout = timeout
+        self.fallback = fallback
+
+    def request(self, path, **params):
+        '''Run one search
+
+        Args:
+            path (str): One of the SEARCHES paths
+            params: The search arguments
+
+        Returns:
+            A list of policies
+        '''
+        url = 'http://%s:%d%s' % (HOST, self.port, path)
+        if params:
+            url += '?' + urlencode(params)
+        try:
+            response = urlopen(url, timeout=self.timeout)
+        except HTTPError as e:
+            try:
+                error = json.loads(e.read().decode('utf-8'))['error']
+            except (ValueError, KeyError):
+                error = str(e)
+            raise SearchDaemonError(error)
+        except (URLError, socket.error) as e:
+            # Only search here if the daemon isn't up; a slow daemon may
+            # still be searching
+            if not (self.fallback and not_running(e)):
+                raise
+            from pol_search import Search
+            return run_search(
+                Search, path, dict((name, str(value))
+                                   for name, value in params.items()))
+        try:
+            return json.loads(response.read().decode('utf-8'))['policies']
+        finally:
+            response.close()
+
+    def get_rewrites(self, state, count=10):
+        return self.request('/rewrites', state=state, count=count)
+
+    def get_renewals(self, state, count=10):
+        return self.request('/renewals', state=state, count=count)
+
+    def get_endorsements(self, state, count=10):
+        return self.request('/endorsements', state=state, count=count)
+
+    def get_rewritten(self):
+        return self.request('/rewritten')
+
+
+def main(argv):
+    port = DEFAULT_PORT
+    if '--port' in argv:
+        port = int(argv[argv.index('--port') + 1])
+    daemon = SearchDaemon(port, verbose=True)
+    sys.stderr.write('Policy search daemon on %s:%d\n' % (HOST, daemon.port))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
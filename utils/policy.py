@@ -1,5 +1,9 @@
 '''Handles identifying policies available for rewrite'''
 
+import threading
+import time
+from collections import OrderedDict
+
 from bbpy.strings import BBPyString
 from bbpy.files.template import getTpl
 from eicpy.insureds import policelink
@@ -9,23 +13,74 @@ class Policy(object):
     '''Rewrite policy finder'''
 
     template = getTpl(['AGPPI.TPL'])
-
-    def __init__(self, record_string):
+    # Billing statuses can be shared by every Policy in the process, fetched
+    # again once they are billing_ttl seconds old.  Off unless
+    # cache_billing() is called, as the search daemon does.
+    billing_ttl = 0
+    billing_cache_size = 10000
+    _billing_cache = OrderedDict()
+    _billing_lock = threading.Lock()
+
+    def __init__(self, record_string, fetch_billing=True):
         '''Handle policies
 
         Args:
             record_string (str): Record string from AGPPI
+            fetch_billing (bool): Look up the billing status now.  If False,
+                call get_billing() before checking eligibility.
         '''
         self.record = BBPyString(record_string, self.template)
         self.policy_number = self.record.pol.strip()
-        self.get_billing()
+        if fetch_billing:
+            self.get_billing()
 
     def get_billing(self):
-        '''Retrieve the billing status for the policy'''
+        '''Retrieve the billing status for the policy, from the cache if it
+        was fetched recently'''
+        cachekey = (self.policy_number, self.record.exp)
+        now = time.time()
+        if self.billing_ttl > 0:
+            with self._billing_lock:
+                cached = self._billing_cache.pop(cachekey, None)
+                if cached is not None and now - cached[0] < self.billing_ttl:
+                    # Most recently used go last
+                    self._billing_cache[cachekey] = cached
+                    self.billing = cached[1]
+                    return
+
         pepolicy = policelink.Policy(self.policy_number, self.record.exp)
         pepolicy.get_billingstatus()
         self.billing = pepolicy.billing
 
+        if self.billing_ttl > 0:
+            with self._billing_lock:
+                cache = self._billing_cache
+                cache.pop(cachekey, None)
+                while cache and len(cache) >= self.billing_cache_size:
+                    cache.popitem(last=False)
+                cache[cachekey] = (now, self.billing)
+
+    @classmethod
+    def cache_billing(cls, ttl=300, size=10000):
+        '''Share billing statuses between every Policy in the process
+
+        Args:
+            ttl (int): Seconds before a status is fetched again, 0 turns the
+                cache off
+            size (int): The most statuses kept; the least recently used are
+                dropped first
+        '''
+        with cls._billing_lock:
+            cls.billing_ttl = ttl
+            cls.billing_cache_size = size
+            cls._billing_cache.clear()
+
+    @classmethod
+    def clear_billing_cache(cls):
+        '''Forget every cached billing status'''
+        with cls._billing_lock:
+            cls._billing_cache.clear()
+
     def is_rewritable(self):
         '''Determine if policy is eligible to be rewritten
 
@@ -0,0 +1,195 @@
+'''Stage timings for policy searches
+
+A SearchProfiler records how long each stage of Search.find() takes, per
+search and per starting key, and can print a summary table or write the
+timings as a Chrome trace (chrome://tracing, Perfetto or speedscope) to see
+the searches as a flame chart.
+
+The stages are:
+
+    index: finding the first record for a starting key in the AGPPI index
+    read: stepping to the next record, which walks the index and reads it
+    decode: splitting the record with the AGPPI template
+    billing: looking up the billing status through policelink
+    predicate: the search's filter
+
+Profiling is off unless a profiler is set on Search:
+
+    profiler = SearchProfiler(trace=True)
+    Search.profiler = profiler
+    Search.get_rewrites('OK', 10)
+    print(profiler.summary())
+    profiler.dump_trace('search_trace.json')
+
+One profiler can be shared by searches in several threads.  It only keeps
+the latest searches and trace events, so one can stay attached to a long
+running process.
+'''
+
+import json
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from timeit import default_timer
+
+STAGES = ('index', 'read', 'decode', 'billing', 'predicate')
+
+
+class _NullStage(object):
+    '''A stage that measures nothing'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class NullProfiler(object):
+    '''Stands in for a SearchProfiler when profiling is off'''
+
+    _stage = _NullStage()
+
+    def search(self, name, **args):
+        return self._stage
+
+    def stage(self, name, key=None):
+        return self._stage
+
+
+class SearchProfiler(object):
+    '''Collects stage timings from searches
+
+    Attributes:
+        searches (deque): A dict per finished search, with its name,
+            elapsed seconds and {stage: [count, seconds]}, the latest
+            max_searches of them
+        stages (dict): [count, seconds, longest] per (key, stage)
+        events (deque): The latest max_events trace events
+    '''
+
+    def __init__(self, trace=False, max_searches=1000, max_events=100000):
+        '''Create an empty profiler
+
+        Args:
+            trace (bool): Keep every stage as a trace event for
+                dump_trace(), rather than only the totals
+            max_searches (int): How many finished searches to keep
+            max_events (int): How many trace events to keep
+        '''
+        self.trace = trace
+        self.searches = deque(maxlen=max_searches)
+        self.stages = {}
+        self.events = deque(maxlen=max_events)
+        self._origin = default_timer()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _event(self, name, category, started, elapsed, args):
+        '''Keep a complete trace event, times in microseconds'''
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (started - self._origin) * 1e6,
+            'dur': elapsed * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args,
+        })
+
+    @contextmanager
+    def search(self, name, **args):
+        '''Time one search; stages inside it are counted towards it
+
+        Args:
+            name (str): What the search is called in the report
+            args: Extra details for the trace event
+        '''
+        totals = {}
+        outer = getattr(self._local, 'totals', None)
+        self._local.totals = totals
+        started = default_timer()
+        try:
+            yield
+        finally:
+            elapsed = default_timer() - started
+            self._local.totals = outer
+            with self._lock:
+                self.searches.append(
+                    {'name': name, 'elapsed': elapsed, 'stages': totals})
+                if self.trace:
+                    self._event(name, 'search', started, elapsed, args)
+
+    @contextmanager
+    def stage(self, name, key=None):
+        '''Time one stage of a search
+
+        Args:
+            name (str): One of STAGES
+            key (str): The starting key being searched
+        '''
+        started = default_timer()
+        try:
+            yield
+        finally:
+            elapsed = default_timer() - started
+            totals = getattr(self._local, 'totals', None)
+            if totals is not None:
+                stage = totals.setdefault(name, [0, 0.0])
+                stage[0] += 1
+                stage[1] += elapsed
+            with self._lock:
+                stage = self.stages.setdefault((key, name), [0, 0.0, 0.0])
+                stage[0] += 1
+                stage[1] += elapsed
+                if elapsed > stage[2]:
+                    stage[2] = elapsed
+                if self.trace:
+                    self._event(name, 'stage', started, elapsed,
+                                {'key': key})
+
+    def clear(self):
+        '''Forget everything recorded so far'''
+        with self._lock:
+            self.searches.clear()
+            self.stages.clear()
+            self.events.clear()
+
+    def summary(self):
+        '''Return a table of the time spent in each stage, per key
+
+        Returns:
+            The table, as a string
+        '''
+        with self._lock:
+            stages = dict(self.stages)
+            searches = list(self.searches)
+        order = dict((name, i) for i, name in enumerate(STAGES))
+        total = sum(stage[1] for stage in stages.values()) or 1.0
+        lines = ['%-12s %-10s %8s %10s %10s %10s %6s' % (
+            'key', 'stage', 'count', 'total ms', 'mean ms', 'max ms', '%')]
+        for key, name in sorted(
+                stages, key=lambda k: (str(k[0]), order.get(k[1], 99), k[1])):
+            count, elapsed, longest = stages[(key, name)]
+            lines.append('%-12s %-10s %8d %10.2f %10.3f %10.3f %6.1f' % (
+                key or '-', name, count, elapsed * 1e3,
+                elapsed * 1e3 / count, longest * 1e3,
+                100.0 * elapsed / total))
+        if searches:
+            lines.append('%d searches, %.2f ms in all' % (
+                len(searches),
+                sum(search['elapsed'] for search in searches) * 1e3))
+        return '\n'.join(lines)
+
+    def dump_trace(self, path):
+        '''Write the recorded events as a Chrome trace event file
+
+        Args:
+            path (str): The JSON file to write
+        '''
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -1,6 +1,6 @@
 '''Utilities for policy searches'''
 
-from bbpy.files.mkeyed import BBPyPartialKeyFoundException
+from mkeyed import BBPyPartialKeyFoundException
 
 starting_keys = {
     'OK': '090N35',
@@ -8,6 +8,10 @@ starting_keys = {
     'MO': '090N24'
 }
 
+# AGPPI keys are the company code followed by the policy number
+company_code = '090'
+policy_key = slice(len(company_code), len(company_code) + 9)
+
 
 def get_keys(state):
     '''Get starting keys from state if one was given